@@ -0,0 +1,11 @@
+""" Plays the audio cues requested with util.play_sound, see audio_cues.py """
+import logging
+import uwsgi
+
+from audio_cues import CueWorker
+
+#######################################
+
+if __name__ == '__main__':
+  logging.warning("start audio cue mule")
+  CueWorker().run()
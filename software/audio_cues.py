@@ -0,0 +1,211 @@
+""" Long lived audio cue player
+
+The WAV files in sounds/ are decoded once into one PCM format and kept in memory.
+util.play_sound sends cue requests as unix datagrams to the worker (run by
+audio_cue_mule.py), which plays them on one open ALSA device. Under bursty load
+a cue already waiting or still starting is merged, and the oldest waiting
+cues are dropped so the sounds never lag behind the timer.
+
+Without pyalsaaudio, or with the null backend, nothing is played which allows
+testing without a sound card:
+
+  python audio_cues.py [--null] sounds/CarStarted.wav sounds/CarFinished.wav ...
+"""
+import logging
+logging.basicConfig()
+import os
+import socket
+import threading
+import wave
+import audioop
+from collections import deque
+from glob import glob
+from time import time, sleep
+
+try:
+  import alsaaudio
+except ImportError:
+  alsaaudio = None # optional, the worker falls back to NullBackend
+
+# unix datagram socket the worker listens on for cue requests
+CUE_SOCKET_PATH = '/tmp/rallyx_audio_cues.sock'
+
+SOUNDS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sounds')
+
+# every cue is converted to this format so the device is only configured once
+PCM_RATE = 44100
+PCM_CHANNELS = 2
+PCM_WIDTH = 2 # bytes per sample, signed little endian
+PCM_PERIOD = 512 # frames per write, about 12ms
+
+CUE_QUEUE_MAX = 2 # cues waiting behind the one playing, older ones are dropped
+CUE_MERGE_INTERVAL = 0.3 # seconds, the same cue requested again this soon after it started playing is merged
+
+#######################################
+
+def send_cue(path):
+  """ Queue a cue with the worker, returns False if it is not running """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+  try:
+    sock.sendto(os.path.basename(path), CUE_SOCKET_PATH)
+    return True
+  except socket.error:
+    return False
+  finally:
+    sock.close()
+
+
+def decode_wav(path):
+  """ PCM frames of a WAV file converted to PCM_RATE, PCM_CHANNELS and PCM_WIDTH """
+  w = wave.open(path, 'rb')
+  try:
+    channels, width, rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+    data = w.readframes(w.getnframes())
+  finally:
+    w.close()
+  if width == 1:
+    data = audioop.bias(data, 1, -128) # 8 bit WAV samples are unsigned
+  if width != PCM_WIDTH:
+    data = audioop.lin2lin(data, width, PCM_WIDTH)
+  if channels == 2 and PCM_CHANNELS == 1:
+    data = audioop.tomono(data, PCM_WIDTH, 0.5, 0.5)
+  if rate != PCM_RATE:
+    data, state = audioop.ratecv(data, PCM_WIDTH, min(channels, PCM_CHANNELS), rate, PCM_RATE, None)
+  if channels == 1 and PCM_CHANNELS == 2:
+    data = audioop.tostereo(data, PCM_WIDTH, 1, 1)
+  return data
+
+
+def load_sounds(sounds_dir=SOUNDS_DIR):
+  """ Decoded cues by file name for every WAV file in sounds_dir """
+  sounds = {}
+  for path in sorted(glob(os.path.join(sounds_dir, '*.wav'))):
+    try:
+      sounds[os.path.basename(path)] = decode_wav(path)
+    except (wave.Error, audioop.error, EOFError):
+      logging.exception("unable to decode %r", path)
+  return sounds
+
+#######################################
+
+class AlsaBackend(object):
+  def __init__(self, device='default'):
+    self.pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NORMAL, device)
+    self.pcm.setchannels(PCM_CHANNELS)
+    self.pcm.setrate(PCM_RATE)
+    self.pcm.setformat(alsaaudio.PCM_FORMAT_S16_LE)
+    self.pcm.setperiodsize(PCM_PERIOD)
+
+  def play(self, name, data):
+    """ Blocks until the last period is written to the device """
+    period_bytes = PCM_PERIOD * PCM_CHANNELS * PCM_WIDTH
+    for i in range(0, len(data), period_bytes):
+      self.pcm.write(data[i:i + period_bytes])
+
+
+class NullBackend(object):
+  """ Plays nothing, keeps the names of the cues played, realtime waits as long as the cue would play """
+
+  def __init__(self, realtime=False):
+    self.realtime = realtime
+    self.played = []
+
+  def play(self, name, data):
+    self.played.append(name)
+    if self.realtime:
+      sleep(float(len(data)) / (PCM_RATE * PCM_CHANNELS * PCM_WIDTH))
+
+
+def default_backend():
+  if alsaaudio is not None:
+    try:
+      return AlsaBackend()
+    except alsaaudio.ALSAAudioError:
+      logging.exception("unable to open the sound device")
+  logging.warning("audio cues are not played, using the null backend")
+  return NullBackend()
+
+#######################################
+
+class CueWorker(object):
+  """ Receives cue requests on a thread and plays them in order on the calling thread """
+
+  def __init__(self, backend=None, sounds=None, socket_path=CUE_SOCKET_PATH):
+    self.backend = backend if backend is not None else default_backend()
+    self.sounds = sounds if sounds is not None else load_sounds()
+    self.socket_path = socket_path
+    self.pending = deque() # cue names waiting to play
+    self.playing = None # (name, start time) of the cue being played
+    self.lock = threading.Condition()
+    self.played_count = 0
+    self.merged_count = 0
+    self.dropped_count = 0
+    self.sock = None
+
+  def bind(self):
+    if os.path.exists(self.socket_path):
+      os.unlink(self.socket_path)
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.sock.bind(self.socket_path)
+
+  def request(self, name):
+    """ Queue a cue by file name, merging and dropping cues as described in the module docstring """
+    if name not in self.sounds:
+      logging.warning("unknown audio cue %r", name)
+      return
+    with self.lock:
+      if name in self.pending or (self.playing is not None and self.playing[0] == name and time() - self.playing[1] < CUE_MERGE_INTERVAL):
+        self.merged_count += 1
+        return
+      if len(self.pending) >= CUE_QUEUE_MAX:
+        dropped = self.pending.popleft()
+        self.dropped_count += 1
+        logging.info("audio cue dropped: %r", dropped)
+      self.pending.append(name)
+      self.lock.notify()
+
+  def receive(self):
+    while True:
+      try:
+        self.request(self.sock.recv(256))
+      except socket.error:
+        logging.exception("audio cue socket")
+        sleep(1)
+
+  def play_next(self, timeout=None):
+    """ Wait for a cue and play it, returns its name or None on timeout """
+    with self.lock:
+      if not self.pending:
+        self.lock.wait(timeout)
+        if not self.pending:
+          return None
+      name = self.pending.popleft()
+      self.playing = (name, time())
+    try:
+      self.backend.play(name, self.sounds[name])
+    except Exception:
+      logging.exception("unable to play %r", name)
+    with self.lock:
+      self.playing = None
+      self.played_count += 1
+    return name
+
+  def run(self):
+    self.bind()
+    receiver = threading.Thread(target=self.receive, name='audio_cue_receiver')
+    receiver.daemon = True
+    receiver.start()
+    logging.warning("audio cue worker ready, %d sounds loaded", len(self.sounds))
+    while True:
+      self.play_next()
+
+
+if __name__ == "__main__":
+  import sys
+  null = '--null' in sys.argv
+  worker = CueWorker(NullBackend(realtime=True) if null else None)
+  for path in [arg for arg in sys.argv[1:] if arg != '--null']:
+    worker.request(os.path.basename(path))
+  while worker.play_next(0):
+    pass
+  print "played %r, %d merged, %d dropped" % (getattr(worker.backend, 'played', worker.played_count), worker.merged_count, worker.dropped_count)
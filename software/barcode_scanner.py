@@ -1,8 +1,10 @@
 from serial_handler import SerialHandler, serial_wrapper
 import re
 from cStringIO import StringIO
+from time import time
 
 BAUDRATE = 9600
+BARCODE_IDLE = 0.2 # seconds without data that ends a barcode, see BarcodeScanner.take_barcode
 
 class ReadTimeout(Exception):
   pass
@@ -50,6 +52,7 @@ def decode_license(data):
 
 class BarcodeScanner(SerialHandler):
   def __init__(self, port=None):
+    self.last_read = 0 # time() of the last bytes read by read_available
     super(BarcodeScanner,self).__init__(port, BAUDRATE)
 
   @serial_wrapper
@@ -63,6 +66,24 @@ class BarcodeScanner(SerialHandler):
     else:
       return None
 
+  @serial_wrapper
+  def read_available(self):
+    """ Read everything waiting on the port into self.buffer, barcodes are framed by take_barcode """
+    if self.read_chunk():
+      self.last_read = time()
+
+  def take_barcode(self, idle=BARCODE_IDLE):
+    """ The buffered barcode once nothing has arrived for idle seconds, otherwise None """
+    if self.buffer and time() - self.last_read >= idle:
+      barcode = str(self.buffer)
+      del self.buffer[:]
+      return barcode
+    return None
+
+  def barcode_deadline(self, idle=BARCODE_IDLE):
+    """ time() at which the buffered barcode is complete, None when nothing is buffered """
+    return self.last_read + idle if self.buffer else None
+
 
 if __name__ == "__main__":
   import sys
@@ -71,5 +92,3 @@ if __name__ == "__main__":
       data = scanner.read()
       if data:
         print repr(data)
-
-
@@ -4,6 +4,7 @@ import threading
 from sql_db import ScoringDatabase
 from time import sleep, time
 import datetime
+import json
 
 from barcode_scanner import BarcodeScanner, decode_license
 from util import play_sound
@@ -15,6 +16,8 @@ except ImportError:
 
 DB_POLL_INTERVAL = 3
 
+log = logging.getLogger('barcode_scanner_mule')
+
 #######################################
 
 def get_db():
@@ -30,8 +33,9 @@ def handle_next_entry(db, data):
     play_sound('sounds/OutputFailure.wav')
     return
 
-  run_group = db.reg_get('run_group')
-  active_event_id = db.reg_get('active_event_id')
+  reg = db.reg_get_many(('run_group', 'active_event_id'))
+  run_group = reg['run_group']
+  active_event_id = reg['active_event_id']
   entry_list = db.query_all("SELECT entry_id, run_group FROM entries WHERE event_id=? AND tracking_number=?", (active_event_id, tracking_number))
 
   if entry_list is None or len(entry_list) == 0:
@@ -55,11 +59,9 @@ def handle_next_entry(db, data):
     
     if next_entry_id is None:
       log.warning("No entry for current run group found")
-      db.reg_set("next_entry_id", None)
-      db.reg_set("next_entry_msg", "Wrong Run Group!")
+      db.reg_set_many({"next_entry_id":None, "next_entry_msg":"Wrong Run Group!"})
     else:
-      db.reg_set("next_entry_id", next_entry_id)
-      db.reg_set("next_entry_msg", None)
+      db.reg_set_many({"next_entry_id":next_entry_id, "next_entry_msg":None})
       log.info("Set next_entry_id, %r", next_entry_id)
       play_sound('sounds/OutputComplete.wav')
 
@@ -67,8 +69,8 @@ def handle_next_entry(db, data):
 
 def handle_barcode(db, data):
   if data.startswith("@"):
-    license_data = decode_pdf417(data)
-    db.reg_set('license_data', license_data)
+    license_data = decode_license(data)
+    db.reg_set('license_data', json.dumps(license_data))
   else:
     db.reg_set('barcode_data', data)
     handle_next_entry(db, data)
@@ -78,7 +80,6 @@ def handle_barcode(db, data):
 if __name__ == '__main__':
   logging.warning("start barcode scanner mule")
   db = get_db()
-  log = logging.getLogger('barcode_scanner_mule')
   scanner = BarcodeScanner()
   open_state = True
   port = None
@@ -0,0 +1,204 @@
+#!/usr/bin/python2
+""" Micro benchmarks for the scoring database hot paths
+
+usage: python benchmark.py run_list [run_count]
+       python benchmark.py score_event [run_count]
+       python benchmark.py serial [record_count]
+"""
+import os
+import sys
+import random
+import tempfile
+import resource
+from time import time
+
+import sql_db
+from sql_db import ScoringDatabase
+import scoring_rules
+import scoring_vector
+
+#######################################
+
+def make_event_db(path, run_count=5000, entry_count=120):
+  """ Create a scratch database holding one event with run_count scored runs """
+  db = ScoringDatabase(path)
+  with db:
+    event_id = db.insert('events', name='benchmark', max_runs=run_count // entry_count + 1, rule_set='DefaultRules')
+    entry_ids = []
+    for i in range(entry_count):
+      entry_ids.append(db.insert('entries', event_id=event_id, first_name='First%d' % i, last_name='Last%d' % i, car_class='SA', car_number=str(i)))
+    for i in range(run_count):
+      start_time_ms = 1000000 + i * 30000
+      finish_time_ms = start_time_ms + random.randint(40000, 90000)
+      db.insert('runs', event_id=event_id, entry_id=entry_ids[i % entry_count], state='scored',
+          start_time_ms=start_time_ms, finish_time_ms=finish_time_ms, cones=random.randint(0,2), gates=0,
+          raw_time_ms=finish_time_ms - start_time_ms, total_time_ms=finish_time_ms - start_time_ms, run_number=i // entry_count + 1)
+  db.close()
+  return event_id
+
+
+def bench_run_list(path, event_id, row_mode, repeat):
+  db = ScoringDatabase(path)
+  if row_mode == 'dict':
+    # previous behaviour, one getdescription() call and one dict per row
+    db.setexectrace(None)
+    db.setrowtrace(sql_db.dict_row_factory)
+  rows = None
+  row_count = 0
+  start = time()
+  for i in range(repeat):
+    rows = db.run_list(event_id=event_id)
+    row_count += len(rows)
+  elapsed = time() - start
+  db.close()
+  return row_count / elapsed
+
+
+def run_child(func, *args):
+  """ Run func in a child process, returns (result, peak rss in KiB) """
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    result = func(*args)
+    os.write(write_fd, repr(result))
+    os._exit(0)
+  os.close(write_fd)
+  result = os.read(read_fd, 1024)
+  os.close(read_fd)
+  _, _, usage = os.wait4(pid, 0)
+  return eval(result), usage.ru_maxrss
+
+
+def run_list_main(run_count=5000):
+  path = tempfile.mktemp(suffix='.db')
+  try:
+    event_id = make_event_db(path, run_count)
+    repeat = 20
+    _, base_rss = run_child(bench_run_list, path, event_id, 'dict', 0)
+    print "run_list over %d runs, %d iterations" % (run_count, repeat)
+    print "%-6s %14s %16s" % ('rows', 'rows/sec', 'peak rss (KiB)')
+    for row_mode in ('dict', 'row'):
+      rate, rss = run_child(bench_run_list, path, event_id, row_mode, repeat)
+      print "%-6s %14.0f %16d" % (row_mode, rate, rss - base_rss)
+  finally:
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(path + suffix):
+        os.remove(path + suffix)
+
+
+def bench_score_event(path, event_id, rule_set, vectorized, repeat):
+  db = ScoringDatabase(path)
+  rules = scoring_rules.get_rule_sets()[rule_set]()
+  rows = rules.load_event(db, event_id)
+  db.close()
+  start = time()
+  for i in range(repeat):
+    rules.score_event(*rows, vectorized=vectorized)
+  return len(rows[1]) * repeat / (time() - start)
+
+
+def score_event_main(run_count=20000):
+  path = tempfile.mktemp(suffix='.db')
+  try:
+    event_id = make_event_db(path, run_count, entry_count=max(run_count // 6, 1))
+    with ScoringDatabase(path) as db:
+      # a few DNFs so the class bogey times have work to do
+      db.execute("UPDATE runs SET dns_dnf=2, state='scored' WHERE run_id % 17 = 0")
+    repeat = 5
+    print "score_event over %d runs, %d iterations" % (run_count, repeat)
+    print "%-24s %14s %14s" % ('rule set', 'python runs/s', 'numpy runs/s')
+    for rule_set in scoring_rules.get_rule_sets():
+      python_rate = bench_score_event(path, event_id, rule_set, False, repeat)
+      if scoring_vector.numpy is None:
+        print "%-24s %14.0f %14s" % (rule_set, python_rate, 'n/a')
+      else:
+        print "%-24s %14.0f %14.0f" % (rule_set, python_rate, bench_score_event(path, event_id, rule_set, True, repeat))
+  finally:
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(path + suffix):
+        os.remove(path + suffix)
+
+def timer_output(record_count):
+  """ Tag Heuer 520 output in the format recorded from the timer, start/finish pairs with a cancelled time now and then """
+  lines = []
+  for i in range(record_count):
+    time_ms = 36000000 + i * 15731
+    kind = 'T-' if i % 50 == 49 else 'T '
+    lines.append("%s %04d     M%d %02d:%02d:%02d.%03d00 \r" % (kind, i // 2 + 1, i % 2 + 1,
+        time_ms // 3600000, time_ms // 60000 % 60, time_ms // 1000 % 60, time_ms % 1000))
+  return "".join(lines)
+
+
+class ReplaySerial(object):
+  """ Stands in for serial.Serial, returns recorded bytes with at most chunk_size waiting at a time """
+  is_open = True
+
+  def __init__(self, data, chunk_size):
+    self.data = data
+    self.pos = 0
+    self.chunk_size = chunk_size
+
+  @property
+  def in_waiting(self):
+    return min(self.chunk_size, len(self.data) - self.pos)
+
+  def read(self, size=1):
+    data = self.data[self.pos:self.pos + size]
+    self.pos += len(data)
+    return data
+
+  def close(self):
+    pass
+
+
+def read_bytewise(timer):
+  # previous TagHeuer520.read, one serial.read(1) call and one string concatenation per byte
+  c = timer.serial.read(1)
+  while c != '':
+    if c == '\r':
+      line, timer.line_buffer = timer.line_buffer, ""
+      return line
+    timer.line_buffer += c
+    c = timer.serial.read(1)
+  return None
+
+
+def bench_serial(data, mode, chunk_size):
+  from tag_heuer_520 import TagHeuer520, parse_record
+  timer = TagHeuer520()
+  timer.serial = ReplaySerial(data, chunk_size)
+  record_count = 0
+  start = time()
+  if mode == 'byte':
+    timer.line_buffer = ""
+    while timer.serial.pos < len(data):
+      line = read_bytewise(timer)
+      if line is not None and parse_record(line) is not None:
+        record_count += 1
+  else:
+    while timer.serial.pos < len(data):
+      record_count += len(timer.read_records())
+  return record_count / (time() - start)
+
+
+def serial_main(record_count=20000):
+  data = timer_output(record_count)
+  print "TagHeuer520 parsing %d records" % record_count
+  print "%-8s %12s %14s" % ('read', 'chunk bytes', 'records/sec')
+  for chunk_size in (30, 4096):
+    for mode in ('byte', 'chunk'):
+      print "%-8s %12d %14.0f" % (mode, chunk_size, bench_serial(data, mode, chunk_size))
+
+#######################################
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2 or sys.argv[1] not in ('run_list', 'score_event', 'serial'):
+    print __doc__
+    sys.exit(1)
+  if sys.argv[1] == 'run_list':
+    run_list_main(*map(int, sys.argv[2:3]))
+  elif sys.argv[1] == 'score_event':
+    score_event_main(*map(int, sys.argv[2:3]))
+  elif sys.argv[1] == 'serial':
+    serial_main(*map(int, sys.argv[2:3]))
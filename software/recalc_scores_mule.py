@@ -13,30 +13,30 @@ try:
 except ImportError:
   raise ImportError("Unable to load scoring_config.py, please reference install instructions!")
 
+LATENCY_PRUNE_INTERVAL = 600 # seconds between latency table prunes
+
 #######################################
 
 def get_db():
   return ScoringDatabase(config.SCORING_DB_PATH)
 
-def get_event(db):
-  active_event_id = db.reg_get('active_event_id')
-  if db.event_exists(active_event_id):
-    return db.select_one('events', event_id=active_event_id)
-
-def get_rules(event):
-  if event is None:
-    return None
-  rule_sets = scoring_rules.get_rule_sets()
-  if event['rule_set'] in rule_sets:
-    rules = rule_sets[event['rule_set']]()
-    if event['max_runs'] is not None:
-      rules.max_runs = event['max_runs']
-    if event['drop_runs'] is not None:
-      rules.drop_runs = event['drop_runs']
-    return rules
-  else:
-    return None
+#######################################
 
+def wait_msgs(db):
+  """ Block until a recalc message arrives, then collect any others sent within the debounce window
+
+  Returns the number of messages taken, they all become one recalc cycle.
+  """
+  uwsgi.mule_get_msg() # wait on any msg indicating there is queued recalc work
+  # FIXME consider changing this to uwsgi.signal_wait() so that we can filter on a particular type
+  count = 1
+  debounce_ms = db.reg_get_int('recalc_debounce_ms', scoring_rules.RECALC_DEBOUNCE_MS)
+  if debounce_ms > 0:
+    sleep(debounce_ms / 1000.0)
+  # timeout=0 only takes messages that are already waiting
+  while uwsgi.mule_get_msg(timeout=0) is not None:
+    count += 1
+  return count
 
 #######################################
 
@@ -44,38 +44,33 @@ if __name__ == '__main__':
   logging.warning("start recalc scores mule")
   db = get_db()
 
-  while True:
-    logging.debug("recalc waiting... mule_id=%r", uwsgi.mule_id())
-    uwsgi.mule_get_msg() # wait on any msg indicating we need to recalc something
-    # FIXME consider changing this to uwsgi.signal_wait() so that we can filter on a particular type
-    logging.debug("RECALC")
-
-    run_id = 1 # trigger first iteration
-    while run_id is not None:
-      # find next run to recalc
-      with db:
-        event = get_event(db)
-        run_id = db.query_single("SELECT run_id FROM runs WHERE event_id=? AND recalc", (event['event_id'],))
-        if run_id is not None:
-          # indicate we are processing run
-          db.update('runs', run_id, recalc=2)
-          rules = get_rules(event)
-          rules.recalc_run(db, run_id)
+  # running totals kept in hidden registry keys, shown on the settings page
+  counts = db.reg_get_many({'.recalc_msg_count':(int,0), '.recalc_cycle_count':(int,0), '.recalc_batch_count':(int,0)})
 
-    entry_id = 1 # trigger first iteration
-    while entry_id is not None:
-      # find next entry to recalc
+  msg_count = 0 # drain anything queued while we were not running
+  prune_time = 0
+  while True:
+    item_count = 0
+    batch_count = 0
+    while True:
+      count = scoring_rules.recalc_batch(db)
+      if not count:
+        break
+      item_count += count
+      batch_count += 1
+    logging.debug("RECALC %d msgs, %d batches, %d items", msg_count, batch_count, item_count)
+
+    counts['.recalc_msg_count'] += msg_count
+    counts['.recalc_cycle_count'] += 1
+    counts['.recalc_batch_count'] += batch_count
+    db.reg_set_many(counts)
+
+    if prune_time <= time():
       with db:
-        event = get_event(db)
-        entry_id = db.query_single("SELECT entry_id FROM entries WHERE event_id=? AND recalc", (event['event_id'],))
-        if entry_id is not None:
-          # indicate we are processing entry
-          db.update('entries', entry_id, recalc=2)
-          rules = get_rules(event)
-          rules.recalc_entry(db, entry_id)
-
-
-
-  
-
+        pruned = db.latency_prune()
+      if pruned:
+        logging.debug("RECALC pruned %d latency rows", pruned)
+      prune_time = time() + LATENCY_PRUNE_INTERVAL
 
+    logging.debug("recalc waiting... mule_id=%r", uwsgi.mule_id())
+    msg_count = wait_msgs(db)
@@ -8,6 +8,20 @@ BAUDRATE = 9600
 # TX is tied to piezo speaker, optimal tone byte is 0b11001100
 # serial settings are 9600,N,8,1
 
+CARD_FRAME = re.compile("\x02([0-9a-fA-F]{12})\x03")
+CARD_FRAME_LENGTH = 14
+
+def card_number(frame_hex):
+  """ (version_id, serial_number) of the 12 hex digits of a card frame, None if the checksum does not match """
+  checksum = int(frame_hex[10:12], 16)
+  local_checksum = 0
+  for i in range(0, 10, 2):
+    local_checksum ^= int(frame_hex[i:i+2], 16)
+  if checksum != local_checksum:
+    return None
+  return int(frame_hex[0:2], 16), int(frame_hex[2:10], 16)
+
+
 class RFIDReader(SerialHandler):
   def __init__(self, port=None):
     super(RFIDReader,self).__init__(port, BAUDRATE)
@@ -38,6 +52,22 @@ class RFIDReader(SerialHandler):
       c = self.serial.read(1)
     return None
 
+  @serial_wrapper
+  def read_cards(self):
+    """ Read everything waiting on the port, returns the serial numbers of the complete card frames received """
+    self.read_chunk()
+    cards = []
+    end = 0
+    for match in CARD_FRAME.finditer(str(self.buffer)):
+      card = card_number(match.group(1))
+      if card is not None:
+        self.version_id, self.serial_number = card
+        cards.append(self.serial_number)
+      end = match.end()
+    # keep no more than a partial frame for the next chunk
+    del self.buffer[:max(end, len(self.buffer) - (CARD_FRAME_LENGTH - 1))]
+    return cards
+
   @serial_wrapper
   def send_ack(self):
     self.serial.write('a')
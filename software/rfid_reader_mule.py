@@ -32,8 +32,9 @@ def handle_next_entry(db, data):
     play_sound('sounds/OutputFailure.wav')
     return
 
-  run_group = db.reg_get('run_group')
-  active_event_id = db.reg_get('active_event_id')
+  reg = db.reg_get_many(('run_group', 'active_event_id'))
+  run_group = reg['run_group']
+  active_event_id = reg['active_event_id']
   entry_list = db.query_all("SELECT entry_id, run_group FROM entries WHERE event_id=? AND tracking_number=?", (active_event_id, tracking_number))
   next_entry_id = None
 
@@ -57,13 +58,11 @@ def handle_next_entry(db, data):
     
   if next_entry_id is None:
     logging.warning("No entry for current session found")
-    db.reg_set("next_entry_id", None)
-    db.reg_set("next_entry_msg", "Invalid tracking_number or wrong session!")
+    db.reg_set_many({"next_entry_id":None, "next_entry_msg":"Invalid tracking_number or wrong session!"})
     play_sound('sounds/OutputFailure.wav')
     return False
   else:
-    db.reg_set("next_entry_id", next_entry_id)
-    db.reg_set("next_entry_msg", None)
+    db.reg_set_many({"next_entry_id":next_entry_id, "next_entry_msg":None})
     logging.info("Set next_entry_id, %r", next_entry_id)
     play_sound('sounds/OutputComplete.wav')
     return True
@@ -0,0 +1,25 @@
+-- upgrade a version 6 database to version 7
+-- adds secondary indexes for the timing, scoring and recalc hot paths
+
+-- cars on course for an event, oldest first (start/finish/split matching, run_list by event)
+CREATE INDEX IF NOT EXISTS runs_event_state_idx ON runs (event_id, state, run_id) WHERE NOT deleted;
+
+-- runs for an entry in run order (run_list/run_count by entry, run_number)
+CREATE INDEX IF NOT EXISTS runs_entry_idx ON runs (entry_id, run_id) WHERE NOT deleted;
+
+-- pending recalc flags, only flagged rows are indexed
+CREATE INDEX IF NOT EXISTS runs_recalc_idx ON runs (event_id) WHERE recalc;
+CREATE INDEX IF NOT EXISTS entries_recalc_idx ON entries (event_id) WHERE recalc;
+
+-- entry lists and class lookups for an event
+CREATE INDEX IF NOT EXISTS entries_event_idx ON entries (event_id, car_class);
+
+-- rfid/barcode/check in lookups
+CREATE INDEX IF NOT EXISTS entries_tracking_idx ON entries (tracking_number, event_id);
+
+-- timer data page, newest first
+CREATE INDEX IF NOT EXISTS times_event_idx ON times (event_id, time_id);
+
+-- penalty totals per entry and penalty lists per event
+CREATE INDEX IF NOT EXISTS penalties_entry_idx ON penalties (entry_id) WHERE NOT deleted;
+CREATE INDEX IF NOT EXISTS penalties_event_idx ON penalties (event_id);
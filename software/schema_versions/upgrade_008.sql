@@ -0,0 +1,20 @@
+-- upgrade a version 7 database to version 8
+-- adds standings written by recalc so scoreboards can ORDER BY instead of sorting in python
+
+ALTER TABLE entries ADD COLUMN sort_key INT NOT NULL DEFAULT 10010000001000; -- no runs
+ALTER TABLE entries ADD COLUMN class_position INT;
+ALTER TABLE entries ADD COLUMN overall_position INT;
+
+-- same as util.entry_sort_key
+UPDATE entries SET sort_key = (1000 - event_runs) * 10000000001 + CASE WHEN event_time_ms IS NULL OR event_time_ms = 0 THEN 10000000000 ELSE event_time_ms END;
+
+-- same as ScoringDatabase.entry_positions_update
+UPDATE entries SET
+  class_position = (SELECT COUNT(*) FROM entries AS e WHERE e.event_id = entries.event_id AND e.car_class = entries.car_class AND e.scores_visible AND NOT e.deleted
+      AND (e.sort_key < entries.sort_key OR (e.sort_key = entries.sort_key AND e.entry_id <= entries.entry_id))),
+  overall_position = (SELECT COUNT(*) FROM entries AS e WHERE e.event_id = entries.event_id AND e.scores_visible AND NOT e.deleted
+      AND (e.sort_key < entries.sort_key OR (e.sort_key = entries.sort_key AND e.entry_id <= entries.entry_id)))
+  WHERE scores_visible AND NOT deleted;
+
+-- scoreboards, entries of an event by class in standing order
+CREATE INDEX IF NOT EXISTS entries_sort_idx ON entries (event_id, car_class, sort_key, entry_id) WHERE NOT deleted;
@@ -0,0 +1,27 @@
+-- upgrade a version 8 database to version 9
+-- adds season standings tables, fill them with Rebuild on the season page
+
+CREATE TABLE IF NOT EXISTS season_results (
+  entry_id      INTEGER PRIMARY KEY, -- entries.entry_id
+  event_id      INTEGER NOT NULL,
+  season_name   TEXT NOT NULL,
+  driver_key    TEXT NOT NULL, -- util.driver_key, matches one driver across events
+  car_class     TEXT NOT NULL,
+  first_name    TEXT,
+  last_name     TEXT,
+  points        INT  NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS season_points (
+  season_name   TEXT NOT NULL,
+  driver_key    TEXT NOT NULL,
+  car_class     TEXT NOT NULL,
+  first_name    TEXT, -- from the driver's most recently changed result
+  last_name     TEXT,
+  points        INT  NOT NULL DEFAULT 0,
+  events        INT  NOT NULL DEFAULT 0, -- number of results counted
+  PRIMARY KEY ( season_name, driver_key, car_class )
+);
+
+CREATE INDEX IF NOT EXISTS season_results_event_idx ON season_results (event_id);
+CREATE INDEX IF NOT EXISTS season_points_standings_idx ON season_points (season_name, car_class, points);
@@ -0,0 +1,16 @@
+-- upgrade a version 9 database to version 10
+-- adds the recalc queue, runs and entries still flagged for recalc are queued
+
+CREATE TABLE IF NOT EXISTS recalc_queue (
+  kind          TEXT NOT NULL, -- 'run', 'entry' or 'event'
+  id            INTEGER NOT NULL, -- run_id, entry_id or event_id
+  event_id      INTEGER NOT NULL,
+  priority      INT  NOT NULL DEFAULT 1, -- sql_db.RECALC_LIVE/ADMIN/BULK, lower is recalculated first
+  PRIMARY KEY ( kind, id )
+);
+
+CREATE INDEX IF NOT EXISTS recalc_queue_priority_idx ON recalc_queue (priority);
+CREATE INDEX IF NOT EXISTS recalc_queue_event_idx ON recalc_queue (event_id);
+
+INSERT OR IGNORE INTO recalc_queue (kind, id, event_id) SELECT 'run', run_id, event_id FROM runs WHERE recalc;
+INSERT OR IGNORE INTO recalc_queue (kind, id, event_id) SELECT 'entry', entry_id, event_id FROM entries WHERE recalc;
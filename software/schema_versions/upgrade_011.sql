@@ -0,0 +1,19 @@
+-- upgrade a version 10 database to version 11
+-- adds latency instrumentation of timer impulses
+
+CREATE TABLE IF NOT EXISTS latency (
+  time_id         INTEGER PRIMARY KEY, -- times.time_id of the impulse
+  event_id        INTEGER,
+  channel         TEXT,
+  run_id          INTEGER, -- run started or finished by the impulse
+  receive_ms      INT, -- line received from the serial port
+  insert_ms       INT, -- times row inserted
+  match_ms        INT, -- run started or finished
+  recalc_start_ms INT, -- recalc batch holding the run started
+  recalc_end_ms   INT, -- recalc batch holding the run done
+  render_ms       INT  -- first scoreboard render after the recalc
+);
+
+-- latency rows waiting on a recalc or a scoreboard render
+CREATE INDEX IF NOT EXISTS latency_recalc_idx ON latency (run_id) WHERE recalc_end_ms IS NULL;
+CREATE INDEX IF NOT EXISTS latency_render_idx ON latency (event_id) WHERE render_ms IS NULL AND recalc_end_ms NOT NULL;
@@ -9,11 +9,12 @@ logging.basicConfig(level=logging.DEBUG) # initialize this early so we get all o
 from flask import *
 from os import urandom
 from util import *
-from sql_db import ScoringDatabase
+from sql_db import ScoringDatabase, ConnectionPool
 from time import time
 import datetime
 import markdown
 import scoring_rules
+from scoring_rules import get_event, get_rules
 
 #######################################
 
@@ -50,39 +51,32 @@ app.jinja_env.lstrip_blocks=True
 
 #######################################
 
+# database connections reused between requests in each worker
+db_pool = ConnectionPool(config.SCORING_DB_PATH)
+
 # per appcontext database session
 def get_db():
   db = getattr(g, '_database', None)
   if db is None:
-    logging.debug(config.SCORING_DB_PATH)
-    db = g._database = ScoringDatabase(config.SCORING_DB_PATH)
+    db = g._database = db_pool.acquire()
   return db
 
 @app.teardown_appcontext
 def close_db(exception):
   db = getattr(g, '_database', None)
   if db is not None:
-    db.close()
-
-def get_event(db):
-  active_event_id = db.reg_get('active_event_id')
-  if db.event_exists(active_event_id):
-    return db.select_one('events', event_id=active_event_id)
-
-
-def get_rules(event):
-  if event is None:
-    return None
-  rule_sets = scoring_rules.get_rule_sets()
-  if event['rule_set'] in rule_sets:
-    rules = rule_sets[event['rule_set']]()
-    if event['max_runs'] is not None:
-      rules.max_runs = event['max_runs']
-    if event['drop_runs'] is not None:
-      rules.drop_runs = event['drop_runs']
-    return rules
-  else:
-    return None
+    db_pool.release(db)
+
+#######################################
+
+LATENCY_RENDER_INTERVAL = 1 # seconds, renders are recorded in the latency table at most this often per worker
+latency_render_time = {} # event_id -> time of the last render recorded by this worker
+
+def latency_render(db, event_id):
+  # every scoreboard page refreshes, throttled so the pages rarely take the write lock
+  if latency_render_time.get(event_id, 0) + LATENCY_RENDER_INTERVAL <= time():
+    latency_render_time[event_id] = time()
+    db.latency_render(event_id)
 
 #######################################
 
@@ -98,23 +92,21 @@ def index_page():
   g.auto_refresh = request.args.get('auto_refresh')
 
   g.class_entry_list = {}
-  g.entry_list = db.entry_list(g.event['event_id'])
+  g.entry_list = db.entry_list(g.event['event_id'], sort=True) # already in standing order from recalc
   for entry in g.entry_list:
     if entry['car_class'] not in g.class_entry_list:
       g.class_entry_list[entry['car_class']] = []
     if entry['scores_visible']:
       g.class_entry_list[entry['car_class']].append(entry)
 
-  # sort each car class by event_time_ms and run_count
-  for car_class in g.class_entry_list:
-    g.class_entry_list[car_class].sort(cmp=entry_cmp)
-
   g.entry_run_list = {}
   for entry in g.entry_list:
     # FIXME TODO add other run states so we can show pending runs in scores
     g.entry_run_list[entry['entry_id']] = db.run_list(entry_id=entry['entry_id'], state=('scored','started','finished'), limit=g.rules.max_runs)
   
-  return render_template('scoreboard_index.html')
+  html = render_template('scoreboard_index.html')
+  latency_render(db, g.event['event_id'])
+  return html
 
 #######################################
 
@@ -130,23 +122,21 @@ def final_page():
   g.auto_refresh = request.args.get('auto_refresh')
 
   g.class_entry_list = {}
-  g.entry_list = db.entry_list(g.event['event_id'])
+  g.entry_list = db.entry_list(g.event['event_id'], sort=True) # already in standing order from recalc
   for entry in g.entry_list:
     if entry['car_class'] not in g.class_entry_list:
       g.class_entry_list[entry['car_class']] = []
     if entry['scores_visible']:
       g.class_entry_list[entry['car_class']].append(entry)
 
-  # sort each car class by event_time_ms and run_count
-  for car_class in g.class_entry_list:
-    g.class_entry_list[car_class].sort(cmp=entry_cmp)
-
   g.entry_run_list = {}
   for entry in g.entry_list:
     # FIXME TODO add other run states so we can show pending runs in scores
     g.entry_run_list[entry['entry_id']] = db.run_list(entry_id=entry['entry_id'], state=('scored','started','finished'), limit=g.rules.max_runs)
   
-  return render_template('scoreboard_final.html')
+  html = render_template('scoreboard_final.html')
+  latency_render(db, g.event['event_id'])
+  return html
 
 #######################################
 
@@ -154,7 +144,7 @@ def final_page():
 def finish_page():
   db = get_db()
   g.event = get_event(db)
-  g.rules = get_rules(event)
+  g.rules = get_rules(g.event)
   
   if g.event is None:
     return "No active event."
@@ -167,14 +157,16 @@ def finish_page():
 
   g.latest_runs = db.run_list(event_id=g.event['event_id'], state="scored", limit=10, sort='D')
 
-  return render_template('scoreboard_finish.html')
+  html = render_template('scoreboard_finish.html')
+  latency_render(db, g.event['event_id'])
+  return html
 
 
 @app.route('/sectors')
 def sectors_page():
   db = get_db()
   g.event = get_event(db)
-  g.rules = get_rules(event)
+  g.rules = get_rules(g.event)
   
   if g.event is None:
     return "No active event."
@@ -186,7 +178,7 @@ def sectors_page():
 def penalties_page():
   db = get_db()
   g.event = get_event(db)
-  g.rules = get_rules(event)
+  g.rules = get_rules(g.event)
   
   if g.event is None:
     return "No active event."
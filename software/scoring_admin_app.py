@@ -9,13 +9,17 @@ logging.basicConfig(level=logging.DEBUG) # initialize this early so we get all o
 from flask import *
 from os import urandom
 from util import *
-from sql_db import ScoringDatabase
+from sql_db import ScoringDatabase, ConnectionPool
 import scoring_rules
+from scoring_rules import get_event, get_rules
+from tag_heuer_520 import DEADTIME_DEFAULTS
 from time import time, sleep
 import datetime
 import csv
+import json
 from cStringIO import StringIO
 from serial.tools.list_ports import comports
+from serial_handler import notify_port_change
 from glob import glob
 import markdown
 
@@ -24,6 +28,7 @@ import uwsgi
 
 import uuid
 import random
+import bisect
 
 #######################################
 # message flash categories
@@ -47,11 +52,7 @@ except ImportError:
 # make sure database is initialized and ready to go
 init_db = ScoringDatabase(config.SCORING_DB_PATH)
 # lets set some default state
-init_db.reg_set('disable_start', 0)
-init_db.reg_set('disable_finish', 0)
-init_db.reg_set('run_group', 1)
-init_db.reg_set('next_entry_id', None)
-init_db.reg_set('next_entry_msg', None)
+init_db.reg_set_many({'disable_start':0, 'disable_finish':0, 'run_group':1, 'next_entry_id':None, 'next_entry_msg':None})
 init_db.close()
 del init_db
 
@@ -76,11 +77,14 @@ app.jinja_env.lstrip_blocks=True
 #######################################
 
 
+# database connections reused between requests in each worker
+db_pool = ConnectionPool(config.SCORING_DB_PATH)
+
 # per appcontext database session
 def get_db():
   db = getattr(g, '_database', None)
   if db is None:
-    db = g._database = ScoringDatabase(config.SCORING_DB_PATH)
+    db = g._database = db_pool.acquire()
   return db
 
 
@@ -88,28 +92,19 @@ def get_db():
 def close_db(exception):
   db = getattr(g, '_database', None)
   if db is not None:
-    db.close()
-
-
-def get_event(db):
-  active_event_id = db.reg_get('active_event_id')
-  if db.event_exists(active_event_id):
-    return db.select_one('events', event_id=active_event_id)
-
-
-def get_rules(event):
-  if event is None:
-    return None
-  rule_sets = scoring_rules.get_rule_sets()
-  if event['rule_set'] in rule_sets:
-    rules = rule_sets[event['rule_set']]()
-    if event['max_runs'] is not None:
-      rules.max_runs = event['max_runs']
-    if event['drop_runs'] is not None:
-      rules.drop_runs = event['drop_runs']
-    return rules
-  else:
-    return None
+    db_pool.release(db)
+
+
+# the recalc mule is notified once per request however many recalcs a handler queues
+def request_recalc():
+  g.recalc_requested = True
+
+
+@app.teardown_request
+def notify_recalc(exception):
+  # queued recalcs are already committed, notify even if the request failed later on
+  if getattr(g, 'recalc_requested', False):
+    uwsgi.mule_msg('recalc')
 
 
 #def new_access_code(db):
@@ -213,12 +208,10 @@ def start_control_page():
   action = request.form.get('action')
   if action == 'set':
     if request.form.get('entry_id'):
-      db.reg_set('next_entry_id',request.form.get('entry_id'))
-      db.reg_set('next_entry_msg', None)
+      db.reg_set_many({'next_entry_id':request.form.get('entry_id'), 'next_entry_msg':None})
     return redirect(url_for('start_control_page'))
   elif action == 'clear':
-    db.reg_set('next_entry_id', None)
-    db.reg_set('next_entry_msg', None)
+    db.reg_set_many({'next_entry_id':None, 'next_entry_msg':None})
     return redirect(url_for('start_control_page'))
   elif action == 'scan':
     try:
@@ -228,8 +221,9 @@ def start_control_page():
       play_sound('sounds/OutputFailure.wav')
       return redirect(url_for('start_control_page'))
 
-    run_group = db.reg_get('run_group')
-    active_event_id = db.reg_get('active_event_id')
+    reg = db.reg_get_many(('run_group', 'active_event_id'))
+    run_group = reg['run_group']
+    active_event_id = reg['active_event_id']
     entry_list = db.query_all("SELECT entry_id, run_group FROM entries WHERE event_id=? AND tracking_number=?", (active_event_id, tracking_number))
     next_entry_id = None
 
@@ -253,12 +247,10 @@ def start_control_page():
       
     if next_entry_id is None:
       logging.warning("No entry for current session found")
-      db.reg_set("next_entry_id", None)
-      db.reg_set("next_entry_msg", "Invalid tracking_number or wrong session!")
+      db.reg_set_many({'next_entry_id':None, 'next_entry_msg':"Invalid tracking_number or wrong session!"})
       play_sound('sounds/OutputFailure.wav')
     else:
-      db.reg_set("next_entry_id", next_entry_id)
-      db.reg_set("next_entry_msg", None)
+      db.reg_set_many({'next_entry_id':next_entry_id, 'next_entry_msg':None})
       logging.info("Set next_entry_id, %r", next_entry_id)
       play_sound('sounds/OutputComplete.wav')
     return redirect(url_for('start_control_page'))
@@ -273,7 +265,8 @@ def start_control_page():
 
   g.entry_list.sort(key=lambda x: x['run_count'])
 
-  g.next_entry_id = db.reg_get_int('next_entry_id')
+  reg = db.reg_get_many({'next_entry_id':int, 'run_group':None, 'next_entry_msg':None})
+  g.next_entry_id = reg['next_entry_id']
   g.next_entry = db.select_one('entries', entry_id=g.next_entry_id)
   if g.next_entry_id is None:
     g.next_entry_run_number = None
@@ -281,8 +274,8 @@ def start_control_page():
     # FIXME change this to max of run_number instead of count
     g.next_entry_run_number = 1 + db.run_count(entry_id=g.next_entry_id, state=('started','finished','scored'))
 
-  g.run_group = db.reg_get('run_group')
-  g.next_entry_msg = db.reg_get('next_entry_msg')
+  g.run_group = reg['run_group']
+  g.next_entry_msg = reg['next_entry_msg']
 
   return render_template('admin_start_control.html')
   
@@ -302,7 +295,8 @@ def start_next_entry_page():
     flash("Invalid rule set for active event!", F_ERROR)
     return redirect(url_for('events_page'))
 
-  g.next_entry_id = db.reg_get_int('next_entry_id')
+  reg = db.reg_get_many({'next_entry_id':int, 'run_group':None, 'next_entry_msg':None})
+  g.next_entry_id = reg['next_entry_id']
   g.next_entry = db.select_one('entries', entry_id=g.next_entry_id)
   if g.next_entry_id is None:
     g.next_entry_run_number = None
@@ -310,8 +304,8 @@ def start_next_entry_page():
     # FIXME change this to max of run_number instead of count
     g.next_entry_run_number = 1 + db.run_count(entry_id=g.next_entry_id, state=('started','finished','scored'))
 
-  g.run_group = db.reg_get('run_group')
-  g.next_entry_msg = db.reg_get('next_entry_msg')
+  g.run_group = reg['run_group']
+  g.next_entry_msg = reg['next_entry_msg']
 
   return render_template('admin_start_next_entry.html')
 
@@ -350,6 +344,8 @@ def events_page():
         event_data[key] = request.form.get(key)
     db.update('events', event_id, **event_data)
     flash("Event changes saved")
+    # season_name or rule set changes move season points
+    scoring_rules.season_update(db, event_id)
     return redirect(url_for('events_page'))
 
   elif action == 'insert':
@@ -371,6 +367,7 @@ def events_page():
           db.reg_set('active_event_id',None)
         db.update("events", event_id, deleted=1)
         # FIXME do we need to propagate this to runs and entries?
+        scoring_rules.season_update(db, event_id)
         flash("Event deleted")
       else:
         flash("Invalid event_id for delete operation.", F_ERROR)
@@ -385,7 +382,7 @@ def events_page():
       return redirect(url_for('events_page'))
     # flag all entries for this event to be recalculated
     db.set_event_recalc(event_id)
-    uwsgi.mule_msg('recalc')
+    request_recalc()
     flash("Event scores recalculating")
     return redirect(url_for('events_page'))
 
@@ -457,13 +454,11 @@ def timing_page():
 
   elif action == 'set_next':
     if request.form.get('next'):
-      db.reg_set('next_entry_id',request.form.get('next'))
-      db.reg_set('next_entry_msg', None)
+      db.reg_set_many({'next_entry_id':request.form.get('next'), 'next_entry_msg':None})
     return redirect(url_for('timing_page'))
 
   elif action == 'clear_next':
-    db.reg_set('next_entry_id', None)
-    db.reg_set('next_entry_msg', None)
+    db.reg_set_many({'next_entry_id':None, 'next_entry_msg':None})
     return redirect(url_for('timing_page'))
 
   elif action == 'set_filter':
@@ -502,7 +497,7 @@ def timing_page():
       # make sure we recalculate all entries event totals based on new max runs
       # this is mainly needed with drop runs > 0
       db.set_event_recalc(g.event['event_id'])
-      uwsgi.mule_msg('recalc')
+      request_recalc()
       flash("Event scores recalculating")
     return redirect(url_for('timing_page'))
 
@@ -559,23 +554,28 @@ def timing_page():
       flash("Setting state to 'finished'", F_WARN)
       run_data['state'] = 'finished'
 
-    db.update('runs', run_id, **run_data)
-    flash("Run changes saved")
-
-    old_entry_id = request.form.get('old_entry_id')
-    if old_entry_id != request.form.get('entry_id') and old_entry_id != 'None':
-      db.set_entry_recalc(old_entry_id)
-      uwsgi.mule_msg('recalc')
-      flash("Old entry recalc")
-
-    db.set_run_recalc(run_id)
-    uwsgi.mule_msg('recalc')
-    flash("Run recalc")
-
-    if 'entry_id' in run_data and run_data['entry_id'] is not None:
-      db.set_entry_recalc(run_data['entry_id'])
-      uwsgi.mule_msg('recalc')
-      flash("Entry recalc")
+    # one transaction so the recalc mule never sees the run moved before the old entry is renumbered
+    with db:
+      db.update('runs', run_id, **run_data)
+      db.course_changed()
+      flash("Run changes saved")
+
+      old_entry_id = request.form.get('old_entry_id')
+      if old_entry_id != request.form.get('entry_id') and old_entry_id != 'None':
+        # later runs of the old entry move down one run number
+        db.run_renumber(old_entry_id, parse_int(run_id))
+        db.set_entry_recalc(old_entry_id)
+        old_car_class = db.query_single("SELECT car_class FROM entries WHERE entry_id=?", (old_entry_id,))
+        g.rules.set_dependent_recalc(db, g.event['event_id'], old_car_class)
+        flash("Old entry recalc")
+
+      db.set_run_recalc(run_id)
+      flash("Run recalc")
+
+      if 'entry_id' in run_data and run_data['entry_id'] is not None:
+        db.set_entry_recalc(run_data['entry_id'])
+        flash("Entry recalc")
+    request_recalc()
 
     return redirect(url_for('timing_page'))
 
@@ -586,9 +586,11 @@ def timing_page():
         continue # ignore
       elif key in request.form:
         run_data[key] = clean_str(request.form.get(key))
-    run_id = db.insert('runs', **run_data)
-    db.set_run_recalc(run_id)
-    uwsgi.mule_msg('recalc')
+    with db:
+      run_id = db.insert('runs', **run_data)
+      db.course_changed()
+      db.set_run_recalc(run_id)
+    request_recalc()
     flash("Added new run [%r]" % run_id)
     return redirect(url_for('timing_page'))
 
@@ -627,10 +629,21 @@ def timing_page():
   g.cars_started = db.run_count(event_id=g.event['event_id'], state='started')
   g.cars_finished = db.run_count(event_id=g.event['event_id'], state='finished')
   
-  g.disable_start = db.reg_get_int('disable_start', 0)
-  g.disable_finish = db.reg_get_int('disable_finish', 0)
+  reg = db.reg_get_many({
+      'disable_start':(int,0),
+      'disable_finish':(int,0),
+      'next_entry_id':int,
+      'barcode_scanner_status':None,
+      'tag_heuer_status':None,
+      'rfid_reader_status':None,
+      'run_group':None,
+      'next_entry_msg':None,
+      })
+
+  g.disable_start = reg['disable_start']
+  g.disable_finish = reg['disable_finish']
   
-  g.next_entry_id = db.reg_get_int('next_entry_id')
+  g.next_entry_id = reg['next_entry_id']
   g.next_entry = db.select_one('entries', entry_id=g.next_entry_id)
   if g.next_entry_id is None:
     g.next_entry_run_number = None
@@ -638,17 +651,17 @@ def timing_page():
     # FIXME change this to max of run_number instead of count
     g.next_entry_run_number = 1 + db.run_count(entry_id=g.next_entry_id, state=('started','finished','scored'))
   
-  g.barcode_scanner_status = db.reg_get('barcode_scanner_status')
-  g.tag_heuer_status = db.reg_get('tag_heuer_status')
-  g.rfid_reader_status = db.reg_get('rfid_reader_status')
+  g.barcode_scanner_status = reg['barcode_scanner_status']
+  g.tag_heuer_status = reg['tag_heuer_status']
+  g.rfid_reader_status = reg['rfid_reader_status']
 
   # FIXME change how watchdog is handled
   g.hardware_ok = True
   g.start_ready = g.hardware_ok and (g.tag_heuer_status == 'Open') and not g.disable_start
   g.finish_ready = g.hardware_ok and (g.tag_heuer_status == 'Open') and not g.disable_finish
 
-  g.run_group = db.reg_get('run_group')
-  g.next_entry_msg = db.reg_get('next_entry_msg')
+  g.run_group = reg['run_group']
+  g.next_entry_msg = reg['next_entry_msg']
 
   # create car description strings for entries
   g.car_dict = {}
@@ -676,6 +689,13 @@ def timer_data_page():
   g.timer_data_count = db.reg_get_int('timer_data_count', 100)
   g.time_list = db.query_all("SELECT * FROM times WHERE event_id=? ORDER BY time_id DESC LIMIT ?", (g.event['event_id'], g.timer_data_count))
 
+  # impulses dropped by the timing mule's dead time filter, see tag_heuer_520.DeadTimeFilter
+  keys = dict(('.suppressed_%s' % kind, (int, 0)) for kind in DEADTIME_DEFAULTS)
+  keys['.suppressed_recent'] = None
+  reg = db.reg_get_many(keys, event_id=g.event['event_id'])
+  g.suppressed_counts = dict((kind, reg['.suppressed_%s' % kind]) for kind in DEADTIME_DEFAULTS)
+  g.suppressed_recent = list(reversed(json.loads(reg['.suppressed_recent'] or '[]')))
+
   return render_template('admin_timer_data.html')
 
 #######################################
@@ -805,9 +825,16 @@ def entries_page():
     if request.form.get('confirm_delete') == 'do_it':
       entry_id = request.form.get('entry_id')
       if db.entry_exists(entry_id):
+        old_entry = db.select_one('entries', entry_id=entry_id)
         db.update('entries', entry_id, deleted=1)
         # FIXME add propagation of deletes to runs?
         flash("Entry deleted")
+        # the entry's runs no longer count towards its class
+        if g.rules.set_dependent_recalc(db, g.event['event_id'], old_entry['car_class']):
+          request_recalc()
+          flash("Class recalc")
+        db.entry_positions_update(g.event['event_id'])
+        scoring_rules.season_update(db, g.event['event_id'])
       else:
         flash("Invalid entry_id for delete operation.", F_ERROR)
     else:
@@ -829,8 +856,20 @@ def entries_page():
     if 'tracking_number' in entry_data and entry_data['tracking_number'] is not None:
       entry_data['tracking_number'] = entry_data['tracking_number'].lstrip('0')
       flash("tracking_number = %r" % entry_data['tracking_number'])
+    old_entry = db.select_one('entries', entry_id=entry_id)
     db.update('entries', entry_id, **entry_data)
     flash("Entry changes saved")
+    # class or scores_visible changes move positions
+    db.entry_positions_update(g.event['event_id'])
+    # names, class and season_points changes move season points
+    scoring_rules.season_update(db, g.event['event_id'])
+    if 'car_class' in entry_data and entry_data['car_class'] != old_entry['car_class'] and g.rules.entry_dependencies:
+      # the entry's runs move from one class to another
+      db.set_entry_recalc(entry_id)
+      g.rules.set_dependent_recalc(db, g.event['event_id'], old_entry['car_class'])
+      g.rules.set_dependent_recalc(db, g.event['event_id'], entry_data['car_class'])
+      request_recalc()
+      flash("Class recalc")
     return redirect(url_for('entries_page'))
 
   elif action == 'check_in':
@@ -912,7 +951,7 @@ def penalties_page():
     flash("Penalty added")
 
     db.set_entry_recalc(entry_id)
-    uwsgi.mule_msg('recalc')
+    request_recalc()
     flash("Entry recalculating")
 
     return redirect(url_for('penalties_page'))
@@ -948,11 +987,11 @@ def penalties_page():
       # update previous entry
       flash("old entry recalc, %r != %r" % (old_penalty['entry_id'],entry_id))
       db.set_entry_recalc(old_penalty['entry_id'])
-      uwsgi.mule_msg('recalc')
+      request_recalc()
 
     # update current entry
     db.set_entry_recalc(entry_id)
-    uwsgi.mule_msg('recalc')
+    request_recalc()
     flash("entry recalc")
 
     return redirect(url_for('penalties_page'))
@@ -971,7 +1010,7 @@ def penalties_page():
     # update previous entry
     flash("old entry recalc")
     db.set_entry_recalc(old_penalty['entry_id'])
-    uwsgi.mule_msg('recalc')
+    request_recalc()
 
     return redirect(url_for('penalties_page'))
 
@@ -1006,12 +1045,15 @@ def run_groups_page():
   # FIXME change sessions to run_groups
 
   if action == 'update':
-    for car_class in g.rules.car_class_list:
-      class_run_group = request.form.get("%s_run_group" % car_class)
-      if class_run_group not in ('1','2','3','4','-1'):
-        class_run_group = '-1'
-      db.reg_set("%s_run_group" % car_class, class_run_group)
-      db.entry_run_group_update(g.event['event_id'], car_class, class_run_group)
+    class_run_groups = {}
+    with db:
+      for car_class in g.rules.car_class_list:
+        class_run_group = request.form.get("%s_run_group" % car_class)
+        if class_run_group not in ('1','2','3','4','-1'):
+          class_run_group = '-1'
+        class_run_groups["%s_run_group" % car_class] = class_run_group
+        db.entry_run_group_update(g.event['event_id'], car_class, class_run_group)
+      db.reg_set_many(class_run_groups)
 
     flash("Class run groups updated")
     return redirect(url_for('run_groups_page'))
@@ -1028,11 +1070,12 @@ def run_groups_page():
     flash("Unkown form action %r" % action, F_ERROR)
     return redirect(url_for('run_groups_page'))
 
+  reg = db.reg_get_many(["%s_run_group" % car_class for car_class in g.rules.car_class_list] + ['run_group'])
   g.class_run_groups = {}
   for car_class in g.rules.car_class_list:
-    g.class_run_groups[car_class] = parse_int(db.reg_get("%s_run_group" % car_class), -1)
+    g.class_run_groups[car_class] = parse_int(reg["%s_run_group" % car_class], -1)
 
-  g.run_group = parse_int(db.reg_get('run_group'), 1)
+  g.run_group = parse_int(reg['run_group'], 1)
 
   return render_template('admin_run_groups.html')
 
@@ -1043,25 +1086,36 @@ def run_groups_page():
 def settings_page():
   db = get_db()
 
+  serial_port_keys = ('serial_port_rfid_reader', 'serial_port_tag_heuer', 'serial_port_barcode')
+
   if request.form.get('action') == 'update':
-    port = request.form.get('serial_port_rfid_reader')
-    if port in ('', 'None'):
-      port = None
-    db.reg_set('serial_port_rfid_reader', port)
-    port = request.form.get('serial_port_tag_heuer')
-    if port in ('', 'None'):
-      port = None
-    db.reg_set('serial_port_tag_heuer', port)
-    port = request.form.get('serial_port_barcode')
-    if port in ('', 'None'):
-      port = None
-    db.reg_set('serial_port_barcode', port)
+    ports = {}
+    for key in serial_port_keys:
+      port = request.form.get(key)
+      if port in ('', 'None'):
+        port = None
+      ports[key] = port
+    db.reg_set_many(ports)
+    db.reg_set('recalc_debounce_ms', parse_int(request.form.get('recalc_debounce_ms'), scoring_rules.RECALC_DEBOUNCE_MS))
+    deadtime = {}
+    for kind in DEADTIME_DEFAULTS:
+      try:
+        deadtime['deadtime_%s' % kind] = max(float(request.form.get('deadtime_%s' % kind)), 0)
+      except (TypeError, ValueError):
+        flash("Invalid %s dead time, not changed" % kind.replace('_', ' '), F_ERROR)
+    db.reg_set_many(deadtime)
+    notify_port_change()
     flash("Settings updated")
     return redirect(url_for('settings_page'))
 
-  g.serial_port_rfid_reader = db.reg_get('serial_port_rfid_reader')
-  g.serial_port_tag_heuer = db.reg_get('serial_port_tag_heuer')
-  g.serial_port_barcode = db.reg_get('serial_port_barcode')
+  reg = db.reg_get_many(serial_port_keys)
+  g.serial_port_rfid_reader = reg['serial_port_rfid_reader']
+  g.serial_port_tag_heuer = reg['serial_port_tag_heuer']
+  g.serial_port_barcode = reg['serial_port_barcode']
+
+  g.recalc_debounce_ms = db.reg_get_int('recalc_debounce_ms', scoring_rules.RECALC_DEBOUNCE_MS)
+  g.recalc_counts = db.reg_get_many({'.recalc_msg_count':(int,0), '.recalc_cycle_count':(int,0), '.recalc_batch_count':(int,0)})
+  g.deadtime = db.reg_get_many(dict(('deadtime_%s' % kind, (float, seconds)) for kind, seconds in DEADTIME_DEFAULTS.items()))
 
   g.serial_list = glob("/dev/ttyUSB*") + glob("/dev/ttyACM*") + glob("/dev/serial/by-id/*")
 
@@ -1087,7 +1141,7 @@ def scores_page():
 
   if action == 'event_recalc':
     db.set_event_recalc(g.event['event_id'])
-    uwsgi.mule_msg('recalc')
+    request_recalc()
     flash("Event scores recalculating")
     return redirect(url_for('scores_page'))
 
@@ -1097,7 +1151,7 @@ def scores_page():
       flash("Invalid entry id", F_ERROR)
       return redirect(url_for('entries_page'))
     db.set_entry_recalc(entry_id)
-    uwsgi.mule_msg('recalc')
+    request_recalc()
     flash("Entry score recalculating")
     return redirect(url_for('scores_page'))
 
@@ -1106,9 +1160,11 @@ def scores_page():
       run_count = db.run_count(entry_id=entry_id, state=('started','finished','scored'))
       for i in range(g.rules.max_runs - run_count):
         flash("Add DNS [%s, %r]" % (entry_id,i))
-        run_id = db.insert('runs', event_id=g.event['event_id'], entry_id=entry_id, recalc=1, dns_dnf=1, state='scored')
+        run_id = db.insert('runs', event_id=g.event['event_id'], entry_id=entry_id, dns_dnf=1, state='scored')
+        db.set_run_recalc(run_id)
         flash("Added new run [%r]" % run_id)
-      uwsgi.mule_msg('recalc')
+      db.set_entry_recalc(entry_id)
+      request_recalc()
 
     return redirect(url_for('scores_page'))
 
@@ -1121,17 +1177,13 @@ def scores_page():
 
   # sort entries into car class
   g.class_entry_list = {}
-  g.entry_list = db.entry_list(g.event['event_id'])
+  g.entry_list = db.entry_list(g.event['event_id'], sort=True) # already in standing order from recalc
   for entry in g.entry_list:
     if entry['car_class'] not in g.class_entry_list:
       g.class_entry_list[entry['car_class']] = []
     if entry['scores_visible']:
       g.class_entry_list[entry['car_class']].append(entry)
 
-  # sort each car class by event_time_ms and run_count
-  for car_class in g.class_entry_list:
-    g.class_entry_list[car_class].sort(cmp=entry_cmp)
-
   g.entry_run_list = {}
   for entry in g.entry_list:
     g.entry_run_list[entry['entry_id']] = db.run_list(entry_id=entry['entry_id'], state=('scored','finished','started'), limit=g.rules.max_runs)
@@ -1140,6 +1192,51 @@ def scores_page():
 
 #######################################
 
+def whatif_scores(db):
+  # shared by the what-if page and json api, request args rule_set, max_runs and drop_runs default to the event
+  rule_set = request.args.get('rule_set') or None
+  max_runs = parse_int(request.args.get('max_runs'))
+  drop_runs = parse_int(request.args.get('drop_runs'))
+  return scoring_rules.whatif_event(db, g.event, rule_set, max_runs, drop_runs)
+
+
+@app.route('/scores/whatif')
+def whatif_page():
+  db = get_db()
+  g.event = get_event(db)
+  g.rules = get_rules(g.event)
+
+  if g.event is None:
+    flash("No active event!", F_ERROR)
+    return redirect(url_for('events_page'))
+
+  try:
+    g.whatif_rules, g.entry_list = whatif_scores(db)
+  except KeyError:
+    flash("Invalid rule set %r" % request.args.get('rule_set'), F_ERROR)
+    return redirect(url_for('whatif_page'))
+
+  g.rule_sets = scoring_rules.get_rule_sets()
+  return render_template('admin_whatif.html')
+
+
+@app.route('/scores/whatif/json')
+def whatif_json_page():
+  db = get_db()
+  g.event = get_event(db)
+
+  if g.event is None:
+    return jsonify(error="No active event"), 404
+
+  try:
+    whatif_rules, entry_list = whatif_scores(db)
+  except KeyError:
+    return jsonify(error="Invalid rule set %r" % request.args.get('rule_set')), 400
+
+  return jsonify(event_id=g.event['event_id'], rule_set=type(whatif_rules).__name__, max_runs=whatif_rules.max_runs, drop_runs=whatif_rules.drop_runs, entries=entry_list)
+
+#######################################
+
 @app.route('/import', methods=['GET','POST'])
 def import_page():
   db = get_db()
@@ -1260,17 +1357,13 @@ def export_scores_csv_page():
   
   # sort entries into car class
   g.class_entry_list = {}
-  g.entry_list = db.entry_list(g.event['event_id'])
+  g.entry_list = db.entry_list(g.event['event_id'], sort=True) # already in standing order from recalc
   for entry in g.entry_list:
     if entry['car_class'] not in g.class_entry_list:
       g.class_entry_list[entry['car_class']] = []
     if entry['scores_visible']:
       g.class_entry_list[entry['car_class']].append(entry)
 
-  # sort each car class by event_time_ms and run_count
-  for car_class in g.class_entry_list:
-    g.class_entry_list[car_class].sort(cmp=entry_cmp)
-
   g.entry_run_list = {}
   for entry in g.entry_list:
     g.entry_run_list[entry['entry_id']] = db.run_list(entry_id=entry['entry_id'], state=('scored',), limit=g.rules.max_runs)
@@ -1343,6 +1436,68 @@ def export_scores_csv_page():
   return response
 
 
+#######################################
+
+def season_class_standings(db, season_name):
+  # season_points rows grouped by class as [(car_class, [row, ...]), ...] in the active event's class order, rows get a position
+  rules = get_rules(get_event(db))
+  class_order = dict((car_class, i) for i, car_class in enumerate(rules.car_class_list if rules else []))
+  class_standings = []
+  for row in db.season_standings(season_name):
+    if not class_standings or class_standings[-1][0] != row['car_class']:
+      class_standings.append((row['car_class'], []))
+    row['position'] = len(class_standings[-1][1]) + 1
+    class_standings[-1][1].append(row)
+  class_standings.sort(key=lambda item: (class_order.get(item[0], len(class_order)), item[0]))
+  return class_standings
+
+
+@app.route('/season', methods=['GET','POST'])
+def season_page():
+  db = get_db()
+  g.event = get_event(db)
+  g.season_list = db.season_names()
+  g.season_name = request.values.get('season_name') or (g.event['season_name'] if g.event and g.event['season_name'] else None)
+  if g.season_name is None and g.season_list:
+    g.season_name = g.season_list[0]
+
+  action = request.form.get('action')
+
+  if action == 'rebuild':
+    event_count = scoring_rules.season_rebuild(db, g.season_name)
+    flash("Season points rebuilt from %d events" % event_count)
+    return redirect(url_for('season_page', season_name=g.season_name))
+
+  elif action is not None:
+    flash("Invalid form action %r" % action, F_ERROR)
+    return redirect(url_for('season_page', season_name=g.season_name))
+
+  g.class_standings = season_class_standings(db, g.season_name)
+  return render_template('admin_season.html')
+
+
+@app.route('/season/csv')
+def export_season_csv_page():
+  db = get_db()
+  season_name = request.args.get('season_name')
+  if not season_name:
+    flash("No season selected!", F_ERROR)
+    return redirect(url_for('season_page'))
+
+  output = StringIO()
+  writer = csv.writer(output)
+  writer.writerow(['car_class', 'position', 'first_name', 'last_name', 'events', 'points'])
+  for car_class, standings in season_class_standings(db, season_name):
+    for row in standings:
+      writer.writerow([car_class, row['position'], row['first_name'], row['last_name'], row['events'], row['points']])
+
+  response = make_response(output.getvalue(), 200)
+  response.headers['Content-Disposition'] = 'attachment; filename="%s_season.csv"' % season_name
+  response.mimetype = 'text/csv'
+
+  return response
+
+
 #######################################
 
 
@@ -1350,20 +1505,19 @@ def export_scores_csv_page():
 def debug_registry_page():
   db = get_db()
   if request.method == 'POST' and request.form.get('action') == 'update':
-    for key in request.form:
-      if key != 'action':
-        db.reg_set(key, clean_str(request.form[key]))
+    db.reg_set_many(dict((key, clean_str(request.form[key])) for key in request.form if key != 'action'))
+    notify_port_change()
     return redirect(url_for("debug_registry_page"))
   elif request.method == 'GET' and request.args.get('action') == 'update':
-    for key in request.args:
-      if key != 'action':
-        db.reg_set(key, clean_str(request.args[key]))
+    db.reg_set_many(dict((key, clean_str(request.args[key])) for key in request.args if key != 'action'))
+    notify_port_change()
     return redirect(url_for("debug_registry_page"))
   elif request.method == 'POST' and request.form.get('action') == 'insert':
     key = clean_str(request.form.get('reg_name'))
     value = clean_str(request.form.get('reg_value'))
     if key is not None:
       db.reg_set(key, value)
+      notify_port_change()
       logging.debug("insert reg, %r = %r", key, value)
 
   reg_list = db.reg_list(request.args.get('all',False))
@@ -1374,6 +1528,50 @@ def debug_registry_page():
 
 #######################################
 
+# (name, from column, to column) of each stage in the latency table
+LATENCY_STAGES = (
+  ('serial', 'receive_ms', 'insert_ms'), # serial line parsed and times row inserted, includes sqlite lock waits
+  ('match', 'insert_ms', 'match_ms'), # run started or finished
+  ('queue', 'match_ms', 'recalc_start_ms'), # recalc mule wakeup, debounce and batches ahead of it
+  ('recalc', 'recalc_start_ms', 'recalc_end_ms'),
+  ('render', 'recalc_end_ms', 'render_ms'), # until the next scoreboard refresh
+  ('total', 'receive_ms', 'render_ms'),
+)
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000) # histogram bucket upper bounds
+
+def latency_stats(db):
+  # (rows, stats) for the newest latency rows, request args limit and event_id, stats has count, percentiles and a histogram per stage
+  rows = db.latency_list(parse_int(request.args.get('limit'), 1000), parse_int(request.args.get('event_id')))
+  stats = []
+  for name, start, end in LATENCY_STAGES:
+    values = sorted(row[end] - row[start] for row in rows if row[start] is not None and row[end] is not None)
+    histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    for value in values:
+      histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, value)] += 1
+    stats.append({'stage':name, 'count':len(values), 'p50':percentile(values, 50), 'p90':percentile(values, 90),
+        'p99':percentile(values, 99), 'max':values[-1] if values else None, 'histogram':histogram})
+  return rows, stats
+
+
+@app.route('/debug/latency')
+def debug_latency_page():
+  db = get_db()
+  rows, g.latency_stats = latency_stats(db)
+  g.latency_rows = rows[:50]
+  g.latency_stages = LATENCY_STAGES
+  g.latency_buckets = LATENCY_BUCKETS_MS
+  return render_template('admin_latency.html')
+
+
+@app.route('/debug/latency/json')
+def debug_latency_json_page():
+  db = get_db()
+  rows, stats = latency_stats(db)
+  return jsonify(rows=len(rows), buckets_ms=LATENCY_BUCKETS_MS, stages=stats)
+
+
+#######################################
+
 
 
 if __name__ == '__main__':
@@ -2,3 +2,11 @@
 # you can not use ~ or other home directory redirect since the scoreboard app may be run as root for port 80 privilages
 SCORING_DB_PATH = "/home/<user>/database/scoring.db"
 
+
+# optional, append-only log of the raw timer lines, see timer_capture.py
+# defaults to <database name>_timer_capture.log next to SCORING_DB_PATH
+#TIMER_CAPTURE_PATH = "/home/<user>/database/timer_capture.log"
+
+
+# optional, prepared statements apsw keeps per database connection, default 256
+#STATEMENT_CACHE_SIZE = 256
@@ -1,12 +1,206 @@
 import logging
 from util import *
 import inspect, sys
+import threading
 from collections import OrderedDict
+import scoring_vector
 
 # customizable rules for calculating event scoring
 
 def get_rule_sets():
-  return OrderedDict(inspect.getmembers(sys.modules[__name__],lambda x: inspect.isclass(x) and issubclass(x,DefaultRules)))
+  """ Rule set classes by class name, built once at import """
+  return RULE_SETS
+
+
+def get_event(db):
+  """ Active event row or None """
+  active_event_id = db.reg_get('active_event_id')
+  if active_event_id is not None:
+    return db.select_one('events', event_id=active_event_id, deleted=0)
+
+
+_rules_cache = {} # (event_id, rule_set, max_runs, drop_runs, timestamp) -> rules instance
+_rules_cache_lock = threading.Lock()
+
+def get_rules(event):
+  """ Shared rules instance for an events row, None if its rule set is unknown
+
+  Instances are cached per event and replaced when the rule columns or timestamp of the row change,
+  they can not be modified so they are safe to share between requests and threads.
+  """
+  if event is None:
+    return None
+  key = (event['event_id'], event['rule_set'], event['max_runs'], event['drop_runs'], event['timestamp'])
+  rules = _rules_cache.get(key)
+  if rules is None:
+    if event['rule_set'] not in RULE_SETS:
+      return None
+    rules = RULE_SETS[event['rule_set']](max_runs=event['max_runs'], drop_runs=event['drop_runs'])
+    with _rules_cache_lock:
+      for old_key in [k for k in _rules_cache if k[0] == key[0]]:
+        del _rules_cache[old_key]
+      _rules_cache[key] = rules
+  return rules
+
+
+def whatif_event(db, event, rule_set=None, max_runs=None, drop_runs=None):
+  """ Score an event under another rule set or max/drop runs entirely in memory, nothing is written
+
+  Settings left as None come from the event. Returns (whatif_rules, entry_list) where each visible entry
+  has its car_class, car_number and name plus 'current' and 'whatif' dicts with event_time, event_runs,
+  class_position and overall_position, ordered by car_class and what-if position.
+  Raises KeyError for an unknown rule set.
+  """
+  rules = get_rules(event)
+  whatif_rules = RULE_SETS[rule_set or event['rule_set']](
+      max_runs=max_runs if max_runs is not None else event['max_runs'],
+      drop_runs=drop_runs if drop_runs is not None else event['drop_runs'])
+  rows = whatif_rules.load_event(db, event['event_id'])
+
+  scores = {}
+  for name, score_rules in (('current', rules), ('whatif', whatif_rules)):
+    if score_rules is None:
+      continue # event has an unknown rule set, no current scores
+    entry_list, run_list = score_rules.score_event([dict(entry) for entry in rows[0]], [dict(run) for run in rows[1]], rows[2])
+    for entry in entry_list:
+      scores.setdefault(entry['entry_id'], {})[name] = dict((key, entry[key]) for key in ('event_time', 'event_runs', 'class_position', 'overall_position'))
+
+  entry_list = []
+  for entry in db.query_all("SELECT entry_id, car_class, car_number, first_name, last_name FROM entries WHERE event_id=? AND scores_visible AND NOT deleted", (event['event_id'],)):
+    entry = dict(entry)
+    entry['current'] = scores[entry['entry_id']].get('current')
+    entry['whatif'] = scores[entry['entry_id']]['whatif']
+    entry_list.append(entry)
+  class_order = dict((car_class, i) for i, car_class in enumerate(whatif_rules.car_class_list))
+  entry_list.sort(key=lambda entry: (class_order.get(entry['car_class'], len(class_order)), entry['car_class'], entry['whatif']['class_position']))
+  return whatif_rules, entry_list
+
+
+def season_update(db, event_id):
+  """ Bring the season standings up to date with an event's current results
+
+  Recomputes the season points of the event's entries with the event's rules and
+  writes only the entries that changed, season_points totals get the difference.
+  Deleted events and events without a season_name or valid rule set earn nothing.
+  Returns the number of entries changed.
+  """
+  with db:
+    event = db.select_one('events', event_id=event_id)
+    rules = get_rules(event)
+    results = {}
+    if rules is not None and not event['deleted'] and event['season_name']:
+      for entry in db.query_all("SELECT entry_id, first_name, last_name, msreg_number, car_class, season_points, event_runs, class_position FROM entries WHERE event_id=? AND NOT deleted", (event_id,)):
+        points = rules.calc_season_points(entry)
+        if points is not None:
+          results[entry['entry_id']] = (event['season_name'], driver_key(entry), entry['car_class'], entry['first_name'], entry['last_name'], points)
+    return db.season_results_update(event_id, results)
+
+
+def season_rebuild(db, season_name=None):
+  """ Recompute the season standings of one season, or every season, from the events
+
+  Only needed after upgrading or restoring a database, season_update keeps them current.
+  Returns the number of events scored.
+  """
+  with db:
+    db.season_clear(season_name)
+    if season_name is None:
+      event_ids = db.query_single_list("SELECT event_id FROM events WHERE NOT deleted")
+    else:
+      event_ids = db.query_single_list("SELECT event_id FROM events WHERE season_name=? AND NOT deleted", (season_name,))
+    for event_id in event_ids:
+      season_update(db, event_id)
+    return len(event_ids)
+
+
+RECALC_BATCH_SIZE = 50 # queued recalcs per transaction
+RECALC_DEBOUNCE_MS = 100 # default recalc_debounce_ms, the recalc mule collects messages this long before a cycle
+
+def recalc_batch(db, batch_size=RECALC_BATCH_SIZE):
+  """ Do one batch of queued recalcs in a single transaction, returns the number of items done, 0 once the queue is empty
+
+  A batch holds items of the event with the most urgent queued item, whether or not it is the active event.
+  A queued whole event recalc replaces every other queued item of its event. Items of deleted events or
+  events with an unknown rule set are dropped. Class slowest times are cached for this transaction only,
+  admin edits between batches change them without going through the batch.
+  """
+  with db:
+    event_id, items = db.recalc_queue_next(batch_size)
+    if not items:
+      return 0
+    rules = get_rules(db.select_one('events', event_id=event_id, deleted=0))
+    if rules is None:
+      logging.warning("recalc_batch: dropping %d items of event %r, deleted or invalid rule set", len(items), event_id)
+      db.recalc_queue_remove(items)
+      return len(items)
+
+    start_ms = monotonic_ms()
+    if items[0]['kind'] == 'event':
+      count = db.recalc_queue_remove_event(event_id)
+      rules.recalc_event(db, event_id)
+      db.latency_recalc(event_id, None, start_ms)
+      return count
+
+    slowest_times = ClassSlowestTimes()
+    entry_count = 0
+    for item in items:
+      if item['kind'] == 'run':
+        rules.recalc_run(db, item['id'], slowest_times)
+      else:
+        rules.recalc_entry(db, item['id'], slowest_times)
+        entry_count += 1
+    db.recalc_queue_remove(items)
+
+    if entry_count:
+      # standings of the whole event shift when any entry's score changes
+      db.entry_positions_update(event_id)
+      season_update(db, event_id)
+    db.latency_recalc(event_id, [item['id'] for item in items if item['kind'] == 'run'], start_ms)
+    return len(items)
+
+###########################################################
+
+class ClassSlowestTimes(object):
+  """ Memoized slowest scored raw time per (event_id, car_class, run_number)
+
+  One instance is shared by every recalc in one recalc_batch transaction. An
+  event's table is filled with a single GROUP BY query on first use, classes
+  touched by a changed run are invalidated and queried again on their next use.
+  """
+
+  def __init__(self):
+    self._tables = {} # event_id -> {(car_class, run_number): raw_time_ms}
+    self._stale = {} # event_id -> set of car_class
+
+  def set_event(self, event_id, table):
+    """ Use a table already computed by the caller, e.g. recalc_event """
+    self._tables[event_id] = table
+    self._stale[event_id] = set()
+
+  def invalidate(self, event_id, car_class):
+    if event_id in self._tables:
+      self._stale[event_id].add(car_class)
+
+  def _query(self, db, event_id, car_class=None):
+    sql = "SELECT entries.car_class, runs.run_number, MAX(runs.raw_time_ms) FROM entries, runs WHERE entries.entry_id=runs.entry_id AND runs.state = 'scored' AND runs.event_id=? AND runs.run_number NOT NULL AND NOT entries.deleted AND NOT runs.deleted"
+    if car_class is None:
+      rows = db.query_all(sql + " GROUP BY entries.car_class, runs.run_number", (event_id,))
+    else:
+      rows = db.query_all(sql + " AND entries.car_class=? GROUP BY runs.run_number", (event_id, car_class))
+    return dict(((row[0], row[1]), row[2]) for row in rows)
+
+  def get(self, db, event_id, car_class, run_number):
+    table = self._tables.get(event_id)
+    if table is None:
+      table = self._query(db, event_id)
+      self.set_event(event_id, table)
+    stale = self._stale[event_id]
+    if car_class in stale:
+      for key in [key for key in table if key[0] == car_class]:
+        del table[key]
+      table.update(self._query(db, event_id, car_class))
+      stale.discard(car_class)
+    return table.get((car_class, run_number))
 
 
 ###########################################################
@@ -36,119 +230,303 @@ class DefaultRules(object):
   cone_penalty = 2 # seconds
   gate_penalty = 10 # seconds
   dnf_penalty = 0 # seconds, DNF bogey time
+  dnf_bogey = 'penalty' # DNF run time: 'penalty' is dnf_penalty, 'class_slowest' adds it to the class slowest time, 'dnf' lets the DNF stand
   min_runs = 1 # number of runs needed before drop runs can be used
   max_runs = 5 # total number of scored runs
   drop_runs = 0 # number of runs allowed to be dropped
 
+  season_points_list = [20, 17, 15, 13, 11, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1] # season points by class position
+  season_points_min = 1 # points for class positions past the end of season_points_list
+
+  # values outside of an entry's own runs and penalties that its score depends on
+  #   'class_run_slowest': slowest scored raw time in the entry's car_class for each run_number
+  entry_dependencies = ()
+
   def __init__(self, **kwarg):
     self.log = kwarg.get('logger', logging.getLogger(__name__))
+    # per event overrides of the class defaults
+    self.max_runs = parse_int(kwarg.get('max_runs'), self.max_runs)
+    self.drop_runs = parse_int(kwarg.get('drop_runs'), self.drop_runs)
+    self._frozen = True
+
+  def __setattr__(self, name, value):
+    if getattr(self, '_frozen', False):
+      raise AttributeError("rules instances are shared and can not be modified, pass %s to the constructor" % name)
+    object.__setattr__(self, name, value)
+
+
+  def class_slowest_time_ms(self, db, run, slowest_times):
+    """ Slowest scored raw time in the run's car_class for its run_number
 
+    Rule sets read it through this hook, slowest_times is the batch's ClassSlowestTimes.
+    """
+    return slowest_times.get(db, run['event_id'], run['car_class'], run['run_number'])
 
-  def calc_dnf(self, db, run_id):
+
+  def set_dependent_recalc(self, db, event_id, car_class, run_number=None):
+    """ Flag entries whose score depends on runs of car_class at run_number (any run_number if None) """
+    if car_class is None:
+      return 0
+    if 'class_run_slowest' in self.entry_dependencies:
+      return db.set_class_run_recalc(event_id, car_class, run_number)
+    return 0
+
+
+  def calc_dnf(self, db, run, slowest_times):
     # time penalty in milliseconds or None to have the DNF stand
+    # run has run_id, event_id, run_number and car_class (None if the entry is deleted)
+    if self.dnf_bogey == 'dnf':
+      return None
+    elif self.dnf_bogey == 'class_slowest':
+      # dnf is bogey_time_ms + slowest time in class for run_number
+      if run['car_class'] is None:
+        return None
+      slowest_time_ms = self.class_slowest_time_ms(db, run, slowest_times)
+      if slowest_time_ms is None:
+        return None
+      return slowest_time_ms + (self.dnf_penalty * 1000)
     return self.dnf_penalty * 1000
 
 
-  def recalc_run(self, db, run_id):
+  def calc_run(self, run):
+    """ Fill in raw/total and sector times for a run dict, shared by recalc_run and recalc_event """
+    run['raw_time'] = None
+    run['total_time'] = None
+    run['raw_time_ms'] = None
+    run['total_time_ms'] = None
+    if run['dns_dnf'] == 1:
+      run['raw_time'] = "DNS"
+      run['total_time'] = "DNS"
+    elif run['dns_dnf'] > 1:
+      run['raw_time'] = "DNF"
+      run['total_time'] = "DNF"
+    elif run['start_time_ms'] is None and run['finish_time_ms'] is None:
+      pass
+    elif run['finish_time_ms'] is None:
+      pass
+    elif run['start_time_ms'] is None:
+      run['total_time_ms'] = run['raw_time_ms'] = run['finish_time_ms']
+      if run['cones']:
+        run['total_time_ms'] += run['cones'] * self.cone_penalty * 1000 # penalty is in seconds, we need milliseconds
+      if run['gates']:
+        run['total_time_ms'] += run['gates'] * self.gate_penalty * 1000 # penalty is in seconds, we need milliseconds
+      run['raw_time'] = format_time(run['raw_time_ms'])
+      run['total_time'] = format_time(run['total_time_ms'])
+    elif run['finish_time_ms'] <= run['start_time_ms']:
+      run['raw_time'] = "INVALID"
+      run['total_time'] = "INVALID"
+    else:
+      run['total_time_ms'] = run['raw_time_ms'] = run['finish_time_ms'] - run['start_time_ms']
+      if run['cones']:
+        run['total_time_ms'] += run['cones'] * self.cone_penalty * 1000 # penalty is in seconds, we need milliseconds
+      if run['gates']:
+        run['total_time_ms'] += run['gates'] * self.gate_penalty * 1000 # penalty is in seconds, we need milliseconds
+      run['raw_time'] = format_time(run['raw_time_ms'])
+      run['total_time'] = format_time(run['total_time_ms'])
+    return run_sectors(run)
+
+
+  def calc_entry(self, db, entry_id, scored_runs, penalty_time_ms, slowest_times=None):
+    """ Score one entry, shared by recalc_entry and recalc_event
+
+    scored_runs are the entry's runs in the 'scored' state in run_id order.
+    Returns (entry, scored_runs, dropped_runs) where entry holds the new entries column values.
+    """
+    entry = {'entry_id':entry_id}
+    entry['event_penalties'] = format_time(penalty_time_ms)
+
+    scored_runs = list(scored_runs)
+    dropped_runs = []
+
+    # remove extra runs beyond max_runs
+    dropped_runs += scored_runs[self.max_runs:]
+    del scored_runs[self.max_runs:]
+
+    # sort runs based on time or dnf status
+    scored_runs.sort(key=run_sort_key)
+
+    # removed drop runs beyond min runs
+    if len(scored_runs) > self.min_runs and self.drop_runs > 0:
+      dropped_runs += scored_runs[-self.drop_runs:]
+      del scored_runs[-self.drop_runs:]
+    
+    entry['event_runs'] = len(scored_runs)
+    entry['event_time_ms'] = penalty_time_ms if penalty_time_ms is not None else 0
+    entry['event_time'] = None
+    if slowest_times is None:
+      slowest_times = ClassSlowestTimes()
+    event_dnf = False
+    for run in scored_runs:
+      if run['dns_dnf'] > 0:
+        dnf_time_ms = self.calc_dnf(db, run, slowest_times)
+        if dnf_time_ms is None:
+          event_dnf = True
+          break
+        else:
+          entry['event_time_ms'] += dnf_time_ms
+      elif run['total_time_ms']:
+        entry['event_time_ms'] += run['total_time_ms']
+
+    if event_dnf:
+      entry['event_time'] = "DNF"
+      entry['event_time_ms'] = 0
+    else:
+      entry['event_time'] = format_time(entry['event_time_ms']) if entry['event_time_ms'] > 0 else None
+    entry['sort_key'] = entry_sort_key(entry)
+
+    return entry, scored_runs, dropped_runs
+
+
+  def calc_season_points(self, entry):
+    """ Season points earned by an entry's event result, None if it does not take part in the season
+
+    entry needs season_points, event_runs and class_position.
+    """
+    if not entry['season_points'] or not entry['event_runs'] or entry['class_position'] is None:
+      return None
+    if entry['class_position'] <= len(self.season_points_list):
+      return self.season_points_list[entry['class_position'] - 1]
+    return self.season_points_min
+
+
+  def recalc_run(self, db, run_id, slowest_times=None):
+    """ Recalculate one run, slowest_times is the batch's ClassSlowestTimes to invalidate """
     self.log.debug("recalc_run: %r", run_id)
     with db:
-      run = db.query_one("SELECT run_id, entry_id, start_time_ms, finish_time_ms, split_1_time_ms, split_2_time_ms, cones, gates, dns_dnf FROM runs WHERE run_id=? AND NOT deleted", (run_id,))
+      run = db.query_one("SELECT run_id, event_id, entry_id, run_number, start_time_ms, finish_time_ms, split_1_time_ms, split_2_time_ms, cones, gates, dns_dnf, deleted FROM runs WHERE run_id=?", (run_id,))
       if run is None:
         return
-      run['raw_time'] = None
-      run['total_time'] = None
-      run['raw_time_ms'] = None
-      run['total_time_ms'] = None
-      run['run_number'] = None
-      if run['dns_dnf'] == 1:
-        run['raw_time'] = "DNS"
-        run['total_time'] = "DNS"
-      elif run['dns_dnf'] > 1:
-        run['raw_time'] = "DNF"
-        run['total_time'] = "DNF"
-      elif run['start_time_ms'] is None and run['finish_time_ms'] is None:
-        pass
-      elif run['finish_time_ms'] is None:
-        pass
-      elif run['start_time_ms'] is None:
-        run['total_time_ms'] = run['raw_time_ms'] = run['finish_time_ms']
-        if run['cones']:
-          run['total_time_ms'] += run['cones'] * self.cone_penalty * 1000 # penalty is in seconds, we need milliseconds
-        if run['gates']:
-          run['total_time_ms'] += run['gates'] * self.gate_penalty * 1000 # penalty is in seconds, we need milliseconds
-        run['raw_time'] = format_time(run['raw_time_ms'])
-        run['total_time'] = format_time(run['total_time_ms'])
-      elif run['finish_time_ms'] <= run['start_time_ms']:
-        run['raw_time'] = "INVALID"
-        run['total_time'] = "INVALID"
-      else:
-        run['total_time_ms'] = run['raw_time_ms'] = run['finish_time_ms'] - run['start_time_ms']
-        if run['cones']:
-          run['total_time_ms'] += run['cones'] * self.cone_penalty * 1000 # penalty is in seconds, we need milliseconds
-        if run['gates']:
-          run['total_time_ms'] += run['gates'] * self.gate_penalty * 1000 # penalty is in seconds, we need milliseconds
-        run['raw_time'] = format_time(run['raw_time_ms'])
-        run['total_time'] = format_time(run['total_time_ms'])
-
-      if run['entry_id'] is not None:
-        row = db.query_one("SELECT count(*) as run_count FROM runs WHERE entry_id=:entry_id AND state != 'tossout' AND run_id <= :run_id AND NOT deleted", run)
-        if row:
-          run['run_number'] = row['run_count']
+      # a state change, new run or delete shifts the numbers of this entry's later runs
+      renumbered = db.run_renumber(run['entry_id'], run_id)
+      if run['entry_id'] is not None and (slowest_times is not None or self.entry_dependencies):
+        car_class = db.query_single("SELECT car_class FROM entries WHERE entry_id=?", (run['entry_id'],))
+        if slowest_times is not None:
+          slowest_times.invalidate(run['event_id'], car_class)
+        # when later runs were renumbered every run number of the class may have changed
+        self.set_dependent_recalc(db, run['event_id'], car_class, None if renumbered else run['run_number'])
+      if run['deleted']:
+        db.execute("UPDATE runs SET recalc=0 WHERE run_id=?", (run_id,))
+        return
+      run = self.calc_run(dict(run)) # dict used for named sql bindings below
 
-      db.execute("UPDATE runs SET recalc=0, raw_time=:raw_time, total_time=:total_time, raw_time_ms=:raw_time_ms, total_time_ms=:total_time_ms, run_number=:run_number WHERE run_id=:run_id", run)
+      if run['entry_id'] is None:
+        db.execute("UPDATE runs SET recalc=0, raw_time=:raw_time, total_time=:total_time, raw_time_ms=:raw_time_ms, total_time_ms=:total_time_ms, sector_1_time=:sector_1_time, sector_2_time=:sector_2_time, sector_3_time=:sector_3_time, run_number=NULL WHERE run_id=:run_id", run)
+      else:
+        db.execute("UPDATE runs SET recalc=0, raw_time=:raw_time, total_time=:total_time, raw_time_ms=:raw_time_ms, total_time_ms=:total_time_ms, sector_1_time=:sector_1_time, sector_2_time=:sector_2_time, sector_3_time=:sector_3_time WHERE run_id=:run_id", run)
 
 
-  def recalc_entry(self, db, entry_id):
+  def recalc_entry(self, db, entry_id, slowest_times=None):
+    """ Recalculate one entry's event time, slowest_times is the batch's ClassSlowestTimes """
     self.log.debug("recalc_entry: %r", entry_id)
     if entry_id is None:
       return
     with db:
-      entry = {'entry_id':entry_id}
       penalty_time_ms = db.query_single("SELECT SUM(time_ms) FROM penalties WHERE entry_id=? AND NOT deleted", (entry_id,))
-      entry['event_penalties'] = format_time(penalty_time_ms)
-
-      dropped_runs = []
-      scored_runs = db.query_all("SELECT run_id, dns_dnf, start_time_ms, finish_time_ms, total_time_ms FROM runs WHERE state = 'scored' AND entry_id=? AND NOT deleted", (entry_id,))
-
-      # remove extra runs beyond max_runs
-      dropped_runs += scored_runs[self.max_runs:]
-      del scored_runs[self.max_runs:]
-
-      # sort runs based on time or dnf status
-      scored_runs.sort(cmp=run_cmp)
-
-      # removed drop runs beyond min runs
-      if len(scored_runs) > self.min_runs and self.drop_runs > 0:
-        dropped_runs += scored_runs[-self.drop_runs:]
-        del scored_runs[-self.drop_runs:]
-      
-      entry['event_runs'] = len(scored_runs)
-      entry['event_time_ms'] = penalty_time_ms if penalty_time_ms is not None else 0
-      entry['event_time'] = None
-      event_dnf = False
+      car_class = db.query_single("SELECT car_class FROM entries WHERE entry_id=? AND NOT deleted", (entry_id,))
+
+      scored_runs = []
+      for run in db.query_all("SELECT run_id, event_id, run_number, dns_dnf, start_time_ms, finish_time_ms, total_time_ms FROM runs WHERE state = 'scored' AND entry_id=? AND NOT deleted ORDER BY run_id", (entry_id,)):
+        run['car_class'] = car_class
+        scored_runs.append(run)
+
+      entry, scored_runs, dropped_runs = self.calc_entry(db, entry_id, scored_runs, penalty_time_ms, slowest_times)
+
+      for run in dropped_runs:
+        db.execute("UPDATE runs SET drop_run=1 WHERE run_id=?", (run['run_id'],))
       for run in scored_runs:
-        if run['dns_dnf'] > 0:
-          dnf_time_ms = self.calc_dnf(db, run['run_id'])
-          if dnf_time_ms is None:
-            event_dnf = True
-            break
-          else:
-            entry['event_time_ms'] += dnf_time_ms
-        elif run['total_time_ms']:
-          entry['event_time_ms'] += run['total_time_ms']
-
-      if event_dnf:
-        entry['event_time'] = "DNF"
-        entry['event_time_ms'] = 0
-      else:
-        entry['event_time'] = format_time(entry['event_time_ms']) if entry['event_time_ms'] > 0 else None
+        db.execute("UPDATE runs SET drop_run=0 WHERE run_id=?", (run['run_id'],))
+
+      db.execute("UPDATE entries SET recalc=0, event_time_ms=:event_time_ms, event_time=:event_time, event_penalties=:event_penalties, event_runs=:event_runs, sort_key=:sort_key WHERE entry_id=:entry_id", entry)
+
+
+  def load_event(self, db, event_id):
+    """ Rows needed to score a whole event, returns (entry_list, run_list, penalty_time) for score_event """
+    entry_list = db.query_all("SELECT entry_id, car_class, scores_visible, deleted FROM entries WHERE event_id=? ORDER BY entry_id", (event_id,))
+    run_list = db.query_all("SELECT run_id, event_id, entry_id, state, start_time_ms, finish_time_ms, split_1_time_ms, split_2_time_ms, cones, gates, dns_dnf FROM runs WHERE event_id=? AND NOT deleted ORDER BY run_id", (event_id,))
+    penalty_time = dict((row['entry_id'], row['time_ms']) for row in db.query_all("SELECT entry_id, SUM(time_ms) AS time_ms FROM penalties WHERE event_id=? AND NOT deleted GROUP BY entry_id", (event_id,)))
+    return entry_list, run_list, penalty_time
+
+
+  def can_vectorize(self):
+    """ True if scoring_vector can score events for these rules, it needs NumPy and the stock calc_* methods """
+    if scoring_vector.numpy is None:
+      return False
+    for name in ('calc_run', 'calc_entry', 'calc_dnf', 'class_slowest_time_ms'):
+      if getattr(type(self), name) != getattr(DefaultRules, name):
+        return False
+    return True
+
+
+  def score_event(self, entry_list, run_list, penalty_time, vectorized=None):
+    """ Score a whole event in memory from load_event rows, nothing is written to the database
+
+    Fills in the columns recalc writes on each run (raw/total times, run_number, drop_run for scored runs)
+    and entry (event times, event_runs, sort_key, class_position, overall_position).
+    Uses scoring_vector when can_vectorize() unless vectorized is False.
+    """
+    if vectorized is not False and self.can_vectorize():
+      scoring_vector.score_event(self, entry_list, run_list, penalty_time)
+      return entry_list, run_list
 
+    car_class = dict((entry['entry_id'], entry['car_class']) for entry in entry_list if not entry['deleted'])
+    entry_runs = {}
+    for run in run_list:
+      self.calc_run(run)
+      run['car_class'] = car_class.get(run['entry_id'])
+      run['run_number'] = None
+      if run['entry_id'] is not None:
+        entry_runs.setdefault(run['entry_id'], []).append(run)
+    for runs in entry_runs.values():
+      for run, run_number in run_numbers(runs):
+        run['run_number'] = run_number
+
+    # slowest scored raw time per class and run number, used for DNF bogey times
+    class_slowest = {}
+    for run in run_list:
+      if run['state'] == 'scored' and run['car_class'] is not None and run['run_number'] is not None and run['raw_time_ms'] is not None:
+        key = (run['car_class'], run['run_number'])
+        if key not in class_slowest or run['raw_time_ms'] > class_slowest[key]:
+          class_slowest[key] = run['raw_time_ms']
+    slowest_times = ClassSlowestTimes()
+    if run_list:
+      slowest_times.set_event(run_list[0]['event_id'], class_slowest)
+
+    for entry in entry_list:
+      scored_runs = [run for run in entry_runs.get(entry['entry_id'], []) if run['state'] == 'scored']
+      result, scored_runs, dropped_runs = self.calc_entry(None, entry['entry_id'], scored_runs, penalty_time.get(entry['entry_id']), slowest_times)
+      for key, value in result.items():
+        entry[key] = value
       for run in dropped_runs:
-        db.execute("UPDATE runs SET drop_run=1 WHERE run_id=:run_id", run)
+        run['drop_run'] = 1
       for run in scored_runs:
-        db.execute("UPDATE runs SET drop_run=0 WHERE run_id=:run_id", run)
+        run['drop_run'] = 0
+
+    for entry, class_position, overall_position in entry_positions(sorted(entry_list, key=lambda entry: (entry['sort_key'], entry['entry_id']))):
+      entry['class_position'] = class_position
+      entry['overall_position'] = overall_position
+    return entry_list, run_list
 
-      db.execute("UPDATE entries SET recalc=0, event_time_ms=:event_time_ms, event_time=:event_time, event_penalties=:event_penalties, event_runs=:event_runs WHERE entry_id=:entry_id", entry)
+
+  def recalc_event(self, db, event_id):
+    """ Recalculate every run and entry of an event in one pass and one transaction
+
+    Gives the same results as recalc_run for every run followed by recalc_entry for every entry.
+    """
+    self.log.debug("recalc_event: %r", event_id)
+    with db:
+      entry_list, run_list = self.score_event(*self.load_event(db, event_id))
+
+      cur = db.cursor()
+      cur.executemany("UPDATE runs SET recalc=0, raw_time=?, total_time=?, raw_time_ms=?, total_time_ms=?, sector_1_time=?, sector_2_time=?, sector_3_time=?, run_number=? WHERE run_id=?",
+          [(run['raw_time'], run['total_time'], run['raw_time_ms'], run['total_time_ms'], run['sector_1_time'], run['sector_2_time'], run['sector_3_time'], run['run_number'], run['run_id']) for run in run_list])
+      drop_updates = [(run['drop_run'], run['run_id']) for run in run_list if 'drop_run' in run]
+      if drop_updates:
+        cur.executemany("UPDATE runs SET drop_run=? WHERE run_id=?", drop_updates)
+      if entry_list:
+        cur.executemany("UPDATE entries SET recalc=0, event_time_ms=?, event_time=?, event_penalties=?, event_runs=?, sort_key=?, class_position=?, overall_position=? WHERE entry_id=?",
+            [(entry['event_time_ms'], entry['event_time'], entry['event_penalties'], entry['event_runs'], entry['sort_key'], entry['class_position'], entry['overall_position'], entry['entry_id']) for entry in entry_list])
+      cur.execute("UPDATE runs SET recalc=0 WHERE event_id=? AND recalc", (event_id,))
+      season_update(db, event_id)
 
 
 ###########################################################
@@ -160,9 +538,7 @@ class ORG_RallyCross_Rules(DefaultRules):
   name = "ORG Rally Cross"
   drop_runs = 1
   min_runs = 3
-
-  def calc_dnf(self, db, run_id):
-    return None # a DNF is a DNF, you already got a drop run
+  dnf_bogey = 'dnf' # a DNF is a DNF, you already got a drop run
 
 
 ###########################################################
@@ -196,17 +572,8 @@ class NWRA_RallyCross_Rules(DefaultRules):
     'Time Only':'TO'
       }
   dnf_penalty = 10
-  
-  def calc_dnf(self, db, run_id):
-    # dnf is bogey_time_ms + slowest time in class for run_number
-    entry_run = db.query_one("SELECT entries.car_class, entries.event_id, runs.run_number FROM entries, runs WHERE entries.entry_id=runs.entry_id AND runs.run_id=? AND NOT entries.deleted AND NOT runs.deleted", (run_id,))
-    if entry_run is None:
-      return None
-    slowest_time_ms =  db.query_single("SELECT MAX(raw_time_ms) FROM entries, runs WHERE entries.entry_id=runs.entry_id AND runs.state = 'scored' AND runs.event_id=? AND runs.run_number=? AND entries.car_class=? AND NOT entries.deleted AND NOT runs.deleted", (entry_run['event_id'], entry_run['run_number'], entry_run['car_class']))
-    if slowest_time_ms is None:
-      return None
-    else:
-      return slowest_time_ms + (self.dnf_penalty * 1000)
+  dnf_bogey = 'class_slowest' # dnf is bogey time + slowest time in class for run_number
+  entry_dependencies = ('class_run_slowest',) # DNF bogey time
 
 
 ###########################################################
@@ -231,19 +598,13 @@ class NWRA_RallySprint_Rules(DefaultRules):
   cone_penalty = 30
   gate_penalty = 50
   dnf_penalty = 120 # 2 minutes
-
-  def calc_dnf(self, db, run_id):
-    # dnf is bogey_time_ms + slowest time in class for run_number
-    entry_run = db.query_one("SELECT entries.car_class, entries.event_id, runs.run_number FROM entries, runs WHERE entries.entry_id=runs.entry_id AND runs.run_id=? AND NOT entries.deleted AND NOT runs.deleted", (run_id,))
-    if entry_run is None:
-      return None
-    slowest_time_ms =  db.query_single("SELECT MAX(raw_time_ms) FROM entries, runs WHERE entries.entry_id=runs.entry_id AND runs.state = 'scored' AND runs.event_id=? AND runs.run_number=? AND entries.car_class=? AND NOT entries.deleted AND NOT runs.deleted", (entry_run['event_id'], entry_run['run_number'], entry_run['car_class']))
-    if slowest_time_ms is None:
-      return None
-    else:
-      return slowest_time_ms + (self.dnf_penalty * 1000)
+  dnf_bogey = 'class_slowest' # dnf is bogey time + slowest time in class for run_number
+  entry_dependencies = ('class_run_slowest',) # DNF bogey time
 
 
 ###########################################################
 ###########################################################
 
+# rule sets available to events, by class name
+RULE_SETS = OrderedDict(inspect.getmembers(sys.modules[__name__],lambda x: inspect.isclass(x) and issubclass(x,DefaultRules)))
+
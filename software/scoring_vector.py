@@ -0,0 +1,193 @@
+""" NumPy scoring backend for whole events
+
+Loads an event's runs into column arrays and computes run times, run numbers,
+drop runs, DNF bogey times, event totals and positions with array operations.
+Used by DefaultRules.score_event for large events, season recomputation and
+what-if scoring. Gives the same results as the calc_run/calc_entry/calc_dnf
+methods of DefaultRules, rules that override those are scored in python.
+"""
+
+try:
+  import numpy
+except ImportError:
+  numpy = None # optional, DefaultRules.score_event falls back to the python path
+
+from util import format_time, run_sectors, ENTRY_SORT_MAX_RUNS, ENTRY_SORT_NO_TIME
+
+NO_TIME = -2**62 # marks a missing value in int64 columns
+
+#######################################
+
+def group_rank(groups):
+  """ 0 based position of each element within its run of equal values, groups must be sorted """
+  count = len(groups)
+  if count == 0:
+    return numpy.zeros(0, numpy.int64)
+  index = numpy.arange(count)
+  starts = numpy.ones(count, bool)
+  starts[1:] = groups[1:] != groups[:-1]
+  return index - numpy.maximum.accumulate(numpy.where(starts, index, 0))
+
+
+def group_cumsum(values, groups):
+  """ Running sum of values restarting at each new group, groups must be sorted """
+  total = numpy.cumsum(values)
+  return total - (total - values)[numpy.arange(len(groups)) - group_rank(groups)]
+
+
+def int_column(rows, key):
+  """ (values, present) int64 arrays for a column that may hold None """
+  values = [row[key] for row in rows]
+  present = numpy.array([value is not None for value in values], bool)
+  return numpy.array([value or 0 for value in values], numpy.int64), present
+
+#######################################
+
+def score_event(rules, entry_list, run_list, penalty_time):
+  """ Vectorized DefaultRules.score_event, fills in the same run and entry values """
+  entry_count = len(entry_list)
+  run_count = len(run_list)
+
+  # entries, runs of entry_ids outside entry_list still get run numbers so they get groups past entry_count
+  group_index = dict((entry['entry_id'], i) for i, entry in enumerate(entry_list))
+  for run in run_list:
+    if run['entry_id'] is not None and run['entry_id'] not in group_index:
+      group_index[run['entry_id']] = len(group_index)
+  class_names = sorted(set(entry['car_class'] for entry in entry_list))
+  class_index = dict((car_class, i) for i, car_class in enumerate(class_names))
+  entry_class = numpy.array([class_index[entry['car_class']] for entry in entry_list], numpy.int64)
+  entry_deleted = numpy.array([bool(entry['deleted']) for entry in entry_list], bool)
+  entry_visible = numpy.array([bool(entry['scores_visible']) for entry in entry_list], bool) & ~entry_deleted
+  entry_id = numpy.array([entry['entry_id'] for entry in entry_list], numpy.int64)
+
+  # run columns
+  start_ms, has_start = int_column(run_list, 'start_time_ms')
+  finish_ms, has_finish = int_column(run_list, 'finish_time_ms')
+  cones, _ = int_column(run_list, 'cones')
+  gates, _ = int_column(run_list, 'gates')
+  dns_dnf, _ = int_column(run_list, 'dns_dnf')
+  scored = numpy.array([run['state'] == 'scored' for run in run_list], bool)
+  counted = numpy.array([run['state'] is not None and run['state'] != 'tossout' for run in run_list], numpy.int64)
+  group = numpy.array([group_index[run['entry_id']] if run['entry_id'] is not None else -1 for run in run_list], numpy.int64)
+  in_entries = (group >= 0) & (group < entry_count)
+  run_class = numpy.full(run_count, -1, numpy.int64)
+  run_class[in_entries] = numpy.where(entry_deleted[group[in_entries]], -1, entry_class[group[in_entries]])
+
+  # calc_run
+  timed = (dns_dnf < 1) & has_finish
+  no_start = timed & ~has_start
+  invalid = timed & has_start & (finish_ms <= start_ms)
+  valid = timed & ~invalid
+  raw_ms = numpy.where(no_start, finish_ms, finish_ms - start_ms)
+  total_ms = raw_ms + cones * (rules.cone_penalty * 1000) + gates * (rules.gate_penalty * 1000)
+
+  # run numbers, runs are in run_id order so a stable sort keeps that order within each entry
+  order = numpy.argsort(group, kind='mergesort')
+  run_number = numpy.zeros(run_count, numpy.int64)
+  run_number[order] = group_cumsum(counted[order], group[order])
+
+  # slowest scored raw time per class and run number
+  slowest = numpy.full((max(len(class_names), 1), (run_number.max() + 1) if run_count else 1), NO_TIME, numpy.int64)
+  contributes = scored & (run_class >= 0) & (group >= 0) & valid
+  numpy.maximum.at(slowest, (run_class[contributes], run_number[contributes]), raw_ms[contributes])
+
+  # calc_entry, first the runs past max_runs in run_id order
+  runs = numpy.nonzero(scored & in_entries)[0]
+  runs = runs[numpy.argsort(group[runs], kind='mergesort')]
+  over_max = group_rank(group[runs]) >= rules.max_runs
+  kept = runs[~over_max]
+  # then sort by util.run_sort_key keeping run_id order for ties
+  sort_class = numpy.where(dns_dnf[kept] != 0, 2, numpy.where(valid[kept] & (total_ms[kept] != 0), 0, 1))
+  sort_time = numpy.where(sort_class == 0, total_ms[kept], 0)
+  kept = kept[numpy.lexsort((kept, sort_time, sort_class, group[kept]))]
+  kept_group = group[kept]
+  kept_count = numpy.bincount(kept_group, minlength=entry_count)[kept_group]
+  dropped = numpy.zeros(len(kept), bool)
+  if rules.drop_runs > 0:
+    dropped = (kept_count > rules.min_runs) & (group_rank(kept_group) >= kept_count - rules.drop_runs)
+  drop_run = numpy.zeros(run_count, numpy.int64)
+  drop_run[runs[over_max]] = 1
+  drop_run[kept[dropped]] = 1
+  kept = kept[~dropped]
+  kept_group = group[kept]
+
+  # DNF bogey times, NO_TIME lets the DNF stand
+  dnf = dns_dnf[kept] > 0
+  if rules.dnf_bogey == 'dnf':
+    dnf_ms = numpy.full(len(kept), NO_TIME, numpy.int64)
+  elif rules.dnf_bogey == 'class_slowest':
+    kept_class = run_class[kept]
+    dnf_ms = slowest[numpy.maximum(kept_class, 0), run_number[kept]]
+    dnf_ms = numpy.where((kept_class >= 0) & (dnf_ms != NO_TIME), dnf_ms + rules.dnf_penalty * 1000, NO_TIME)
+  else:
+    dnf_ms = numpy.full(len(kept), rules.dnf_penalty * 1000, numpy.int64)
+  event_dnf = numpy.bincount(kept_group[dnf & (dnf_ms == NO_TIME)], minlength=entry_count) > 0
+
+  penalty_ms = numpy.array([penalty_time.get(entry['entry_id']) or 0 for entry in entry_list], numpy.int64)
+  event_ms = penalty_ms.copy()
+  numpy.add.at(event_ms, kept_group, numpy.where(dnf, dnf_ms, numpy.where(valid[kept], total_ms[kept], 0)))
+  event_ms[event_dnf] = 0
+  event_runs = numpy.bincount(kept_group, minlength=entry_count)
+
+  # util.entry_sort_key and util.entry_positions
+  sort_key = (ENTRY_SORT_MAX_RUNS - event_runs) * (ENTRY_SORT_NO_TIME + 1) + numpy.where(event_ms == 0, ENTRY_SORT_NO_TIME, event_ms)
+  order = numpy.lexsort((entry_id, sort_key))
+  overall_position = numpy.zeros(entry_count, numpy.int64)
+  overall_position[order] = numpy.cumsum(entry_visible[order])
+  order = numpy.lexsort((entry_id, sort_key, entry_class))
+  class_position = numpy.zeros(entry_count, numpy.int64)
+  class_position[order] = group_cumsum(entry_visible[order].astype(numpy.int64), entry_class[order])
+
+  # back to the row dicts, plain lists index much faster than arrays
+  dns_dnf = dns_dnf.tolist()
+  valid = valid.tolist()
+  invalid = invalid.tolist()
+  raw_ms = raw_ms.tolist()
+  total_ms = total_ms.tolist()
+  run_class = run_class.tolist()
+  run_number = numpy.where(group >= 0, run_number, -1).tolist()
+  drop_run = numpy.where(scored & in_entries, drop_run, -1).tolist()
+  for i, run in enumerate(run_list):
+    if dns_dnf[i] == 1:
+      run['raw_time'] = run['total_time'] = "DNS"
+      run['raw_time_ms'] = run['total_time_ms'] = None
+    elif dns_dnf[i] > 1:
+      run['raw_time'] = run['total_time'] = "DNF"
+      run['raw_time_ms'] = run['total_time_ms'] = None
+    elif valid[i]:
+      run['raw_time_ms'] = raw_ms[i]
+      run['total_time_ms'] = total_ms[i]
+      run['raw_time'] = format_time(raw_ms[i])
+      run['total_time'] = format_time(total_ms[i])
+    elif invalid[i]:
+      run['raw_time'] = run['total_time'] = "INVALID"
+      run['raw_time_ms'] = run['total_time_ms'] = None
+    else:
+      run['raw_time'] = run['total_time'] = None
+      run['raw_time_ms'] = run['total_time_ms'] = None
+    run_sectors(run)
+    run['car_class'] = class_names[run_class[i]] if run_class[i] >= 0 else None
+    run['run_number'] = run_number[i] if run_number[i] >= 0 else None
+    if drop_run[i] >= 0:
+      run['drop_run'] = drop_run[i]
+
+  event_ms = event_ms.tolist()
+  event_runs = event_runs.tolist()
+  sort_key = sort_key.tolist()
+  overall_position = overall_position.tolist()
+  class_position = class_position.tolist()
+  event_dnf = event_dnf.tolist()
+  entry_visible = entry_visible.tolist()
+  for i, entry in enumerate(entry_list):
+    penalty = penalty_time.get(entry['entry_id'])
+    entry['event_penalties'] = format_time(penalty)
+    entry['event_runs'] = event_runs[i]
+    entry['event_time_ms'] = event_ms[i]
+    if event_dnf[i]:
+      entry['event_time'] = "DNF"
+    else:
+      entry['event_time'] = format_time(event_ms[i]) if event_ms[i] > 0 else None
+    entry['sort_key'] = sort_key[i]
+    entry['class_position'] = class_position[i] if entry_visible[i] else None
+    entry['overall_position'] = overall_position[i] if entry_visible[i] else None
+  return entry_list, run_list
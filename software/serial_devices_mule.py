@@ -0,0 +1,190 @@
+""" Optional single mule for every serial device
+
+Replaces tag_heuer_520_mule.py, rfid_reader_mule.py and barcode_scanner_mule.py,
+run either this mule or those three. One select.poll loop waits on every open
+port and handles bytes as soon as they arrive. Port settings are read again when
+the admin app sends serial_handler.notify_port_change, ports that fail to open
+are retried every PORT_RETRY_INTERVAL.
+"""
+import logging
+import uwsgi
+import os
+import select
+import socket
+from sql_db import ScoringDatabase
+from time import time
+
+from serial_handler import PORT_NOTIFY_PATH
+from tag_heuer_520 import TagHeuer520, DeadTimeFilter
+from rfid_reader import RFIDReader
+from barcode_scanner import BarcodeScanner
+import tag_heuer_520_mule
+import rfid_reader_mule
+import barcode_scanner_mule
+
+try:
+  import scoring_config as config
+except ImportError:
+  raise ImportError("Unable to load scoring_config.py, please reference install instructions!")
+
+PORT_RETRY_INTERVAL = 1 # seconds between attempts to open a configured port
+SUPPRESSED_FLUSH_INTERVAL = 3 # seconds between writes of the suppressed impulse counts
+POLL_EVENTS = select.POLLIN | select.POLLPRI
+
+#######################################
+
+def get_db():
+  return ScoringDatabase(config.SCORING_DB_PATH)
+
+#######################################
+
+deadtime = DeadTimeFilter()
+
+def handle_tag_heuer(db, tag_heuer):
+  for record in tag_heuer.read_records() or []:
+    if record.kind == 'T ':
+      if deadtime.accept(record):
+        tag_heuer_520_mule.applier.submit(record, tag_heuer.receive_ms)
+    else:
+      logging.info("timer record ignored: %r", record.line)
+
+
+class RFIDHandler(object):
+  """ Card reads with the repeat filter of rfid_reader_mule.py """
+
+  def __init__(self):
+    self.prev_data = None
+    self.repeat_time = 0
+
+  def __call__(self, db, rfid_reader):
+    for rfid_data in rfid_reader.read_cards() or []:
+      rfid_reader.send_ack()
+      rfid_reader.pause()
+      if rfid_data != self.prev_data or self.repeat_time < time():
+        self.prev_data = rfid_data
+        self.repeat_time = time() + rfid_reader_mule.REPEAT_INTERVAL
+        if rfid_reader_mule.handle_next_entry(db, rfid_data):
+          rfid_reader.beep(2)
+        else:
+          rfid_reader.beep(5)
+
+
+def handle_barcode(db, scanner):
+  # the barcode is handled by the poll loop once the scanner goes quiet, see BarcodeScanner.take_barcode
+  scanner.read_available()
+
+#######################################
+
+class Device(object):
+  """ One serial device, its registry keys and the handler called when its port is readable """
+
+  def __init__(self, name, port_key, status_key, handler, reader):
+    self.name = name
+    self.port_key = port_key
+    self.status_key = status_key
+    self.handler = handler
+    self.reader = reader
+    self.port = None # configured port
+    self.fd = None # registered with poll while open
+
+DEVICES = (
+  Device('tag_heuer', 'serial_port_tag_heuer', 'tag_heuer_status', handle_tag_heuer, TagHeuer520()),
+  Device('rfid_reader', 'serial_port_rfid_reader', 'rfid_reader_status', RFIDHandler(), RFIDReader()),
+  Device('barcode_scanner', 'serial_port_barcode', 'barcode_scanner_status', handle_barcode, BarcodeScanner()),
+)
+
+
+def notify_socket():
+  """ Datagram socket bound to PORT_NOTIFY_PATH, any datagram means the port settings changed """
+  if os.path.exists(PORT_NOTIFY_PATH):
+    os.unlink(PORT_NOTIFY_PATH)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+  sock.bind(PORT_NOTIFY_PATH)
+  sock.setblocking(False)
+  return sock
+
+
+def close_device(db, poller, device):
+  if device.fd is not None:
+    poller.unregister(device.fd)
+    device.fd = None
+  device.reader.close()
+  db.reg_set(device.status_key, 'closed')
+  logging.warning("%s: closed", device.status_key)
+
+
+def update_devices(db, poller, reload_ports):
+  """ Close devices whose port setting changed and open configured ones, returns True while a port failed to open """
+  if reload_ports:
+    ports = db.reg_get_many([device.port_key for device in DEVICES])
+  retry = False
+  for device in DEVICES:
+    if reload_ports:
+      device.port = ports[device.port_key]
+    if device.fd is not None and (not device.reader.is_open() or device.reader.port != device.port):
+      close_device(db, poller, device)
+    if device.fd is None and device.port is not None:
+      if device.reader.open(device.port):
+        device.fd = device.reader.fileno()
+        poller.register(device.fd, POLL_EVENTS)
+        db.reg_set(device.status_key, 'open')
+        logging.warning("%s: open", device.status_key)
+      else:
+        retry = True
+  return retry
+
+#######################################
+
+if __name__ == '__main__':
+  logging.warning("start serial devices mule")
+  db = get_db()
+  poller = select.poll()
+  sock = notify_socket()
+  poller.register(sock.fileno(), select.POLLIN)
+  for device in DEVICES:
+    db.reg_set(device.status_key, 'closed')
+  for device in DEVICES:
+    if isinstance(device.reader, TagHeuer520):
+      device.reader.capture = tag_heuer_520_mule.open_capture_log()
+  tag_heuer_520_mule.applier.start()
+
+  reload_ports = True
+  retry_time = None
+  flush_time = 0
+  while True:
+    if reload_ports:
+      deadtime.load(db)
+    if reload_ports or (retry_time is not None and retry_time <= time()):
+      retry_time = time() + PORT_RETRY_INTERVAL if update_devices(db, poller, reload_ports) else None
+      reload_ports = False
+    if deadtime.suppressed and flush_time <= time():
+      tag_heuer_520_mule.applier.submit_suppressed(deadtime)
+      flush_time = time() + SUPPRESSED_FLUSH_INTERVAL
+
+    # sleep until bytes arrive, a notification, a port retry, a barcode completes or suppressed counts are due
+    deadlines = [device.reader.barcode_deadline() for device in DEVICES if isinstance(device.reader, BarcodeScanner)]
+    deadlines = [deadline for deadline in deadlines + [retry_time, flush_time if deadtime.suppressed else None] if deadline is not None]
+    timeout = max(min(deadlines) - time(), 0) * 1000 if deadlines else None
+
+    for fd, events in poller.poll(timeout):
+      if fd == sock.fileno():
+        while True:
+          try:
+            sock.recv(64)
+          except socket.error:
+            break
+        reload_ports = True
+        continue
+      for device in DEVICES:
+        if device.fd == fd:
+          device.handler(db, device.reader)
+          if not device.reader.is_open():
+            # serial_wrapper closed it after an error, eg. the device was unplugged
+            close_device(db, poller, device)
+            retry_time = time() + PORT_RETRY_INTERVAL
+
+    for device in DEVICES:
+      if isinstance(device.reader, BarcodeScanner):
+        barcode_data = device.reader.take_barcode()
+        if barcode_data is not None:
+          barcode_scanner_mule.handle_barcode(db, barcode_data)
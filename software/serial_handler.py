@@ -1,5 +1,22 @@
+
+import socket
 from serial import Serial, SerialException
 
+READ_CHUNK_MAX = 4096 # most bytes taken from the port by one read_chunk call
+
+# unix datagram socket serial_devices_mule.py listens on for serial port setting changes
+PORT_NOTIFY_PATH = '/tmp/rallyx_serial_devices.sock'
+
+def notify_port_change():
+  """ Tell serial_devices_mule.py to re-read the serial port settings, nothing happens if it is not running """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+  try:
+    sock.sendto('ports', PORT_NOTIFY_PATH)
+  except socket.error:
+    pass # not running, the per device mules poll the registry instead
+  finally:
+    sock.close()
+
 def serial_wrapper(func):
   def wrapper(self, *args, **kwargs):
     try:
@@ -14,6 +31,7 @@ class SerialHandler(object):
     self.serial = None
     self.port = None
     self.baudrate = baudrate
+    self.buffer = bytearray() # received bytes not yet consumed by a parser, see read_chunk
     self.open(port)
 
   def open(self, port, baudrate=None, raise_ex=False):
@@ -34,6 +52,10 @@ class SerialHandler(object):
       self.port = port
       return True
 
+  def fileno(self):
+    """ File descriptor of the open port, for select/poll """
+    return self.serial.fileno()
+
   def is_open(self):
     return self.serial is not None and self.serial.is_open
 
@@ -42,11 +64,20 @@ class SerialHandler(object):
       self.serial.close()
     self.serial = None
     self.port = None
+    del self.buffer[:] # partial data from the old port is useless
+
+  @serial_wrapper
+  def read_chunk(self):
+    """ Append everything waiting on the port to self.buffer in one read
+
+    Waits up to the port timeout when nothing is waiting. Returns the number of bytes read.
+    """
+    data = self.serial.read(min(max(self.serial.in_waiting, 1), READ_CHUNK_MAX))
+    self.buffer.extend(data)
+    return len(data)
 
   def __enter__(self):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
     self.close()
-
-
@@ -1,19 +1,128 @@
 import apsw
 import logging
-from util import format_time, time_cmp
+from util import format_time, time_cmp, run_numbers, entry_positions, monotonic_ms
 import types
 import os
+import threading
+
+try:
+  import scoring_config as config
+except ImportError:
+  config = None # eg. benchmark.py and the tests, which pass their own database paths
 
 #######################################
 
 # this number should match the schema_versions/version_NNN.sql file name used to init the db
-SCHEMA_VERSION = 6
+SCHEMA_VERSION = 11
+
+# oldest db file version that can be upgraded in place using schema_versions/upgrade_NNN.sql files
+MIN_UPGRADE_VERSION = 6
+
+# default number of prepared statements apsw keeps per connection, STATEMENT_CACHE_SIZE in scoring_config
+STATEMENT_CACHE_SIZE = getattr(config, 'STATEMENT_CACHE_SIZE', 256)
+
+# milliseconds a connection waits on another connection's write lock before apsw.BusyError
+BUSY_TIMEOUT_MS = 10000
+
+# recalc_queue priorities, lower is recalculated first
+RECALC_LIVE = 0 # timing equipment
+RECALC_ADMIN = 1 # edits made on the admin pages
+RECALC_BULK = 2 # whole event recalcs
+
+# newest latency rows kept by latency_prune
+LATENCY_KEEP_ROWS = 10000
+
+# season_results values given to season_results_update for each entry
+SEASON_RESULT_COLUMNS = ('season_name', 'driver_key', 'car_class', 'first_name', 'last_name', 'points')
 
 # used as global storage for table column names
 columns = {}
 
 #######################################
 
+def sql_template(builder):
+  """ Memoize a sql text builder, arguments must be hashable and describe only the statement shape """
+  cache = {}
+  def wrapper(*args):
+    try:
+      return cache[args]
+    except KeyError:
+      sql = cache[args] = builder(*args)
+      return sql
+  wrapper.cache = cache
+  return wrapper
+
+def order_by_key(order_by):
+  """ Normalize an _order_by argument into a hashable value for sql_template builders """
+  if isinstance(order_by, types.StringTypes):
+    return order_by
+  elif isinstance(order_by, (list,tuple)) and len(order_by) > 0:
+    return tuple(order_by)
+  else:
+    return None
+
+def where_sql(keys):
+  # keys must already be in canonical (sorted) order
+  return "".join(" AND %s=?" % key for key in keys)
+
+@sql_template
+def select_sql(table_name, keys, order_by, limit, offset):
+  sql = "SELECT * FROM %s WHERE 1%s" % (table_name, where_sql(keys))
+  if isinstance(order_by, tuple):
+    sql += " ORDER BY %s" % ",".join(order_by)
+  elif order_by is not None:
+    sql += " ORDER BY %s" % order_by
+  else:
+    sql += " ORDER BY rowid ASC"
+  if limit:
+    sql += " LIMIT ?"
+    if offset:
+      sql += " OFFSET ?"
+  return sql
+
+@sql_template
+def count_sql(table_name, keys):
+  return "SELECT count(*) FROM %s WHERE 1%s" % (table_name, where_sql(keys))
+
+@sql_template
+def insert_sql(table_name, keys):
+  return "INSERT INTO %s (%s) VALUES (%s)" % (table_name, ','.join(keys), ','.join('?' * len(keys)))
+
+@sql_template
+def update_sql(table_name, keys):
+  return "UPDATE %s SET %s WHERE rowid=?" % (table_name, ', '.join(['%s=?' % k for k in keys]))
+
+@sql_template
+def run_list_sql(count, has_event_id, entry_filter, state_count, has_max_run_id, sort, has_limit, has_offset):
+  # entry_filter is None (any entry), 'null' (unassigned) or 'value' (entry_id=?)
+  if count:
+    sql = "SELECT count(*) FROM runs WHERE NOT deleted"
+  else:
+    sql = "SELECT * FROM runs WHERE NOT deleted"
+  if has_event_id:
+    sql += " AND event_id=?"
+  if entry_filter == 'null':
+    sql += " AND entry_id ISNULL"
+  elif entry_filter == 'value':
+    sql += " AND entry_id=?"
+  if state_count == 1:
+    sql += " AND state=?"
+  elif state_count > 1:
+    sql += " AND state IN (%s)" % ','.join('?' * state_count)
+  if has_max_run_id:
+    sql += " AND run_id<=?"
+  if sort in ('d','D'):
+    sql += " ORDER BY run_id DESC"
+  elif sort in ('a','A'):
+    sql += " ORDER BY run_id ASC"
+  if has_limit:
+    sql += " LIMIT ?"
+    if has_offset:
+      sql += " OFFSET ?"
+  return sql
+
+#######################################
+
 def dict_row_factory(cursor, row):
   d = {}
   for idx, col in enumerate(cursor.getdescription()):
@@ -21,6 +130,95 @@ def dict_row_factory(cursor, row):
     d[col[0]] = row[idx] # column name indexing
   return d
 
+
+class Row(object):
+  """ Compact result row supporting dict style row['col'] access
+
+  The column name index is shared by every row returned by a statement, each
+  row only holds its values. Values may be reassigned like a dict, keys that
+  are not result columns are kept in a small per row dict. Use dict(row) when
+  a real dict is needed, eg. for named sql bindings.
+  """
+
+  __slots__ = ('_index', '_values', '_extra')
+
+  def __init__(self, index, values):
+    self._index = index
+    self._values = values
+    self._extra = None
+
+  def __getitem__(self, key):
+    try:
+      return self._values[self._index[key]]
+    except KeyError:
+      if self._extra is not None and key in self._extra:
+        return self._extra[key]
+      elif isinstance(key, int):
+        return self._values[key] # numerical indexing
+      raise
+
+  def __setitem__(self, key, value):
+    if key in self._index:
+      if isinstance(self._values, tuple):
+        self._values = list(self._values)
+      self._values[self._index[key]] = value
+    else:
+      if self._extra is None:
+        self._extra = {}
+      self._extra[key] = value
+
+  def __contains__(self, key):
+    return key in self._index or (self._extra is not None and key in self._extra)
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self._index) + (len(self._extra) if self._extra else 0)
+
+  def __repr__(self):
+    return "Row(%r)" % dict(self)
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except (KeyError, IndexError):
+      return default
+
+  def keys(self):
+    keys = sorted(self._index, key=self._index.get)
+    if self._extra:
+      keys.extend(self._extra)
+    return keys
+
+  def values(self):
+    return [self[key] for key in self.keys()]
+
+  def items(self):
+    return [(key, self[key]) for key in self.keys()]
+
+
+# column name index shared by rows with the same description
+_row_index_cache = {}
+
+def row_index(description):
+  try:
+    return _row_index_cache[description]
+  except KeyError:
+    index = _row_index_cache[description] = dict((col[0], idx) for idx, col in enumerate(description))
+    return index
+
+def row_factory(cursor, row):
+  # fallback for cursors that bypass row_exectrace, eg. cursors with their own exectrace
+  return Row(row_index(cursor.getdescription()), row)
+
+def row_exectrace(cursor, sql, bindings):
+  # look up the column description once per statement instead of once per row
+  if cursor.getrowtrace() is not dict_row_factory:
+    index = row_index(cursor.getdescription())
+    cursor.setrowtrace(lambda cursor, row: Row(index, row))
+  return True
+
 class SchemaVersionException(Exception):
   pass
 
@@ -38,29 +236,48 @@ def columns_exectrace(cursor, sql, bindings):
 #######################################
 
 class ScoringDatabase(apsw.Connection):
-  def __init__(self, path, logger=None):
+  def __init__(self, path, logger=None, statement_cache_size=STATEMENT_CACHE_SIZE, check_schema=True):
     if logger is None:
       self.log = logging.getLogger(__name__)
     else:
       self.log = logger
     new_file = not os.path.exists(path)
-    super(ScoringDatabase,self).__init__(path)
+    super(ScoringDatabase,self).__init__(path, statementcachesize=statement_cache_size)
     self._context_stack = 0 # used for nesting context manager calls using 'with' stantement
-    self.setbusytimeout(10000) # 10 seconds
-    self.setrowtrace(dict_row_factory)
+    self.reg_cache_clear()
+    self.setbusytimeout(BUSY_TIMEOUT_MS)
+    self.setrowtrace(row_factory)
+    self.setexectrace(row_exectrace)
     if new_file:
       self.init_schema()
-    else:
+    elif check_schema:
       self.check_schema()
 
-  def check_schema(self):
+  def schema_version(self):
     try:
-      version = self.execute("PRAGMA user_version").fetchone()['user_version']
+      return self.execute("PRAGMA user_version").fetchone()['user_version']
     except apsw.SQLError:
       raise SchemaErrorException("SQLError")
-    else:
-      if version != SCHEMA_VERSION:
-        raise SchemaVersionException("db_file=%r, software=%r" % (version, SCHEMA_VERSION))
+
+  def check_schema(self):
+    version = self.schema_version()
+    if version == SCHEMA_VERSION:
+      return
+    if version < MIN_UPGRADE_VERSION or version > SCHEMA_VERSION:
+      raise SchemaVersionException("db_file=%r, software=%r" % (version, SCHEMA_VERSION))
+    self.upgrade_schema()
+
+  def upgrade_schema(self):
+    # apply each upgrade_NNN.sql in order, all in one transaction so a failed upgrade leaves the file untouched
+    with self:
+      # re-read the version now that we hold the write lock, another process may have already upgraded the file
+      version = self.schema_version()
+      while version < SCHEMA_VERSION:
+        version += 1
+        self.log.warning("upgrading database schema to version %d", version)
+        with open("schema_versions/upgrade_%03d.sql" % version) as sql_file:
+          self.execute(sql_file.read())
+        self.execute("PRAGMA user_version=%d" % version)
 
   def init_schema(self):
     cur = self.cursor()
@@ -90,11 +307,19 @@ class ScoringDatabase(apsw.Connection):
       else:
         self.rollback()
 
+  def reset(self):
+    """ Return the connection to autocommit mode, used before reusing a pooled connection """
+    if not self.getautocommit():
+      self.log.warning("rolling back unfinished transaction")
+      self.rollback()
+    self._context_stack = 0
+
   def commit(self):
     self.cursor().execute("commit")
 
   def rollback(self):
     self.cursor().execute("rollback")
+    self.reg_cache_clear() # snapshots may hold values written inside the rolled back transaction
 
   def begin(self):
     self.cursor().execute("begin")
@@ -123,23 +348,28 @@ class ScoringDatabase(apsw.Connection):
 
   #### SQL statement wrappers ####
 
+  # kwargs are sorted so the same logical statement always produces the same sql text,
+  # this lets the apsw statement cache reuse the prepared statement
+
   def insert(self, _table_name, **kwargs):
-    keys = kwargs.keys()
-    values = kwargs.values()
-    sql = "INSERT INTO %s (%s) VALUES (%s)" % (_table_name, ','.join(keys), ','.join('?' * len(keys)))
-    self.cursor().execute(sql, values)
+    keys = tuple(sorted(kwargs))
+    self.cursor().execute(insert_sql(_table_name, keys), [kwargs[k] for k in keys])
     return self.last_insert_rowid()
 
   def update(self, _table_name, _row_id, **kwargs):
-    keys = kwargs.keys()
-    values = kwargs.values()
-    sql = "UPDATE %s SET %s WHERE rowid=?" % (_table_name, ', '.join(['%s=?' % k for k in keys]))
-    self.cursor().execute(sql, values + [_row_id])
+    keys = tuple(sorted(kwargs))
+    self.cursor().execute(update_sql(_table_name, keys), [kwargs[k] for k in keys] + [_row_id])
     return self.changes()
 
   def execute(self, *args, **kwargs):
     return self.cursor().execute(*args, **kwargs)
 
+  def dict_cursor(self):
+    """ Cursor returning plain dict rows instead of Row objects """
+    cur = self.cursor()
+    cur.setrowtrace(dict_row_factory)
+    return cur
+
   def query_one(self, *args, **kwargs):
     return self.cursor().execute(*args, **kwargs).fetchone()
   
@@ -148,62 +378,66 @@ class ScoringDatabase(apsw.Connection):
 
   def query_single(self, *args, **kwargs):
     row = self.cursor().execute(*args, **kwargs).fetchone()
-    return row.values()[0] if row else None
+    return row[0] if row else None
 
   def query_single_list(self, *args, **kwargs):
     values = []
     for row in self.cursor().execute(*args, **kwargs):
-      values.append(row.values()[0])
+      values.append(row[0])
     return values
 
   def select_one(self, _table_name, _order_by=None, _offset=None, **kwargs):
-    sql = "SELECT * FROM %s WHERE 1 " % _table_name
-    args = []
-    for key in kwargs:
-      sql += " AND %s=?" % key
-      args.append(kwargs[key])
-    if isinstance(_order_by, types.StringTypes):
-      sql += " ORDER BY %s " % _order_by
-    elif isinstance(_order_by, (list,tuple)) and len(_order_by) > 0:
-      sql += " ORDER BY %s " % ",".join(_order_by)
-    else:
-      sql += " ORDER BY rowid ASC "
-    sql += " LIMIT 1"
+    keys = tuple(sorted(kwargs))
+    args = [kwargs[k] for k in keys] + [1]
     if _offset:
-      sql += " OFFSET ? "
       args.append(_offset)
-    return self.query_one(sql, args)
+    return self.query_one(select_sql(_table_name, keys, order_by_key(_order_by), 1, bool(_offset)), args)
 
   def select_all(self, _table_name, _order_by=None, _limit=None, _offset=None, **kwargs):
-    sql = "SELECT * FROM %s WHERE 1 " % _table_name
-    args = []
-    for key in kwargs:
-      sql += " AND %s=?" % key
-      args.append(kwargs[key])
-    if isinstance(_order_by, types.StringTypes):
-      sql += " ORDER BY %s " % _order_by
-    elif isinstance(_order_by, (list,tuple)) and len(_order_by) > 0:
-      sql += " ORDER BY %s " % ",".join(_order_by)
-    else:
-      sql += " ORDER BY rowid ASC "
+    keys = tuple(sorted(kwargs))
+    args = [kwargs[k] for k in keys]
     if _limit:
-      sql += " LIMIT ? "
       args.append(_limit)
       if _offset:
-        sql += " OFFSET ? "
         args.append(_offset)
-    return self.query_all(sql, args)
+    return self.query_all(select_sql(_table_name, keys, order_by_key(_order_by), bool(_limit), bool(_limit and _offset)), args)
 
   def count(self, _table_name, **kwargs):
-    sql = "SELECT count(*) FROM %s WHERE 1 " % _table_name
-    args = []
-    for key in kwargs:
-      sql += " AND %s=?" % key
-      args.append(kwargs[key])
-    return self.query_single(sql, args)
+    keys = tuple(sorted(kwargs))
+    return self.query_single(count_sql(_table_name, keys), [kwargs[k] for k in keys])
 
   #### REGISTRY ####
 
+  # reg_get* reads are served from a per connection snapshot of the registry tables.
+  # PRAGMA data_version changes whenever another connection commits, so the snapshot
+  # is only reloaded after some other process (uwsgi worker, mule) wrote to the database.
+  # Writes through this connection clear the snapshot directly.
+
+  def reg_cache_clear(self):
+    self._reg_data_version = None
+    self._reg_cache = {} # event_id (None for global registry) -> {key: value}
+
+  def data_version(self):
+    """ PRAGMA data_version, changes whenever another connection commits """
+    return self.cursor().execute("PRAGMA data_version").fetchone()[0]
+
+  def _reg_cache_check(self):
+    data_version = self.data_version()
+    if data_version != self._reg_data_version:
+      self._reg_cache = {}
+      self._reg_data_version = data_version
+
+  def _reg_snapshot(self, event_id=None):
+    self._reg_cache_check()
+    snapshot = self._reg_cache.get(event_id)
+    if snapshot is None:
+      if event_id is None:
+        rows = self.cursor().execute("SELECT key, value FROM registry")
+      else:
+        rows = self.cursor().execute("SELECT key, value FROM event_registry WHERE event_id=?", (event_id,))
+      snapshot = self._reg_cache[event_id] = dict((row[0], row[1]) for row in rows)
+    return snapshot
+
   def reg_exists(self, key, event_id=None):
     if event_id is None:
       return bool(self.cursor().execute("SELECT count(*) as count FROM registry WHERE key=?", (key,)).fetchone()['count'])
@@ -212,26 +446,63 @@ class ScoringDatabase(apsw.Connection):
 
   def reg_set_default(self, key, value, event_id=None):
     # this should not overwrite any existing registry values
+    self.reg_cache_clear()
     if event_id is None:
       self.cursor().execute("INSERT OR IGNORE INTO registry (key,value) VALUES (?,?)", (key, value))
     else:
       self.cursor().execute("INSERT OR IGNORE INTO event_registry (key,value,event_id) VALUES (?,?,?)", (key, value, event_id))
 
   def reg_set(self, key, value, event_id=None):
+    self.reg_cache_clear()
     if event_id is None:
       self.cursor().execute("INSERT OR REPLACE INTO registry (key,value) VALUES (?,?)", (key, value))
     else:
       self.cursor().execute("INSERT OR REPLACE INTO event_registry (key,value,event_id) VALUES (?,?,?)", (key, value, event_id))
 
   def reg_get(self, key, default=None, event_id=None):
-    if event_id is None:
-      row = self.cursor().execute("SELECT value FROM registry WHERE key=?", (key,)).fetchone()
-    else:
-      row = self.cursor().execute("SELECT value FROM event_registry WHERE event_id=? AND key=?", (event_id, key)).fetchone()
-    if row is None:
-      return default
-    else:
-      return row['value']
+    # a key stored with a NULL value returns None, not default
+    return self._reg_snapshot(event_id).get(key, default)
+
+  def reg_get_many(self, keys, event_id=None):
+    """ Read several registry keys from one snapshot, returns a dict of key -> value
+
+    keys is a list of key names, or a dict of key name -> type where type is None for
+    the raw value, a conversion function like int, or a (function, default) tuple.
+    Conversion failures and missing keys return the default like reg_get_int.
+    """
+    snapshot = self._reg_snapshot(event_id)
+    if not isinstance(keys, dict):
+      return dict((key, snapshot.get(key)) for key in keys)
+    result = {}
+    for key, key_type in keys.items():
+      if isinstance(key_type, tuple):
+        convert, default = key_type
+      else:
+        convert, default = key_type, None
+      if convert is None:
+        result[key] = snapshot.get(key, default)
+      else:
+        try:
+          result[key] = convert(snapshot.get(key))
+        except (ValueError, TypeError):
+          result[key] = default
+    return result
+
+  def reg_set_many(self, values, event_id=None):
+    """ Write a dict of key -> value in a single transaction """
+    self.reg_cache_clear()
+    with self:
+      if event_id is None:
+        self.cursor().executemany("INSERT OR REPLACE INTO registry (key,value) VALUES (?,?)", values.items())
+      else:
+        self.cursor().executemany("INSERT OR REPLACE INTO event_registry (key,value,event_id) VALUES (?,?,?)", [(k, v, event_id) for k, v in values.items()])
+
+  def reg_snapshot(self, hidden=True, event_id=None):
+    """ Copy of the whole registry as a dict, like reg_dict but served from the snapshot """
+    snapshot = self._reg_snapshot(event_id)
+    if hidden:
+      return dict(snapshot)
+    return dict((k, v) for k, v in snapshot.items() if not k.startswith('.'))
 
   def reg_get_int(self, key, default=None, event_id=None):
     try:
@@ -250,12 +521,14 @@ class ScoringDatabase(apsw.Connection):
       return default
 
   def reg_toggle(self, key, default=None, event_id=None):
+    self.reg_cache_clear()
     if event_id is None:
       self.cursor().execute("INSERT OR IGNORE INTO registry (key,value) VALUES (?,?); UPDATE registry SET value = NOT value WHERE key=?", (key, default, key))
     else:
       self.cursor().execute("INSERT OR IGNORE INTO event_registry (key,value) VALUES (?,?); UPDATE event_registry SET value = NOT value WHERE event_id=? AND key=?", (key, default, event_id, key))
 
   def reg_inc(self, key, event_id=None):
+    self.reg_cache_clear()
     if event_id is None:
       self.cursor().execute("INSERT OR IGNORE INTO registry (key,value) VALUES (?,0); UPDATE registry SET value=value+1 WHERE key=?", (key,key))
     else:
@@ -321,87 +594,254 @@ class ScoringDatabase(apsw.Connection):
   def penalty_exists(self, penalty_id):
     return bool(self.cursor().execute("SELECT 1 FROM penalties WHERE penalty_id=? AND NOT deleted LIMIT 1", (penalty_id,)).fetchone())
 
-  def entry_list(self, event_id):
+  def entry_list(self, event_id, sort=False):
+    """ Entries of an event, with sort=True ordered by car_class and standing """
+    if sort:
+      return list(self.cursor().execute("SELECT * FROM entries WHERE event_id=? AND NOT deleted ORDER BY car_class, sort_key, entry_id", (event_id,)))
     return list(self.cursor().execute("SELECT * FROM entries WHERE event_id=? AND NOT deleted", (event_id,)))
-  
-  def set_run_recalc(self, run_id):
-    self.execute("UPDATE runs SET recalc=1 WHERE run_id=?", (run_id,))
-    return self.changes()
 
-  def set_entry_recalc(self, entry_id):
-    self.execute("UPDATE entries SET recalc=1 WHERE entry_id=?", (entry_id,))
-    return self.changes()
+  def entry_positions_update(self, event_id):
+    """ Rewrite class_position and overall_position of an event's entries from their sort_key
 
-  def set_event_recalc(self, event_id):
-    self.execute("UPDATE runs SET recalc=1 WHERE event_id=?", (event_id,))
-    self.execute("UPDATE entries SET recalc=1 WHERE event_id=?", (event_id,))
+    Positions count visible entries only, hidden and deleted entries get NULL. Returns the number of entries changed.
+    """
+    with self:
+      updates = []
+      entry_list = self.query_all("SELECT entry_id, car_class, scores_visible, deleted, class_position, overall_position FROM entries WHERE event_id=? ORDER BY sort_key, entry_id", (event_id,))
+      for entry, class_position, overall_position in entry_positions(entry_list):
+        if (class_position, overall_position) != (entry['class_position'], entry['overall_position']):
+          updates.append((class_position, overall_position, entry['entry_id']))
+      if updates:
+        self.cursor().executemany("UPDATE entries SET class_position=?, overall_position=? WHERE entry_id=?", updates)
+      return len(updates)
+
+  def season_results_update(self, event_id, results):
+    """ Replace an event's season_results with results and apply the differences to season_points
+
+    results maps entry_id to a tuple of SEASON_RESULT_COLUMNS values, entries missing from it earn nothing.
+    Only changed rows are written. Returns the number of entries changed.
+    """
+    with self:
+      old_results = {}
+      for row in self.query_all("SELECT entry_id, %s FROM season_results WHERE event_id=?" % ", ".join(SEASON_RESULT_COLUMNS), (event_id,)):
+        old_results[row['entry_id']] = tuple(row[key] for key in SEASON_RESULT_COLUMNS)
+
+      totals = {} # (season_name, driver_key, car_class) -> [points, events, first_name, last_name]
+      replaced = []
+      removed = []
+      for entry_id in set(old_results) | set(results):
+        old = old_results.get(entry_id)
+        new = results.get(entry_id)
+        if old == new:
+          continue
+        if old is not None:
+          total = totals.setdefault(old[:3], [0, 0, None, None])
+          total[0] -= old[5]
+          total[1] -= 1
+        if new is not None:
+          total = totals.setdefault(new[:3], [0, 0, None, None])
+          total[0] += new[5]
+          total[1] += 1
+          total[2:] = new[3:5]
+          replaced.append((entry_id, event_id) + tuple(new))
+        else:
+          removed.append((entry_id,))
+
+      cur = self.cursor()
+      if removed:
+        cur.executemany("DELETE FROM season_results WHERE entry_id=?", removed)
+      if replaced:
+        cur.executemany("INSERT OR REPLACE INTO season_results (entry_id, event_id, %s) VALUES (?,?,?,?,?,?,?,?)" % ", ".join(SEASON_RESULT_COLUMNS), replaced)
+      if totals:
+        cur.executemany("INSERT OR IGNORE INTO season_points (season_name, driver_key, car_class) VALUES (?,?,?)", totals.keys())
+        cur.executemany("UPDATE season_points SET points=points+?, events=events+?, first_name=COALESCE(?,first_name), last_name=COALESCE(?,last_name) WHERE season_name=? AND driver_key=? AND car_class=?",
+            [tuple(total) + key for key, total in totals.items()])
+        cur.execute("DELETE FROM season_points WHERE events <= 0")
+      return len(replaced) + len(removed)
+
+  def season_clear(self, season_name=None):
+    """ Remove the season tables rows of one season, or of every season """
+    with self:
+      if season_name is None:
+        self.execute("DELETE FROM season_results")
+        self.execute("DELETE FROM season_points")
+      else:
+        self.execute("DELETE FROM season_results WHERE season_name=?", (season_name,))
+        self.execute("DELETE FROM season_points WHERE season_name=?", (season_name,))
+
+  def season_names(self):
+    """ Season names of events that are not deleted, newest first """
+    return self.query_single_list("SELECT DISTINCT season_name FROM events WHERE season_name NOT NULL AND season_name != '' AND NOT deleted ORDER BY season_name DESC")
+
+  def season_standings(self, season_name):
+    """ season_points rows of a season ordered by car_class and points, best first """
+    return self.query_all("SELECT * FROM season_points WHERE season_name=? ORDER BY car_class, points DESC, events DESC, last_name, first_name", (season_name,))
+
+  def recalc_enqueue(self, kind, items, priority=RECALC_ADMIN):
+    """ Queue (id, event_id) items of a kind ('run', 'entry' or 'event') for the recalc mule
+
+    An item that is already queued keeps its place and takes the more urgent priority. Returns the number of items.
+    """
+    if items:
+      with self:
+        cur = self.cursor()
+        cur.executemany("INSERT OR IGNORE INTO recalc_queue (kind, id, event_id, priority) VALUES (?,?,?,?)", [(kind, item_id, event_id, priority) for item_id, event_id in items])
+        cur.executemany("UPDATE recalc_queue SET priority=? WHERE kind=? AND id=? AND priority>?", [(priority, kind, item_id, priority) for item_id, event_id in items])
+    return len(items)
+
+  def recalc_queue_next(self, limit):
+    """ (event_id, items) for up to limit queued items of the event holding the most urgent item
+
+    Items are ordered whole event recalcs first, then runs, then entries, so entries are scored from recalculated runs.
+    """
+    event_id = self.query_single("SELECT event_id FROM recalc_queue ORDER BY priority, rowid LIMIT 1")
+    if event_id is None:
+      return None, []
+    return event_id, self.query_all("SELECT kind, id, priority FROM recalc_queue WHERE event_id=? ORDER BY CASE kind WHEN 'event' THEN 0 WHEN 'run' THEN 1 ELSE 2 END, priority, rowid LIMIT ?", (event_id, limit))
+
+  def recalc_queue_remove(self, items):
+    """ Remove items returned by recalc_queue_next once they are done """
+    self.cursor().executemany("DELETE FROM recalc_queue WHERE kind=? AND id=?", [(item['kind'], item['id']) for item in items])
+
+  def recalc_queue_remove_event(self, event_id):
+    """ Remove every queued item of an event, returns the number removed """
+    self.execute("DELETE FROM recalc_queue WHERE event_id=?", (event_id,))
     return self.changes()
 
-  def set_run_recalc(self, run_id):
-    self.execute("UPDATE runs SET recalc=1 WHERE run_id=?", (run_id,))
+  def recalc_queue_count(self):
+    return self.query_single("SELECT count(*) FROM recalc_queue")
+
+  def latency_insert(self, time_id, event_id, channel, receive_ms=None):
+    """ Start the latency row of a timer impulse once its times row is inserted """
+    self.execute("INSERT OR REPLACE INTO latency (time_id, event_id, channel, receive_ms, insert_ms) VALUES (?,?,?,?,?)", (time_id, event_id, channel, receive_ms, monotonic_ms()))
+
+  def latency_match(self, time_id, run_id):
+    """ Record the run started or finished by a timer impulse, before the run is queued for recalc """
+    self.execute("UPDATE latency SET run_id=?, match_ms=? WHERE time_id=?", (run_id, monotonic_ms(), time_id))
+
+  def latency_recalc(self, event_id, run_ids, start_ms):
+    """ Record a recalc batch on the latency rows of its runs, or of every matched run of the event when run_ids is None """
+    end_ms = monotonic_ms()
+    if run_ids is None:
+      self.execute("UPDATE latency SET recalc_start_ms=?, recalc_end_ms=? WHERE event_id=? AND run_id NOT NULL AND recalc_end_ms IS NULL", (start_ms, end_ms, event_id))
+    elif run_ids:
+      self.cursor().executemany("UPDATE latency SET recalc_start_ms=?, recalc_end_ms=? WHERE run_id=? AND recalc_end_ms IS NULL", [(start_ms, end_ms, run_id) for run_id in run_ids])
+
+  def latency_render(self, event_id):
+    """ Record a scoreboard render on the latency rows of an event's recalculated runs that were not shown yet """
+    # checked with a read first so scoreboard requests only take the write lock when there is something to record
+    if self.query_single("SELECT 1 FROM latency WHERE event_id=? AND render_ms IS NULL AND recalc_end_ms NOT NULL LIMIT 1", (event_id,)):
+      # never wait on the timing mule or recalc, a later render records it instead
+      self.setbusytimeout(0)
+      try:
+        self.execute("UPDATE latency SET render_ms=? WHERE event_id=? AND render_ms IS NULL AND recalc_end_ms NOT NULL", (monotonic_ms(), event_id))
+      except apsw.BusyError:
+        pass
+      finally:
+        self.setbusytimeout(BUSY_TIMEOUT_MS)
+
+  def latency_prune(self, keep_rows=LATENCY_KEEP_ROWS):
+    """ Delete all but the newest keep_rows latency rows, returns the number deleted """
+    self.execute("DELETE FROM latency WHERE time_id <= (SELECT time_id FROM latency ORDER BY time_id DESC LIMIT 1 OFFSET ?)", (keep_rows,))
     return self.changes()
+
+  def latency_list(self, limit=1000, event_id=None):
+    """ Newest latency rows first """
+    if event_id is None:
+      return self.query_all("SELECT * FROM latency ORDER BY time_id DESC LIMIT ?", (limit,))
+    return self.query_all("SELECT * FROM latency WHERE event_id=? ORDER BY time_id DESC LIMIT ?", (event_id, limit))
+
+  def set_run_recalc(self, run_id, priority=RECALC_ADMIN):
+    with self:
+      event_id = self.query_single("SELECT event_id FROM runs WHERE run_id=?", (run_id,))
+      if event_id is None:
+        return 0
+      self.execute("UPDATE runs SET recalc=1 WHERE run_id=?", (run_id,))
+      return self.recalc_enqueue('run', [(run_id, event_id)], priority)
+
+  def set_entry_recalc(self, entry_id, priority=RECALC_ADMIN):
+    with self:
+      event_id = self.query_single("SELECT event_id FROM entries WHERE entry_id=?", (entry_id,))
+      if event_id is None:
+        return 0
+      self.execute("UPDATE entries SET recalc=1 WHERE entry_id=?", (entry_id,))
+      return self.recalc_enqueue('entry', [(entry_id, event_id)], priority)
+
+  def set_class_run_recalc(self, event_id, car_class, run_number=None, priority=RECALC_ADMIN):
+    """ Queue entries of a car_class with a scored DNF run, at run_number if given, for recalc
+
+    Their DNF bogey time depends on the slowest time of the class for that run number.
+    """
+    sql = "SELECT entry_id FROM entries WHERE event_id=? AND car_class=? AND NOT deleted AND entry_id IN (SELECT entry_id FROM runs WHERE event_id=? AND state='scored' AND dns_dnf > 0 AND NOT deleted"
+    with self:
+      if run_number is None:
+        entry_ids = self.query_single_list(sql + ")", (event_id, car_class, event_id))
+      else:
+        entry_ids = self.query_single_list(sql + " AND run_number=?)", (event_id, car_class, event_id, run_number))
+      self.cursor().executemany("UPDATE entries SET recalc=1 WHERE entry_id=?", [(entry_id,) for entry_id in entry_ids])
+      return self.recalc_enqueue('entry', [(entry_id, event_id) for entry_id in entry_ids], priority)
+
+  def set_event_recalc(self, event_id, priority=RECALC_BULK):
+    """ Queue a whole event recalc, its runs and entries are flagged until it is done """
+    with self:
+      self.execute("UPDATE runs SET recalc=1 WHERE event_id=?", (event_id,))
+      self.execute("UPDATE entries SET recalc=1 WHERE event_id=?", (event_id,))
+      return self.recalc_enqueue('event', [(event_id, event_id)], priority)
   
   def entry_run_group_update(self, event_id, car_class, run_group):
     self.execute("UPDATE entries SET run_group=? WHERE event_id=? AND car_class=?", (run_group, event_id, car_class))
     return self.changes()
 
-  def run_list(self, event_id=None, entry_id=None, state=None, max_run_id=None, limit=None, offset=None, sort='A'):
-    sql = "SELECT * FROM runs WHERE deleted=0 "
-    args = []
+  def _run_filter(self, event_id, entry_id, state, max_run_id):
+    # returns the statement shape and bindings shared by run_list and run_count
     if event_id is None and entry_id is None:
       raise Exception("Oops! missing event_id or entry_id")
+    args = []
     if event_id is not None:
-      sql += " AND event_id=? "
       args.append(event_id)
     if entry_id in ('noassign', 'null'):
-      sql += " AND entry_id ISNULL "
+      entry_filter = 'null'
     elif entry_id not in (None, 'all'):
-      sql += " AND entry_id=? "
+      entry_filter = 'value'
       args.append(entry_id)
+    else:
+      entry_filter = None
     if isinstance(state, types.StringTypes):
-      sql += " AND state = ? "
-      args.append(state)
-    elif isinstance(state, (list,tuple)) and len(state) > 0:
-      sql += " AND state in (" + ','.join('?'*len(state)) + ") "
-      args.extend(state)
+      state = (state,)
+    elif not isinstance(state, (list,tuple)):
+      state = ()
+    args.extend(state)
     if max_run_id is not None:
-      sql += " AND run_id<=? "
       args.append(max_run_id)
-    if sort in ('d','D'):
-      sql += " ORDER BY run_id DESC "
-    elif sort in ('a','A'):
-      sql += " ORDER BY run_id ASC "
+    return (event_id is not None, entry_filter, len(state), max_run_id is not None), args
+
+  def run_list(self, event_id=None, entry_id=None, state=None, max_run_id=None, limit=None, offset=None, sort='A'):
+    shape, args = self._run_filter(event_id, entry_id, state, max_run_id)
     if limit:
-      sql += " LIMIT ? "
       args.append(limit)
       if offset:
-        sql += " OFFSET ? "
         args.append(offset)
-    return self.query_all(sql, args)
+    return self.query_all(run_list_sql(False, *(shape + (sort, bool(limit), bool(limit and offset)))), args)
 
   def run_count(self, event_id=None, entry_id=None, state=None, max_run_id=None):
-    sql = "SELECT count(*) FROM runs WHERE deleted=0 "
-    args = []
-    if event_id is None and entry_id is None:
-      raise Exception("Oops! missing event_id or entry_id")
-    if event_id is not None:
-      sql += " AND event_id=? "
-      args.append(event_id)
-    if entry_id in ('noassign', 'null'):
-      sql += " AND entry_id ISNULL "
-    elif entry_id not in (None, 'all'):
-      sql += " AND entry_id=? "
-      args.append(entry_id)
-    if isinstance(state, types.StringTypes):
-      sql += " AND state = ? "
-      args.append(state)
-    elif isinstance(state, (list,tuple)) and len(state) > 0:
-      sql += " AND state in (" + ','.join('?'*len(state)) + ") "
-      args.extend(state)
-    if max_run_id is not None:
-      sql += " AND run_id<=? "
-      args += [max_run_id]
-    return self.query_single(sql, args)
+    shape, args = self._run_filter(event_id, entry_id, state, max_run_id)
+    return self.query_single(run_list_sql(True, *(shape + (None, False, False))), args)
+
+  def run_renumber(self, entry_id, from_run_id=None):
+    """ Renumber an entry's runs in one ordered pass, call after a run is added, tossed out, reassigned or deleted
+
+    Only runs at or after from_run_id whose run_number changed are written. Returns the number of runs updated.
+    """
+    if entry_id in (None, 'None'):
+      return 0
+    with self:
+      updates = []
+      for run, run_number in run_numbers(self.query_all("SELECT run_id, state, run_number FROM runs WHERE entry_id=? AND NOT deleted ORDER BY run_id", (entry_id,))):
+        if (from_run_id is None or run['run_id'] >= from_run_id) and run['run_number'] != run_number:
+          updates.append((run_number, run['run_id']))
+      if updates:
+        self.cursor().executemany("UPDATE runs SET run_number=? WHERE run_id=?", updates)
+      return len(updates)
 
   def run_started(self, event_id, time_ms, entry_id):
     self.cursor().execute("INSERT INTO runs (event_id, start_time_ms, entry_id, state) VALUES (?,?,?,'started')", (event_id, time_ms, entry_id))
@@ -409,29 +849,84 @@ class ScoringDatabase(apsw.Connection):
 
   def run_finished(self, event_id, time_ms):
     with self:
-      row = self.query_one("SELECT run_id FROM runs WHERE deleted=0 AND event_id=? AND NOT start_time_ms ISNULL AND start_time_ms > 0 AND start_time_ms <= ? AND state='started' ORDER BY run_id ASC LIMIT 1", (event_id, time_ms))
+      row = self.query_one("SELECT run_id FROM runs WHERE NOT deleted AND event_id=? AND NOT start_time_ms ISNULL AND start_time_ms > 0 AND start_time_ms <= ? AND state='started' ORDER BY run_id ASC LIMIT 1", (event_id, time_ms))
       if row is None:
         return None
       self.execute("UPDATE runs SET finish_time_ms=?, state='finished' WHERE run_id = ?", (time_ms, row['run_id']))
       return row['run_id']
 
-  def run_split_1(self, event_id, time_ms):
-    with self:
-      row = self.query_one("SELECT run_id FROM runs WHERE deleted=0 AND event_id=? AND NOT start_time_ms ISNULL AND start_time_ms > 0 AND start_time_ms <= ? AND state='started' AND split_1_time_ms ISNULL ORDER BY run_id ASC LIMIT 1", (event_id, time_ms))
-      if row is None:
-        return None
-      self.execute("UPDATE runs SET split_1_time_ms=? WHERE run_id = ?", (time_ms, row['run_id']))
+  def run_open_list(self, event_id):
+    """ Runs on course (started, not yet finished) in start order, used to rebuild the timing mule's course tracker """
+    return self.query_all("SELECT run_id, start_time_ms, split_1_time_ms, split_2_time_ms FROM runs WHERE NOT deleted AND event_id=? AND NOT start_time_ms ISNULL AND start_time_ms > 0 AND state='started' ORDER BY run_id ASC", (event_id,))
+
+  def run_finish(self, run_id, time_ms):
+    """ Finish a run matched by the course tracker, returns False if it is no longer on course """
+    self.execute("UPDATE runs SET finish_time_ms=?, state='finished' WHERE run_id=? AND state='started' AND NOT deleted", (time_ms, run_id))
+    return self.changes() > 0
+
+  def run_split(self, run_id, split, time_ms):
+    """ Set split_1_time_ms or split_2_time_ms (split 1 or 2) of a run matched by the course tracker, returns False if it is no longer on course """
+    self.execute("UPDATE runs SET split_%d_time_ms=? WHERE run_id=? AND state='started' AND NOT deleted" % int(split), (time_ms, run_id))
+    return self.changes() > 0
 
-  def run_split_2(self, event_id, time_ms):
+  def course_version(self):
+    return self.reg_get_int('.course_version', 0)
+
+  def course_changed(self):
+    """ Runs were edited outside the timing mule, its course tracker reloads on the next impulse """
     with self:
-      row = self.query_one("SELECT run_id FROM runs WHERE deleted=0 AND event_id=? AND NOT start_time_ms ISNULL AND start_time_ms > 0 AND start_time_ms <= ? AND state='started' AND NOT split_1_time_ms ISNULL AND split_2_time_ms ISNULL ORDER BY run_id ASC LIMIT 1", (event_id, time_ms))
-      if row is None:
-        return None
-      self.execute("UPDATE runs SET split_2_time_ms=? WHERE run_id = ?", (time_ms, row['run_id']))
+      self.reg_set('.course_version', self.course_version() + 1)
 
 
 #######################################
-#######################################
 
+class ConnectionPool(object):
+  """ Per process pool of warm ScoringDatabase connections
+
+  Connections keep their prepared statement cache and registry snapshot between
+  requests. The schema is only checked by the first connection opened in each
+  process, connections are never shared across a fork.
+  """
+
+  def __init__(self, path, max_idle=4, logger=None):
+    self.path = path
+    self.max_idle = max_idle
+    self.log = logger if logger is not None else logging.getLogger(__name__)
+    self._lock = threading.Lock()
+    self._idle = []
+    self._pid = None
+    self._schema_checked = False
+
+  def acquire(self):
+    with self._lock:
+      if self._pid != os.getpid():
+        # new process (eg. forked uwsgi worker), idle connections belong to the parent
+        self._idle = []
+        self._pid = os.getpid()
+        self._schema_checked = False
+      if not self._schema_checked:
+        # open while holding the lock so other threads wait for a schema upgrade,
+        # a failed open leaves the check to the next acquire
+        db = ScoringDatabase(self.path, logger=self.log, check_schema=True)
+        self._schema_checked = True
+        return db
+      if self._idle:
+        return self._idle.pop()
+    return ScoringDatabase(self.path, logger=self.log, check_schema=False)
+
+  def release(self, db):
+    try:
+      db.reset()
+    except apsw.Error:
+      self.log.exception("unable to reset connection")
+      db.close()
+      return
+    with self._lock:
+      if self._pid == os.getpid() and len(self._idle) < self.max_idle:
+        self._idle.append(db)
+        return
+    db.close()
 
 
+#######################################
+#######################################
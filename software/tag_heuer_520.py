@@ -1,52 +1,164 @@
 import logging
 logging.basicConfig()
+import json
+from collections import namedtuple
 from serial_handler import SerialHandler, serial_wrapper
+from util import monotonic_ms
 
 BAUDRATE = 9600
 
+RECORD_LENGTH = 30 # characters in a time record, not counting the '\r'
+
+# kind is the first two characters of the line, eg. 'T ' for a time impulse, 'T-' and 'T+' for times
+# removed or added on the timer, number, channel and time_ms are None for records that are not times
+TimeRecord = namedtuple('TimeRecord', 'kind number channel time_ms line')
+
+#######################################
+
+def parse_time(line):
+  """ time_ms of a time record, None if the time field is invalid """
+  time_ms = 0
+  try:
+    if line[15:17].strip() != '':
+      time_ms += (60*60*1000) * int(line[15:17])
+    if line[18:20].strip() != '':
+      time_ms += (60*1000) * int(line[18:20])
+    time_ms += 1000 * int(line[21:23])
+    time_ms += int(line[24:27])
+  except ValueError:
+    return None
+  return time_ms
+
+
+def parse_record(line):
+  """ TimeRecord for one line without its '\r', None for a malformed time record """
+  kind = line[0:2]
+  if not kind.startswith('T'):
+    return TimeRecord(kind, None, None, None, line)
+  if len(line) != RECORD_LENGTH:
+    logging.debug('bad time event format')
+    return None
+  time_ms = parse_time(line)
+  if time_ms is None:
+    return None
+  return TimeRecord(kind, line[2:12].strip(), line[12:14].strip(), time_ms, line)
+
+
+def parse_frames(buffer, capture=None):
+  """ Records of every complete '\r' terminated line in a bytearray
+
+  Complete lines are removed from the buffer, a partial line is left for the next chunk.
+  Every line is appended to the capture log, if given, before it is parsed.
+  """
+  end = buffer.rfind('\r')
+  if end < 0:
+    return []
+  lines = str(buffer[:end]).split('\r')
+  del buffer[:end + 1]
+  records = []
+  for line in lines:
+    line = line.lstrip('\n')
+    if line:
+      logging.debug(repr(line))
+      if capture is not None:
+        capture.append(line)
+      record = parse_record(line)
+      if record is not None:
+        records.append(record)
+  return records
+
+#######################################
+
+# channel names of time records by timer input, the timer sends '1', 'M1' or '01' depending on its mode
+CHANNEL_KINDS = {
+  '1':'start', 'M1':'start', '01':'start',
+  '2':'finish', 'M2':'finish', '02':'finish',
+  '3':'split_1', 'M3':'split_1', '03':'split_1',
+  '4':'split_2', 'M4':'split_2', '04':'split_2',
+}
+
+# seconds after an accepted impulse during which the same input is ignored, registry 'deadtime_<kind>'
+# starts are a few seconds apart at least, finishes and splits of cars on course can be close together
+# so they only get a debounce long enough for a bouncing photocell
+DEADTIME_DEFAULTS = {'start':2, 'finish':0.3, 'split_1':0.3, 'split_2':0.3}
+
+SUPPRESSED_RECENT = 20 # suppressed impulses kept per event for the timer data page
+
+class DeadTimeFilter(object):
+  """ Drops impulses that follow the last accepted impulse of their input within its dead time
+
+  A bouncing photocell then leaves one impulse instead of a burst of times rows, false starts and recalcs.
+  Uses the timer's time_ms so a backlog read in one chunk is filtered like live impulses.
+  Suppressed impulses are only counted here, write_suppressed adds them to the event registry.
+  """
+
+  def __init__(self):
+    self.deadtime_ms = dict((kind, int(seconds * 1000)) for kind, seconds in DEADTIME_DEFAULTS.items())
+    self.last_ms = {} # kind -> time_ms of the last accepted impulse
+    self.suppressed = {} # kind -> count not yet flushed
+    self.recent = [] # (kind, time_ms) not yet flushed
+
+  def load(self, db):
+    """ Read the dead times from the registry, 0 turns the filter off for an input """
+    reg = db.reg_get_many(dict(('deadtime_%s' % kind, (float, seconds)) for kind, seconds in DEADTIME_DEFAULTS.items()))
+    for kind in DEADTIME_DEFAULTS:
+      self.deadtime_ms[kind] = max(int(reg['deadtime_%s' % kind] * 1000), 0)
+
+  def accept(self, record):
+    kind = CHANNEL_KINDS.get(record.channel)
+    if kind is None:
+      return True
+    last_ms = self.last_ms.get(kind)
+    # a time before the last one is a new timer day or a reset timer, not a bounce
+    if last_ms is not None and 0 <= record.time_ms - last_ms < self.deadtime_ms[kind]:
+      self.suppressed[kind] = self.suppressed.get(kind, 0) + 1
+      self.recent.append((kind, record.time_ms))
+      logging.info("%s impulse suppressed: %r", kind, record.line)
+      return False
+    self.last_ms[kind] = record.time_ms
+    return True
+
+  def take(self):
+    """ Returns and clears the (suppressed, recent) not yet written, see write_suppressed """
+    taken = (self.suppressed, self.recent)
+    self.suppressed = {}
+    self.recent = []
+    return taken
+
+
+def write_suppressed(db, suppressed, recent):
+  """ Add suppressed counts and impulses taken from a DeadTimeFilter to the active event's hidden registry keys """
+  event_id = db.reg_get('active_event_id')
+  if event_id is None:
+    return
+  with db:
+    keys = dict(('.suppressed_%s' % kind, (int, 0)) for kind in suppressed)
+    keys['.suppressed_recent'] = None
+    reg = db.reg_get_many(keys, event_id=event_id)
+    values = dict(('.suppressed_%s' % kind, reg['.suppressed_%s' % kind] + count) for kind, count in suppressed.items())
+    values['.suppressed_recent'] = json.dumps((json.loads(reg['.suppressed_recent'] or '[]') + recent)[-SUPPRESSED_RECENT:])
+    db.reg_set_many(values, event_id=event_id)
+
+#######################################
+
 class TagHeuer520(SerialHandler):
   def __init__(self, port=None):
+    self.receive_ms = None # util.monotonic_ms when the last chunk was received
+    self.capture = None # timer_capture.CaptureLog for the raw lines, see tag_heuer_520_mule.py
     super(TagHeuer520,self).__init__(port,BAUDRATE)
-    self.line_buffer = ""
 
   @serial_wrapper
-  def read(self):
-    """ Read and parse time from serial port """
-    c = self.serial.read(1)
-    while c != '':
-      if c == '\r':
-        logging.debug(repr(self.line_buffer))
-        result = None
-        # TODO add ability to handle other types of time events eg. T-, T+, etc.
-        if self.line_buffer.startswith('T ') and len(self.line_buffer) == 30:
-          channel = self.line_buffer[12:14].strip()
-          time_ms = 0
-          try:
-            if self.line_buffer[15:17].strip() != '':
-                time_ms += (60*60*1000) * int(self.line_buffer[15:17])
-            if self.line_buffer[18:20].strip() != '':
-                time_ms += (60*1000) * int(self.line_buffer[18:20])
-            time_ms += 1000 * int(self.line_buffer[21:23])
-            time_ms += int(self.line_buffer[24:27])
-          except ValueError:
-            self.line_buffer = ""
-            return None
-          result = (channel, time_ms)
-        else:
-            logging.debug('bad time event format')
-        self.line_buffer = ""
-        return result
-      else:
-        self.line_buffer += c
-      c = self.serial.read(1)
-    return None
+  def read_records(self):
+    """ Read everything waiting on the port, returns the complete records received """
+    if self.read_chunk():
+      self.receive_ms = monotonic_ms()
+      return parse_frames(self.buffer, self.capture)
+    return []
 
 
 if __name__ == "__main__":
   import sys
   timer = TagHeuer520(sys.argv[1])
   while True:
-    t = timer.read()
-    if t:
-      print t
-
+    for record in timer.read_records() or []:
+      print record
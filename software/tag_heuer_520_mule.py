@@ -1,12 +1,20 @@
 import logging
-import uwsgi
+try:
+  import uwsgi
+except ImportError:
+  uwsgi = None # imported outside of uwsgi by the timer_capture.py replay command
 import threading
-from sql_db import ScoringDatabase
+import Queue
+import apsw
+from sql_db import ScoringDatabase, RECALC_LIVE
 from time import sleep, time
 import datetime
+from collections import deque
 import scoring_rules
+from scoring_rules import get_event, get_rules
 
-from tag_heuer_520 import TagHeuer520
+from tag_heuer_520 import TagHeuer520, DeadTimeFilter, CHANNEL_KINDS, write_suppressed
+from timer_capture import CaptureLog, capture_path
 from util import play_sound
 
 try:
@@ -15,121 +23,264 @@ except ImportError:
   raise ImportError("Unable to load scoring_config.py, please reference install instructions!")
 
 DB_POLL_INTERVAL = 3
-
-DEFAULT_START_DEADTIME_INTERVAL = 10
-DEFAULT_FINISH_DEADTIME_INTERVAL = 10
-DEFAULT_SPLIT_1_DEADTIME_INTERVAL = 10
-DEFAULT_SPLIT_2_DEADTIME_INTERVAL = 10
+DB_BUSY_RETRY_INTERVAL = 1 # seconds before an impulse is applied again after the database stayed locked
 
 #######################################
 
 def get_db():
   return ScoringDatabase(config.SCORING_DB_PATH)
 
-def get_event(db):
-  active_event_id = db.reg_get('active_event_id')
-  if db.event_exists(active_event_id):
-    return db.select_one('events', event_id=active_event_id)
+#######################################
 
-def get_rules(event):
-  if event is None:
-    return None
-  rule_sets = scoring_rules.get_rule_sets()
-  if event['rule_set'] in rule_sets:
-    rules = rule_sets[event['rule_set']]()
-    if event['max_runs'] is not None:
-      rules.max_runs = event['max_runs']
-    if event['drop_runs'] is not None:
-      rules.drop_runs = event['drop_runs']
-    return rules
-  else:
+class CourseTracker(object):
+  """ Cars on course for the active event, oldest start first
+
+  Finish and split impulses are matched here instead of searching the runs table.
+  The database stays authoritative, the tracker is rebuilt when the event or
+  '.course_version' (bumped by ScoringDatabase.course_changed on admin edits) changes.
+  """
+
+  def __init__(self):
+    self.runs = deque() # dicts of run_id, start_time_ms, split_1_time_ms, split_2_time_ms
+    self.event_id = None
+    self.version = None
+
+  def load(self, db, event_id):
+    self.runs = deque(dict(run) for run in db.run_open_list(event_id))
+    self.event_id = event_id
+    self.version = db.course_version()
+    logging.debug("course tracker loaded, %d on course", len(self.runs))
+
+  def check(self, db, event_id):
+    """ Reload if the event changed or runs were edited since the last load """
+    if event_id != self.event_id or db.course_version() != self.version:
+      self.load(db, event_id)
+
+  def started(self, run_id, time_ms):
+    self.runs.append({'run_id':run_id, 'start_time_ms':time_ms, 'split_1_time_ms':None, 'split_2_time_ms':None})
+
+  def match(self, time_ms, split=None):
+    """ Oldest run on course started before time_ms, for split 1/2 the oldest that has not passed that split yet """
+    for run in self.runs:
+      if run['start_time_ms'] > time_ms:
+        continue
+      if split == 1 and run['split_1_time_ms'] is not None:
+        continue
+      if split == 2 and (run['split_1_time_ms'] is None or run['split_2_time_ms'] is not None):
+        continue
+      return run
     return None
 
+  def finished(self, run):
+    self.runs.remove(run)
+
+course = CourseTracker()
+
 #######################################
 
-def handle_start_event(db, event, rules, time_ms, time_id):
-  next_entry_id = db.reg_get_int('next_entry_id')
-  db.reg_set('next_entry_id', None)
-  db.reg_set('next_entry_msg', None)
-  disable_start = db.reg_get_int('disable_start', 0)
+class EventContext(object):
+  """ Active event row and its rules, read again only after another connection commits """
+
+  def __init__(self):
+    self.data_version = None
+    self.event = None
+    self.rules = None
+
+  def get(self, db):
+    data_version = db.data_version()
+    if data_version != self.data_version:
+      self.event = get_event(db)
+      self.rules = get_rules(self.event)
+      self.data_version = data_version
+    return self.event, self.rules
+
+context = EventContext()
+
+#######################################
 
-  if not disable_start:
+# the handlers run inside the impulse's transaction, they return (run_id, sound) where
+# run_id is the run the impulse was matched to (None if invalid) and sound is played after the commit.
+# replay is True when timer_capture.py replays the capture log, starts are then left unassigned
+
+def handle_start_event(db, event, rules, time_ms, time_id, replay=False):
+  reg = db.reg_get_many({'next_entry_id':int, 'disable_start':(int,0)})
+  if replay:
+    next_entry_id = None
+  else:
+    next_entry_id = reg['next_entry_id']
+    db.reg_set_many({'next_entry_id':None, 'next_entry_msg':None})
+
+  if not reg['disable_start']:
     run_id = db.run_started(event['event_id'], time_ms, next_entry_id)
     if run_id is None:
-      db.update('times', time_id, invalid=True)
       logging.info("Start [FALSE]: %r", time_id)
-      play_sound('sounds/FalseStart.wav')
-    else:
-      db.set_run_recalc(run_id)
-      uwsgi.mule_msg('recalc')
-      logging.info("Start: %r", time_id)
-      play_sound('sounds/CarStarted.wav')
+      return None, 'sounds/FalseStart.wav'
+    if time_ms > 0:
+      course.started(run_id, time_ms)
+    logging.info("Start: %r", time_id)
+    return run_id, 'sounds/CarStarted.wav'
   else:
-    db.update('times', time_id, invalid=True)
     logging.info("Start [DISABLED]: %r", time_id)
-    play_sound('sounds/FalseStart.wav')
+    return None, 'sounds/FalseStart.wav'
+
+def match_run(db, event, time_ms, split=None):
+  """ Write a finish (split None) or split time to the matching run on course, returns its run_id or None """
+  for attempt in range(2):
+    run = course.match(time_ms, split)
+    if run is None:
+      return None
+    if split is None:
+      updated = db.run_finish(run['run_id'], time_ms)
+    else:
+      updated = db.run_split(run['run_id'], split, time_ms)
+    if updated:
+      if split is None:
+        course.finished(run)
+      else:
+        run['split_%d_time_ms' % split] = time_ms
+      return run['run_id']
+    # the run was edited since the tracker was loaded
+    logging.warning("course tracker out of date, reloading")
+    course.load(db, event['event_id'])
+  return None
 
-def handle_finish_event(db, event, rules, time_ms, time_id):
+def handle_finish_event(db, event, rules, time_ms, time_id, replay=False):
   disable_finish = db.reg_get_int('disable_finish', 0)
 
   if not disable_finish:
-    run_id = db.run_finished(event['event_id'], time_ms)
+    run_id = match_run(db, event, time_ms)
     if run_id is None:
-      db.update('times', time_id, invalid=True)
       logging.info("Finish [FALSE]: %r", time_id)
-      play_sound('sounds/FalseFinish.wav')
-    else:
-      db.set_run_recalc(run_id)
-      uwsgi.mule_msg('recalc')
-      logging.info("Finish: %r", time_id)
-      play_sound('sounds/CarFinished.wav')
+      return None, 'sounds/FalseFinish.wav'
+    logging.info("Finish: %r", time_id)
+    return run_id, 'sounds/CarFinished.wav'
   else:
-    db.update('times', time_id, invalid=True)
     logging.info("Finish [DISABLED]: %r", time_id)
-    play_sound('sounds/FalseFinish.wav')
+    return None, 'sounds/FalseFinish.wav'
+
+def handle_split_event(db, event, rules, time_ms, time_id, split):
+  if db.reg_get_int('disable_split_%d' % split, 0):
+    logging.info("Split %d [DISABLED]: %r", split, time_id)
+    return None, None
+
+  # sector times are filled in by the recalc
+  run_id = match_run(db, event, time_ms, split)
+  if run_id is None:
+    logging.info("Split %d [FALSE]: %r", split, time_id)
+  else:
+    logging.info("Split %d: %r", split, time_id)
+  return run_id, None
+
+def handle_split_1_event(db, event, rules, time_ms, time_id, replay=False):
+  return handle_split_event(db, event, rules, time_ms, time_id, 1)
 
-def handle_split_1_event(db, event, rules, time_ms, time_id):
-  disable_split_1 = db.reg_get_int('disable_split_1', 0)
-  # TODO
-  logging.warning("SPLIT 1 not implemented")
+def handle_split_2_event(db, event, rules, time_ms, time_id, replay=False):
+  return handle_split_event(db, event, rules, time_ms, time_id, 2)
 
-def handle_split_2_event(db, event, rules, time_ms, time_id):
-  disable_split_2 = db.reg_get_int('disable_split_2', 0)
-  # TODO
-  logging.warning("SPLIT 2 not implemented")
+KIND_HANDLERS = {
+  'start':handle_start_event,
+  'finish':handle_finish_event,
+  'split_1':handle_split_1_event,
+  'split_2':handle_split_2_event,
+}
 
 #######################################
 
-def handle_time_event(db, channel, time_ms):
-  event = get_event(db)
-  rules = get_rules(event)
+def handle_time_event(db, channel, time_ms, receive_ms=None, replay=False):
+  """ Record one timer impulse and its run in a single transaction, the recalc is queued in the same commit """
+  event, rules = context.get(db)
 
   if event is None:
     logging.error("invalid event")
-    play_sound('sounds/FalseStart.wav')
+    if not replay:
+      play_sound('sounds/FalseStart.wav')
     return
   if rules is None:
     logging.error("invalid event rule set")
-    play_sound('sounds/FalseStart.wav')
+    if not replay:
+      play_sound('sounds/FalseStart.wav')
     return
 
-  time_id = db.insert('times', event_id=event["event_id"], channel=channel, time_ms=time_ms)
-
-  if channel in ('1', 'M1', '01'): # start
-    logging.info("start event")
-    handle_start_event(db, event, rules, time_ms, time_id)
-  elif channel in ('2', 'M2', '02'): # finish
-    logging.info("finish event")
-    handle_finish_event(db, event, rules, time_ms, time_id)
-  elif channel in ('3', 'M3', '03'): # split 1
-    logging.info("split_1 event")
-    handle_split_1_event(db, event, rules, time_ms, time_id)
-  elif channel in ('4', 'M4', '04'): # split 2
-    logging.info("split_2 event")
-    handle_split_2_event(db, event, rules, time_ms, time_id)
-  else:
+  handler = KIND_HANDLERS.get(CHANNEL_KINDS.get(channel))
+  if handler is None:
     logging.error("bad channel, %r", channel)
 
+  try:
+    with db:
+      course.check(db, event['event_id'])
+      time_id = db.insert('times', event_id=event["event_id"], channel=channel, time_ms=time_ms)
+      db.latency_insert(time_id, event['event_id'], channel, receive_ms)
+      if handler is None:
+        return
+      run_id, sound = handler(db, event, rules, time_ms, time_id, replay)
+      if run_id is None:
+        db.update('times', time_id, invalid=True)
+      else:
+        db.latency_match(time_id, run_id)
+        db.set_run_recalc(run_id, RECALC_LIVE)
+  except:
+    # rolled back, the tracker may hold a start or finish that was never committed
+    course.version = None
+    raise
+
+  if replay:
+    return
+  if run_id is not None:
+    uwsgi.mule_msg('recalc')
+  if sound is not None:
+    play_sound(sound)
+
+
+class ImpulseApplier(threading.Thread):
+  """ Applies time impulses to the database in the order they were received
+
+  The serial port is read on another thread, a busy database only delays this queue.
+  Impulses are already in the capture log, see timer_capture.py. Every database
+  write of the timing mule goes through this queue, also the suppressed impulse counts.
+  """
+
+  def __init__(self):
+    super(ImpulseApplier,self).__init__(name='impulse_applier')
+    self.daemon = True
+    self.queue = Queue.Queue() # (function, args, description), called as function(db, *args)
+
+  def submit(self, record, receive_ms):
+    self.queue.put((handle_time_event, (record.channel, record.time_ms, receive_ms), "time impulse %r, replay it from the capture log" % record.line))
+
+  def submit_suppressed(self, deadtime):
+    """ Queue the counts of a DeadTimeFilter for write_suppressed, if it suppressed anything """
+    if deadtime.suppressed:
+      self.queue.put((write_suppressed, deadtime.take(), "suppressed impulse counts"))
+
+  def run(self):
+    db = get_db()
+    event = get_event(db)
+    if event is not None:
+      course.load(db, event['event_id'])
+    while True:
+      function, args, description = self.queue.get()
+      while True:
+        try:
+          function(db, *args)
+        except apsw.BusyError:
+          logging.warning("database busy, %d impulses waiting", self.queue.qsize() + 1)
+          sleep(DB_BUSY_RETRY_INTERVAL)
+          continue
+        except Exception:
+          logging.exception("unable to apply %s", description)
+        break
+
+applier = ImpulseApplier() # started by the mule
+
+
+def open_capture_log():
+  path = capture_path(config)
+  try:
+    return CaptureLog(path)
+  except IOError:
+    logging.exception("unable to open timer capture log %r", path)
+    return None
+
 
 #######################################
 
@@ -137,29 +288,31 @@ if __name__ == '__main__':
   logging.warning("start tag heuer 520 mule")
   db = get_db()
   tag_heuer = TagHeuer520()
+  tag_heuer.capture = open_capture_log()
+  applier.start()
   open_state = True
   port = None
   
   poll_time = 0
-  start_dead_time = 0
-  finish_dead_time = 0
-  split_1_dead_time = 0
-  split_2_dead_time = 0
+  deadtime = DeadTimeFilter()
 
   while True:
     if poll_time < time():
       poll_time = time() + DB_POLL_INTERVAL
       port = db.reg_get('serial_port_tag_heuer')
+      deadtime.load(db)
+      applier.submit_suppressed(deadtime)
 
     if tag_heuer.is_open() and tag_heuer.port != port:
       tag_heuer.close()
     elif tag_heuer.is_open():
-      time_data = tag_heuer.read() # None or (channel, time_ms)
-      if time_data is not None:
-        channel, time_ms = time_data
-        handle_time_event(db, channel, time_ms)
-      else:
-        sleep(0.1)
+      # waits up to the port timeout, a backlog comes back as one chunk of records
+      for record in tag_heuer.read_records() or []:
+        if record.kind == 'T ':
+          if deadtime.accept(record):
+            applier.submit(record, tag_heuer.receive_ms)
+        else:
+          logging.info("timer record ignored: %r", record.line)
     elif port is not None and tag_heuer.open(port):
       db.reg_set('tag_heuer_status', 'open')
       logging.warning("tag_heuer_status: open")
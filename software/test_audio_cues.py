@@ -0,0 +1,72 @@
+""" Audio cue worker tests, played on the null backend
+
+  python -m unittest test_audio_cues
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from time import time
+
+from audio_cues import CueWorker, NullBackend, CUE_QUEUE_MAX, CUE_MERGE_INTERVAL
+
+#######################################
+
+class CueWorkerTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    sounds = dict((name, '\0\0\0\0' * 100) for name in ('CarStarted.wav', 'CarFinished.wav', 'FalseStart.wav', 'FalseFinish.wav'))
+    self.worker = CueWorker(NullBackend(), sounds=sounds, socket_path=os.path.join(self.tmp_dir, 'cues.sock'))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def play_all(self):
+    while self.worker.play_next(0):
+      pass
+    return self.worker.backend.played
+
+  def test_repeated_cue_is_merged(self):
+    self.worker.request('CarStarted.wav')
+    self.worker.request('CarStarted.wav')
+    self.worker.request('CarFinished.wav')
+    self.assertEqual(self.play_all(), ['CarStarted.wav', 'CarFinished.wav'])
+    self.assertEqual((self.worker.played_count, self.worker.merged_count, self.worker.dropped_count), (2, 1, 0))
+
+  def test_cue_requested_while_it_starts_playing_is_merged(self):
+    worker = self.worker
+    requests = ['CarStarted.wav']
+    class RequestingBackend(NullBackend):
+      # the timer sends the same impulse again while the cue is playing
+      def play(self, name, data):
+        NullBackend.play(self, name, data)
+        for name in requests:
+          worker.request(name)
+    worker.backend = RequestingBackend()
+    worker.request('CarStarted.wav')
+    self.assertEqual(self.play_all(), ['CarStarted.wav'])
+    self.assertEqual((worker.played_count, worker.merged_count), (1, 1))
+
+    # requested again once the cue has played for CUE_MERGE_INTERVAL it plays again
+    requests[:] = []
+    worker.playing = ('CarStarted.wav', time() - CUE_MERGE_INTERVAL)
+    worker.request('CarStarted.wav')
+    worker.playing = None
+    self.assertEqual(self.play_all(), ['CarStarted.wav', 'CarStarted.wav'])
+    self.assertEqual((worker.played_count, worker.merged_count), (2, 1))
+
+  def test_oldest_cue_is_dropped(self):
+    names = ['CarStarted.wav', 'CarFinished.wav', 'FalseStart.wav', 'FalseFinish.wav'][:CUE_QUEUE_MAX + 1]
+    for name in names:
+      self.worker.request(name)
+    self.assertEqual(self.play_all(), names[1:])
+    self.assertEqual((self.worker.played_count, self.worker.merged_count, self.worker.dropped_count), (CUE_QUEUE_MAX, 0, 1))
+
+  def test_unknown_cue_is_ignored(self):
+    self.worker.request('Missing.wav')
+    self.assertEqual(self.play_all(), [])
+    self.assertIsNone(self.worker.play_next(0))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,325 @@
+""" Scoring path equivalence tests
+
+Checks on generated events that DefaultRules.recalc_event gives the same runs and
+entries as recalc_run for every run followed by recalc_entry for every entry, and
+that the NumPy scoring backend (scoring_vector.py) gives the same results as the
+python path, for every rule set.
+
+  python -m unittest test_scoring
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+# sql_db opens schema_versions/ relative to the working directory, like the apps do
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import sql_db
+import scoring_rules
+import scoring_vector
+
+SEEDS = range(8)
+
+#######################################
+
+def make_event(path, rule_set, seed, max_runs, drop_runs, entries=30, runs_per_entry=6):
+  """ Event with random entries, runs (tossouts, DNS/DNF, missing times, splits) and penalties, returns its event_id """
+  rnd = random.Random(seed)
+  db = sql_db.ScoringDatabase(path)
+  classes = scoring_rules.get_rule_sets()[rule_set].car_class_list[:4]
+  with db:
+    event_id = db.insert('events', name='test', rule_set=rule_set, max_runs=max_runs, drop_runs=drop_runs)
+    entry_ids = []
+    for i in range(entries):
+      entry_ids.append(db.insert('entries', event_id=event_id, car_class=rnd.choice(classes), first_name='first%d' % i, last_name='last%d' % i,
+          deleted=int(rnd.random() < 0.05), scores_visible=int(rnd.random() > 0.05)))
+    time_ms = 36000000
+    for i in range(entries * runs_per_entry):
+      start_ms = time_ms + rnd.randint(0, 1000)
+      finish_ms = start_ms + rnd.randint(30000, 90000) if rnd.random() > 0.05 else None
+      time_ms += 30000
+      db.insert('runs', event_id=event_id, entry_id=rnd.choice(entry_ids + [None]),
+          start_time_ms=start_ms if rnd.random() > 0.03 else None, finish_time_ms=finish_ms,
+          split_1_time_ms=start_ms + 10000 if finish_ms and rnd.random() < 0.5 else None,
+          split_2_time_ms=start_ms + 20000 if finish_ms and rnd.random() < 0.3 else None,
+          state=rnd.choice(['scored'] * 8 + ['tossout', 'started', 'finished', None]),
+          dns_dnf=rnd.choice([0] * 10 + [1, 2, 2, 2]), cones=rnd.choice([0, 0, 0, 1, 2, None]), gates=rnd.choice([0, 0, 0, 1, None]),
+          deleted=int(rnd.random() < 0.03))
+    for i in range(entries // 4):
+      db.insert('penalties', event_id=event_id, entry_id=rnd.choice(entry_ids), time_ms=rnd.choice([1000, 2000, 5000]), deleted=int(rnd.random() < 0.1))
+  db.close()
+  return event_id
+
+
+def dump_event(db, event_id):
+  """ Every run and entry column except the recalc flag and timestamp, in id order """
+  skip = ('recalc', 'timestamp')
+  runs = [dict((k, v) for k, v in dict(row).items() if k not in skip) for row in db.query_all("SELECT * FROM runs WHERE event_id=? ORDER BY run_id", (event_id,))]
+  entries = [dict((k, v) for k, v in dict(row).items() if k not in skip) for row in db.query_all("SELECT * FROM entries WHERE event_id=? ORDER BY entry_id", (event_id,))]
+  return runs, entries
+
+
+def add_entry(db, event_id, car_class):
+  return db.insert('entries', event_id=event_id, car_class=car_class, first_name='first', last_name=car_class)
+
+
+def add_run(db, event_id, entry_id, raw_time_ms, dns_dnf=0):
+  """ Scored run starting at 10:00, raw_time_ms None for a DNS/DNF """
+  return db.insert('runs', event_id=event_id, entry_id=entry_id, start_time_ms=36000000,
+      finish_time_ms=36000000 + raw_time_ms if raw_time_ms is not None else None, state='scored', dns_dnf=dns_dnf)
+
+
+def drain_queue(db, batch_size=scoring_rules.RECALC_BATCH_SIZE):
+  """ Run recalc batches like the recalc mule until the queue is empty, returns the count of every batch """
+  counts = []
+  while True:
+    counts.append(scoring_rules.recalc_batch(db, batch_size))
+    if not counts[-1]:
+      return counts
+
+
+def event_settings(seed):
+  """ (max_runs, drop_runs) covering the rule set defaults, no drop runs and more drop runs than runs """
+  return [5, 3, 6, 1][seed % 4], [None, 0, 1, 2, 5][seed % 5]
+
+#######################################
+
+class ScoringTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def db_path(self, name):
+    return os.path.join(self.tmp_dir, name)
+
+  def open_db(self, name='test.db'):
+    db = sql_db.ScoringDatabase(self.db_path(name))
+    self.addCleanup(db.close)
+    return db
+
+
+class RecalcEventTest(ScoringTestCase):
+  def test_recalc_event_matches_run_and_entry_recalc(self):
+    for rule_set in sorted(scoring_rules.get_rule_sets()):
+      for seed in SEEDS:
+        max_runs, drop_runs = event_settings(seed)
+        event_id = make_event(self.db_path('a.db'), rule_set, seed, max_runs, drop_runs)
+        shutil.copy(self.db_path('a.db'), self.db_path('b.db'))
+        a = sql_db.ScoringDatabase(self.db_path('a.db'))
+        b = sql_db.ScoringDatabase(self.db_path('b.db'))
+        try:
+          rules = scoring_rules.get_rules(a.select_one('events', event_id=event_id))
+          for run_id in a.query_single_list("SELECT run_id FROM runs WHERE event_id=? ORDER BY run_id", (event_id,)):
+            rules.recalc_run(a, run_id)
+          for entry_id in a.query_single_list("SELECT entry_id FROM entries WHERE event_id=? ORDER BY entry_id", (event_id,)):
+            rules.recalc_entry(a, entry_id)
+          a.entry_positions_update(event_id)
+          rules.recalc_event(b, event_id)
+          self.assertEqual(dump_event(a, event_id), dump_event(b, event_id), "%s seed %d" % (rule_set, seed))
+        finally:
+          a.close()
+          b.close()
+        os.remove(self.db_path('a.db'))
+        os.remove(self.db_path('b.db'))
+
+
+class RecalcBatchTest(ScoringTestCase):
+  def test_dnf_bogey_uses_class_slowest_time_of_each_batch(self):
+    db = self.open_db()
+    with db:
+      event_id = db.insert('events', name='test', rule_set='NWRA_RallyCross_Rules')
+      fast_id = add_entry(db, event_id, 'SA')
+      slow_id = add_entry(db, event_id, 'SA')
+      dnf_id = add_entry(db, event_id, 'SA')
+      run_ids = [add_run(db, event_id, fast_id, 50000), add_run(db, event_id, slow_id, 60000), add_run(db, event_id, dnf_id, None, dns_dnf=2)]
+    for run_id in run_ids:
+      db.set_run_recalc(run_id)
+    for entry_id in (fast_id, slow_id, dnf_id):
+      db.set_entry_recalc(entry_id)
+    drain_queue(db)
+    # DNF bogey is the class slowest time of run 1 plus 10 seconds
+    self.assertEqual(db.select_one('entries', entry_id=dnf_id)['event_time_ms'], 70000)
+
+    # an admin edit between batches moves the slowest entry to another class
+    with db:
+      db.update('entries', slow_id, car_class='PA')
+      db.set_entry_recalc(dnf_id)
+    drain_queue(db)
+    self.assertEqual(db.select_one('entries', entry_id=dnf_id)['event_time_ms'], 60000)
+
+  def test_queue_dedupe_priority_and_batch_size(self):
+    db = self.open_db()
+    with db:
+      event_1 = db.insert('events', name='test 1', rule_set='DefaultRules')
+      event_2 = db.insert('events', name='test 2', rule_set='DefaultRules')
+      entry_1 = add_entry(db, event_1, 'SA')
+      entry_2 = add_entry(db, event_1, 'SA')
+      runs_1 = [add_run(db, event_1, entry_1, 50000 + i) for i in range(3)]
+      run_2 = add_run(db, event_2, add_entry(db, event_2, 'SA'), 50000)
+    db.recalc_enqueue('entry', [(entry_1, event_1), (entry_2, event_1)], sql_db.RECALC_BULK)
+    db.recalc_enqueue('run', [(run_id, event_1) for run_id in runs_1], sql_db.RECALC_ADMIN)
+    db.recalc_enqueue('run', [(run_2, event_2)], sql_db.RECALC_ADMIN)
+    # queued again: the timing equipment raises the priority, a bulk request keeps it
+    db.recalc_enqueue('run', [(run_2, event_2)], sql_db.RECALC_LIVE)
+    db.recalc_enqueue('run', [(runs_1[0], event_1)], sql_db.RECALC_BULK)
+    db.recalc_enqueue('entry', [(entry_1, event_1)], sql_db.RECALC_ADMIN)
+    self.assertEqual(db.recalc_queue_count(), 6)
+
+    batches = []
+    while True:
+      event_id, items = db.recalc_queue_next(2)
+      batches.append((event_id, [(item['kind'], item['id'], item['priority']) for item in items]))
+      if not scoring_rules.recalc_batch(db, 2):
+        break
+    self.assertEqual(batches, [
+      (event_2, [('run', run_2, sql_db.RECALC_LIVE)]),
+      (event_1, [('run', runs_1[0], sql_db.RECALC_ADMIN), ('run', runs_1[1], sql_db.RECALC_ADMIN)]),
+      (event_1, [('run', runs_1[2], sql_db.RECALC_ADMIN), ('entry', entry_1, sql_db.RECALC_ADMIN)]),
+      (event_1, [('entry', entry_2, sql_db.RECALC_BULK)]),
+      (None, []),
+    ])
+    self.assertEqual(db.recalc_queue_count(), 0)
+
+  def test_queue_event_recalc_replaces_event_items(self):
+    db = self.open_db()
+    with db:
+      event_id = db.insert('events', name='test', rule_set='DefaultRules')
+      entry_id = add_entry(db, event_id, 'SA')
+      run_id = add_run(db, event_id, entry_id, 50000)
+    db.set_run_recalc(run_id)
+    db.set_entry_recalc(entry_id)
+    db.set_event_recalc(event_id)
+    self.assertEqual(drain_queue(db), [3, 0])
+    self.assertEqual(db.select_one('entries', entry_id=entry_id)['event_time_ms'], 50000)
+
+
+class DependentRecalcTest(ScoringTestCase):
+  def test_changed_run_flags_class_entries_with_dnf(self):
+    for rule_set in sorted(scoring_rules.get_rule_sets()):
+      db = self.open_db('%s.db' % rule_set)
+      with db:
+        event_id = db.insert('events', name='test', rule_set=rule_set)
+        changed_id, dnf_id, timed_id = [add_entry(db, event_id, 'SA') for i in range(3)]
+        other_class_id = add_entry(db, event_id, 'PA')
+        run_id = add_run(db, event_id, changed_id, 50000)
+        add_run(db, event_id, dnf_id, None, dns_dnf=2)
+        add_run(db, event_id, timed_id, 60000)
+        add_run(db, event_id, other_class_id, None, dns_dnf=2)
+        for entry_id in (changed_id, dnf_id, timed_id, other_class_id):
+          db.run_renumber(entry_id)
+      rules = scoring_rules.get_rules(db.select_one('events', event_id=event_id))
+      rules.recalc_run(db, run_id)
+      flagged = db.query_single_list("SELECT entry_id FROM entries WHERE recalc ORDER BY entry_id")
+      queued = db.query_single_list("SELECT id FROM recalc_queue WHERE kind='entry' ORDER BY id")
+      if rules.entry_dependencies:
+        # only the DNF bogey of the same class depends on the changed run
+        self.assertEqual((flagged, queued), ([dnf_id], [dnf_id]), rule_set)
+      else:
+        self.assertEqual((flagged, queued), ([], []), rule_set)
+
+
+class WhatIfTest(ScoringTestCase):
+  def test_whatif_matches_recalc_and_writes_nothing(self):
+    rule_sets = sorted(scoring_rules.get_rule_sets())
+    for seed in SEEDS:
+      rule_set = rule_sets[seed % len(rule_sets)]
+      whatif_rule_set = rule_sets[(seed + 1) % len(rule_sets)]
+      max_runs, drop_runs = event_settings(seed)
+      whatif_max_runs, whatif_drop_runs = event_settings(seed + 1)
+      event_id = make_event(self.db_path('%d.db' % seed), rule_set, seed, max_runs, drop_runs)
+      db = self.open_db('%d.db' % seed)
+      event = db.select_one('events', event_id=event_id)
+      scoring_rules.get_rules(event).recalc_event(db, event_id)
+
+      before = dump_event(db, event_id)
+      changes = db.totalchanges()
+      whatif_rules, entry_list = scoring_rules.whatif_event(db, event, whatif_rule_set, whatif_max_runs, whatif_drop_runs)
+      self.assertEqual(db.totalchanges(), changes)
+      self.assertEqual(dump_event(db, event_id), before)
+      for entry in entry_list:
+        self.assertEqual(entry['current'], dict((key, db.select_one('entries', entry_id=entry['entry_id'])[key]) for key in entry['current']))
+
+      # the same change made for real, settings left as None in the what-if keep the event's value
+      with db:
+        db.update('events', event_id, rule_set=whatif_rule_set, max_runs=whatif_rules.max_runs, drop_runs=whatif_rules.drop_runs)
+      event = db.select_one('events', event_id=event_id)
+      scoring_rules.get_rules(event).recalc_event(db, event_id)
+      for entry in entry_list:
+        self.assertEqual(entry['whatif'], dict((key, db.select_one('entries', entry_id=entry['entry_id'])[key]) for key in entry['whatif']), "%s seed %d" % (whatif_rule_set, seed))
+      self.assertEqual(len(entry_list), db.query_single("SELECT count(*) FROM entries WHERE event_id=? AND scores_visible AND NOT deleted", (event_id,)))
+
+
+class SeasonTest(ScoringTestCase):
+  def season_tables(self, db):
+    return ([dict(row) for row in db.query_all("SELECT * FROM season_results ORDER BY entry_id")],
+        [dict(row) for row in db.query_all("SELECT * FROM season_points ORDER BY season_name, driver_key, car_class")])
+
+  def test_season_update_matches_season_rebuild(self):
+    path = self.db_path('season.db')
+    rule_sets = sorted(scoring_rules.get_rule_sets())
+    # entries of every event are named first0/last0.. so the same drivers come back each event
+    event_ids = [make_event(path, rule_sets[seed % len(rule_sets)], seed, *event_settings(seed), entries=12) for seed in SEEDS]
+    db = self.open_db('season.db')
+    with db:
+      for i, event_id in enumerate(event_ids):
+        db.update('events', event_id, season_name='2016' if i % 3 else '2017')
+    for event_id in event_ids:
+      scoring_rules.get_rules(db.select_one('events', event_id=event_id)).recalc_event(db, event_id)
+    self.assertTrue(db.count('season_points'))
+
+    rnd = random.Random(0)
+    changes = [
+      lambda event_id: db.execute("UPDATE runs SET dns_dnf=2 WHERE event_id=? AND run_id % 3 = 0", (event_id,)),
+      lambda event_id: db.execute("UPDATE entries SET car_class=(SELECT car_class FROM entries WHERE event_id=? ORDER BY entry_id DESC LIMIT 1) WHERE event_id=? AND entry_id % 2 = 0", (event_id, event_id)),
+      lambda event_id: db.execute("UPDATE entries SET deleted=1 WHERE entry_id=(SELECT min(entry_id) FROM entries WHERE event_id=?)", (event_id,)),
+      lambda event_id: db.execute("UPDATE entries SET season_points=0 WHERE event_id=? AND entry_id % 3 = 0", (event_id,)),
+      lambda event_id: db.execute("UPDATE events SET season_name='2017' WHERE event_id=?", (event_id,)),
+      lambda event_id: db.execute("UPDATE events SET season_name=NULL WHERE event_id=?", (event_id,)),
+      lambda event_id: db.execute("UPDATE events SET deleted=1 WHERE event_id=?", (event_id,)),
+    ]
+    for i, change in enumerate(changes):
+      event_id = rnd.choice(event_ids)
+      with db:
+        change(event_id)
+        event = db.select_one('events', event_id=event_id)
+        if event['deleted']:
+          scoring_rules.season_update(db, event_id)
+        else:
+          scoring_rules.get_rules(event).recalc_event(db, event_id) # recalc_event calls season_update
+      updated = self.season_tables(db)
+      scoring_rules.season_rebuild(db)
+      self.assertEqual(updated, self.season_tables(db), "change %d of event %d" % (i, event_id))
+
+    # rebuilding one season leaves the others alone
+    scoring_rules.season_rebuild(db, '2016')
+    self.assertEqual(updated, self.season_tables(db))
+
+
+@unittest.skipIf(scoring_vector.numpy is None, "NumPy is not installed")
+class ScoreEventVectorTest(ScoringTestCase):
+  def test_vectorized_matches_python(self):
+    for rule_set in sorted(scoring_rules.get_rule_sets()):
+      for seed in SEEDS:
+        max_runs, drop_runs = event_settings(seed)
+        event_id = make_event(self.db_path('a.db'), rule_set, seed, max_runs, drop_runs, entries=[30, 3, 1, 0][seed % 4])
+        db = sql_db.ScoringDatabase(self.db_path('a.db'))
+        try:
+          rules = scoring_rules.get_rules(db.select_one('events', event_id=event_id))
+          self.assertTrue(rules.can_vectorize(), rule_set)
+          python_rows = rules.load_event(db, event_id)
+          vector_rows = rules.load_event(db, event_id)
+        finally:
+          db.close()
+        os.remove(self.db_path('a.db'))
+        rules.score_event(*python_rows, vectorized=False)
+        rules.score_event(*vector_rows, vectorized=True)
+        for name, python_list, vector_list in (('entry', python_rows[0], vector_rows[0]), ('run', python_rows[1], vector_rows[1])):
+          self.assertEqual([dict(row) for row in python_list], [dict(row) for row in vector_list], "%s %s seed %d" % (rule_set, name, seed))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,70 @@
+""" ScoringDatabase tests
+
+  python -m unittest test_sql_db
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+# sql_db opens schema_versions/ relative to the working directory, like the apps do
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import sql_db
+
+#######################################
+
+class RunRenumberTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.db = sql_db.ScoringDatabase(os.path.join(self.tmp_dir, 'test.db'))
+    self.event_id = self.db.insert('events', name='test', rule_set='DefaultRules')
+
+  def tearDown(self):
+    self.db.close()
+    shutil.rmtree(self.tmp_dir)
+
+  def add_runs(self, entry_id, states):
+    run_ids = [self.db.insert('runs', event_id=self.event_id, entry_id=entry_id, state=state) for state in states]
+    self.db.run_renumber(entry_id)
+    return run_ids
+
+  def run_numbers(self, entry_id):
+    return [(row['run_id'], row['run_number']) for row in self.db.query_all("SELECT run_id, run_number FROM runs WHERE entry_id=? AND NOT deleted ORDER BY run_id", (entry_id,))]
+
+  def test_move_middle_run_to_another_entry(self):
+    old_entry_id = self.db.insert('entries', event_id=self.event_id)
+    new_entry_id = self.db.insert('entries', event_id=self.event_id)
+    # runs of the two entries interleave like they do on course
+    old_runs = []
+    new_runs = []
+    for old_state, new_state in (('scored', 'scored'), ('scored', 'tossout'), ('scored', 'scored'), ('scored', None)):
+      old_runs += self.add_runs(old_entry_id, [old_state])
+      new_runs += self.add_runs(new_entry_id, [new_state])
+    self.assertEqual(self.run_numbers(old_entry_id), zip(old_runs, [1, 2, 3, 4]))
+    self.assertEqual(self.run_numbers(new_entry_id), zip(new_runs, [1, 1, 2, 2]))
+
+    # what the timing page and recalc_run do when run 2 of the old entry is reassigned
+    moved_run_id = old_runs[1]
+    self.db.update('runs', moved_run_id, entry_id=new_entry_id)
+    self.assertEqual(self.db.run_renumber(old_entry_id, moved_run_id), 2)
+    self.db.run_renumber(new_entry_id, moved_run_id)
+
+    self.assertEqual(self.run_numbers(old_entry_id), [(old_runs[0], 1), (old_runs[2], 2), (old_runs[3], 3)])
+    # the tossout after the moved run takes its number
+    self.assertEqual(self.run_numbers(new_entry_id), sorted(zip(new_runs, [1, 2, 3, 3]) + [(moved_run_id, 2)]))
+    # counted runs are numbered 1..n without gaps
+    scored = self.db.query_single_list("SELECT run_number FROM runs WHERE entry_id=? AND state='scored' ORDER BY run_id", (new_entry_id,))
+    self.assertEqual(scored, range(1, len(scored) + 1))
+
+  def test_renumber_writes_only_changed_runs(self):
+    entry_id = self.db.insert('entries', event_id=self.event_id)
+    run_ids = self.add_runs(entry_id, ['scored'] * 4)
+    self.assertEqual(self.db.run_renumber(entry_id), 0)
+    self.db.update('runs', run_ids[0], deleted=1)
+    self.assertEqual(self.db.run_renumber(entry_id, run_ids[0]), 3)
+    self.assertEqual(self.run_numbers(entry_id), zip(run_ids[1:], [1, 2, 3]))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,104 @@
+""" Tag Heuer 520 timer tests
+
+  python -m unittest test_tag_heuer_520
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+# sql_db opens schema_versions/ relative to the working directory, like the apps do
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import sql_db
+from tag_heuer_520 import parse_frames, RECORD_LENGTH, TimeRecord, DeadTimeFilter, DEADTIME_DEFAULTS, write_suppressed
+
+#######################################
+
+def time_line(kind, number, channel, time_ms):
+  """ Time record as the timer sends it, without the '\r' """
+  return '%s %04d     %-2s %02d:%02d:%02d.%03d00 ' % (kind, number, channel, time_ms // 3600000, time_ms // 60000 % 60, time_ms // 1000 % 60, time_ms % 1000)
+
+
+class ParseFramesTest(unittest.TestCase):
+  def test_time_records(self):
+    lines = [time_line('T ', 1, 'M1', 36000123), time_line('T-', 1, 'M1', 36000123), time_line('T+', 2, 'M2', 36061456)]
+    self.assertEqual(len(lines[0]), RECORD_LENGTH)
+    buffer = bytearray('\r\n'.join(lines) + '\r')
+    records = parse_frames(buffer)
+    self.assertEqual([(record.kind, record.number, record.channel, record.time_ms) for record in records],
+        [('T ', '0001', 'M1', 36000123), ('T-', '0001', 'M1', 36000123), ('T+', '0002', 'M2', 36061456)])
+    self.assertEqual([record.line for record in records], lines)
+    self.assertEqual(buffer, bytearray())
+
+  def test_partial_line_is_kept_for_the_next_chunk(self):
+    line = time_line('T ', 3, 'M2', 36100000)
+    buffer = bytearray(time_line('T ', 2, 'M1', 36090000) + '\r' + line[:10])
+    self.assertEqual([record.number for record in parse_frames(buffer)], ['0002'])
+    self.assertEqual(buffer, bytearray(line[:10]))
+    self.assertEqual(parse_frames(buffer), [])
+    buffer.extend(line[10:] + '\r')
+    records = parse_frames(buffer)
+    self.assertEqual([(record.channel, record.time_ms, record.line) for record in records], [('M2', 36100000, line)])
+    self.assertEqual(buffer, bytearray())
+
+  def test_garbage_lines(self):
+    capture = [] # appended to like timer_capture.CaptureLog
+    good = time_line('T ', 4, 'M1', 36200000)
+    buffer = bytearray('T garbage\r' + good[:21] + 'xx' + good[23:] + '\r' + 'RS232 0\r' + good + '\r')
+    records = parse_frames(buffer, capture)
+    # malformed time records are dropped, other lines come back with no time
+    self.assertEqual([(record.kind, record.time_ms) for record in records], [('RS', None), ('T ', 36200000)])
+    # every line is captured before it is parsed, including the ones dropped
+    self.assertEqual(capture, ['T garbage', good[:21] + 'xx' + good[23:], 'RS232 0', good])
+
+
+class DeadTimeFilterTest(unittest.TestCase):
+  def impulses(self, deadtime, channel, times_ms):
+    """ Which impulses of a channel the filter accepts """
+    return [deadtime.accept(TimeRecord('T ', '0001', channel, time_ms, 'line')) for time_ms in times_ms]
+
+  def test_finish_debounce(self):
+    deadtime = DeadTimeFilter()
+    self.assertEqual(deadtime.deadtime_ms['finish'], 300)
+    self.assertEqual(self.impulses(deadtime, 'M2', [60000, 60100, 60500]), [True, False, True])
+    self.assertEqual(deadtime.suppressed, {'finish':1})
+    self.assertEqual(deadtime.recent, [('finish', 60100)])
+
+  def test_inputs_are_filtered_separately(self):
+    deadtime = DeadTimeFilter()
+    # start and finish at the same time, the timer's modes send the same input as '1', 'M1' or '01'
+    self.assertEqual(self.impulses(deadtime, 'M1', [60000]), [True])
+    self.assertEqual(self.impulses(deadtime, 'M2', [60000]), [True])
+    self.assertEqual(self.impulses(deadtime, '1', [61000]), [False])
+    self.assertEqual(self.impulses(deadtime, '01', [62000]), [True])
+    self.assertEqual(self.impulses(deadtime, 'M3', [60100, 60200]), [True, False])
+    self.assertEqual(self.impulses(deadtime, 'M9', [60000, 60000]), [True, True]) # unknown inputs are not filtered
+    # a time before the last accepted one is a reset timer, not a bounce
+    self.assertEqual(self.impulses(deadtime, 'M2', [1000]), [True])
+    self.assertEqual(deadtime.take(), ({'start':1, 'split_1':1}, [('start', 61000), ('split_1', 60200)]))
+    self.assertEqual(deadtime.take(), ({}, []))
+
+  def test_registry_settings(self):
+    tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp_dir)
+    db = sql_db.ScoringDatabase(os.path.join(tmp_dir, 'test.db'))
+    self.addCleanup(db.close)
+    event_id = db.insert('events', name='test', rule_set='DefaultRules')
+    db.reg_set_many({'active_event_id':event_id, 'deadtime_finish':'0.5', 'deadtime_split_1':'0'})
+
+    deadtime = DeadTimeFilter()
+    deadtime.load(db)
+    self.assertEqual(deadtime.deadtime_ms, {'start':DEADTIME_DEFAULTS['start'] * 1000, 'finish':500, 'split_1':0, 'split_2':300})
+    self.assertEqual(self.impulses(deadtime, 'M2', [60000, 60400, 60500]), [True, False, True])
+    self.assertEqual(self.impulses(deadtime, 'M3', [60000, 60000]), [True, True]) # 0 turns the filter off
+
+    write_suppressed(db, *deadtime.take())
+    self.assertEqual(self.impulses(deadtime, 'M2', [60600]), [False])
+    write_suppressed(db, *deadtime.take())
+    self.assertEqual(db.reg_get_int('.suppressed_finish', event_id=event_id), 2)
+    self.assertEqual(db.reg_get('.suppressed_recent', event_id=event_id), '[["finish", 60400], ["finish", 60600]]')
+
+
+if __name__ == '__main__':
+  unittest.main()
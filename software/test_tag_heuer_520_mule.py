@@ -0,0 +1,105 @@
+""" Timing mule impulse matching tests
+
+Impulses are applied with replay=True, like timer_capture.py does, so no sounds are
+played and no recalc message is sent outside of uwsgi.
+
+  python -m unittest test_tag_heuer_520_mule
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# sql_db opens schema_versions/ relative to the working directory, like the apps do
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+  import scoring_config
+except ImportError:
+  # the mule only needs SCORING_DB_PATH to open its own connection, which these tests never do
+  sys.modules['scoring_config'] = __import__('scoring_config_example')
+
+import sql_db
+import tag_heuer_520_mule
+from tag_heuer_520_mule import handle_time_event
+
+START, FINISH, SPLIT_1, SPLIT_2 = 'M1', 'M2', 'M3', 'M4'
+
+#######################################
+
+class ImpulseMatchTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.db = sql_db.ScoringDatabase(os.path.join(self.tmp_dir, 'test.db'))
+    self.event_id = self.db.insert('events', name='test', rule_set='DefaultRules')
+    self.db.reg_set('active_event_id', self.event_id)
+    # module level state of the mule, fresh for every test
+    tag_heuer_520_mule.course = tag_heuer_520_mule.CourseTracker()
+    tag_heuer_520_mule.context = tag_heuer_520_mule.EventContext()
+
+  def tearDown(self):
+    self.db.close()
+    shutil.rmtree(self.tmp_dir)
+
+  def impulse(self, channel, seconds):
+    """ Apply an impulse, returns the run it was matched to or None when its times row is invalid """
+    handle_time_event(self.db, channel, seconds * 1000, replay=True)
+    time = self.db.query_one("SELECT time_id, invalid FROM times ORDER BY time_id DESC LIMIT 1")
+    run_id = self.db.query_single("SELECT run_id FROM latency WHERE time_id=?", (time['time_id'],))
+    self.assertEqual(bool(time['invalid']), run_id is None)
+    return run_id
+
+  def run_times(self, run_id):
+    run = self.db.select_one('runs', run_id=run_id)
+    return tuple(run[key] // 1000 if run[key] is not None else None for key in ('start_time_ms', 'split_1_time_ms', 'split_2_time_ms', 'finish_time_ms')) + (run['state'],)
+
+  def test_cars_on_course(self):
+    self.assertIsNone(self.impulse(FINISH, 990)) # no car on course
+    run_a = self.impulse(START, 1000)
+    run_b = self.impulse(START, 1030)
+    self.assertEqual(self.impulse(SPLIT_1, 1040), run_a)
+    self.assertEqual(self.impulse(SPLIT_2, 1050), run_a)
+    self.assertEqual(self.impulse(SPLIT_1, 1060), run_b)
+    self.assertEqual(self.impulse(FINISH, 1070), run_a)
+
+    self.db.reg_set('disable_start', 1)
+    self.assertIsNone(self.impulse(START, 1075)) # false start while starts are disabled
+    self.db.reg_set('disable_start', 0)
+    run_c = self.impulse(START, 1080)
+
+    self.assertEqual(self.impulse(SPLIT_2, 1086), run_b) # run_c has not passed split 1
+    self.assertEqual(self.impulse(FINISH, 1090), run_b)
+    self.assertEqual(self.impulse(FINISH, 1100), run_c)
+    self.assertIsNone(self.impulse(FINISH, 1110)) # course is empty again
+
+    self.assertEqual(self.run_times(run_a), (1000, 1040, 1050, 1070, 'finished'))
+    self.assertEqual(self.run_times(run_b), (1030, 1060, 1086, 1090, 'finished'))
+    self.assertEqual(self.run_times(run_c), (1080, None, None, 1100, 'finished'))
+    self.assertEqual(self.db.count('runs'), 3)
+
+  def test_finish_before_start_time_is_not_matched(self):
+    run_id = self.impulse(START, 1000)
+    self.assertIsNone(self.impulse(FINISH, 999))
+    self.assertEqual(self.impulse(FINISH, 1001), run_id)
+
+  def test_admin_edit_reloads_course(self):
+    run_a = self.impulse(START, 1000)
+    run_b = self.impulse(START, 1010)
+    # the first car is taken off course on the timing page
+    with self.db:
+      self.db.update('runs', run_a, state='tossout')
+      self.db.course_changed()
+    self.assertEqual(self.impulse(FINISH, 1060), run_b)
+    self.assertEqual(self.run_times(run_a), (1000, None, None, None, 'tossout'))
+
+  def test_run_edited_without_course_change(self):
+    run_a = self.impulse(START, 1000)
+    run_b = self.impulse(START, 1010)
+    # edited by a connection that did not bump the course version, match_run finds out on write
+    self.db.update('runs', run_a, state='tossout')
+    self.assertEqual(self.impulse(FINISH, 1060), run_b)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,135 @@
+""" Append-only capture log of the raw Tag Heuer serial lines
+
+The timing mule appends and flushes every line here before the impulse is queued
+for the database, so a busy database never loses or delays timing, lines reach
+the disk within CAPTURE_SYNC_INTERVAL. Each line of the log is the wall clock
+time in ms, a tab and the raw timer line.
+
+Replay applies the logged impulses missing from the times table of the active
+event, eg. after the mule was stopped before they were applied or into a fresh
+database. The log has the lines from before the dead time filter, so replay runs
+them through the same tag_heuer_520.DeadTimeFilter with the dead times from the
+registry. Starts replayed this way have no entry assigned.
+
+  python timer_capture.py replay [YYYY-MM-DD[ HH:MM:SS]] [capture log]
+
+Only impulses logged since the given time are replayed, the default is midnight today.
+"""
+import logging
+logging.basicConfig()
+import os
+import datetime
+import threading
+from time import time, mktime
+from collections import Counter
+
+from tag_heuer_520 import parse_record, DeadTimeFilter
+
+#######################################
+
+def capture_path(config):
+  """ TIMER_CAPTURE_PATH from scoring_config, or a file next to the database """
+  path = getattr(config, 'TIMER_CAPTURE_PATH', None)
+  if path is None:
+    path = os.path.splitext(config.SCORING_DB_PATH)[0] + '_timer_capture.log'
+  return path
+
+
+CAPTURE_SYNC_INTERVAL = 1 # seconds, lines are synced to disk at most this long after they were appended
+
+class CaptureLog(object):
+  """ Every line is flushed when it is appended, so it survives the mule crashing
+
+  Flushing alone does not survive a power loss, the file is fsynced on a timer
+  thread instead of by append so the serial reader never waits on the disk.
+  """
+
+  def __init__(self, path, sync_interval=CAPTURE_SYNC_INTERVAL):
+    self.path = path
+    self.sync_interval = sync_interval # None never syncs before close
+    self.file = open(path, 'ab')
+    self.lock = threading.Lock()
+    self.timer = None # pending sync
+
+  def append(self, line):
+    self.file.write('%d\t%s\n' % (int(time() * 1000), line))
+    self.file.flush()
+    if self.sync_interval is not None:
+      with self.lock:
+        if self.timer is None:
+          self.timer = threading.Timer(self.sync_interval, self.sync)
+          self.timer.daemon = True
+          self.timer.start()
+
+  def sync(self):
+    with self.lock:
+      self.timer = None
+      if not self.file.closed:
+        os.fsync(self.file.fileno())
+
+  def close(self):
+    with self.lock:
+      if self.timer is not None:
+        self.timer.cancel()
+        self.timer = None
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      self.file.close()
+
+
+def read_capture(path, since_ms=None):
+  """ Yield (wall_ms, line) for every line of a capture log logged at or after since_ms """
+  with open(path, 'rb') as f:
+    for log_line in f:
+      wall_ms, sep, line = log_line.rstrip('\n').partition('\t')
+      try:
+        wall_ms = int(wall_ms)
+      except ValueError:
+        continue # torn write at the end of the log
+      if since_ms is None or wall_ms >= since_ms:
+        yield wall_ms, line
+
+#######################################
+
+def replay(db, path, since_ms, handle_time_event):
+  """ Apply logged time impulses that the active event does not have yet, returns (applied, skipped, suppressed) """
+  event = db.select_one('events', event_id=db.reg_get('active_event_id'), deleted=0)
+  if event is None:
+    raise ValueError("no active event")
+  existing = Counter((row['channel'], row['time_ms']) for row in db.query_all("SELECT channel, time_ms FROM times WHERE event_id=? AND NOT deleted", (event['event_id'],)))
+  deadtime = DeadTimeFilter()
+  deadtime.load(db)
+  applied = 0
+  skipped = 0
+  suppressed = 0
+  for wall_ms, line in read_capture(path, since_ms):
+    record = parse_record(line)
+    if record is None or record.kind != 'T ':
+      continue
+    if not deadtime.accept(record):
+      suppressed += 1
+      continue
+    key = (record.channel, record.time_ms)
+    if existing[key] > 0:
+      existing[key] -= 1
+      skipped += 1
+    else:
+      handle_time_event(db, record.channel, record.time_ms, replay=True)
+      applied += 1
+  return applied, skipped, suppressed
+
+
+if __name__ == "__main__":
+  import sys
+  import tag_heuer_520_mule
+  if len(sys.argv) < 2 or sys.argv[1] != 'replay':
+    print __doc__
+    sys.exit(1)
+  if len(sys.argv) > 2:
+    since = datetime.datetime.strptime(sys.argv[2], '%Y-%m-%d %H:%M:%S' if ':' in sys.argv[2] else '%Y-%m-%d')
+  else:
+    since = datetime.datetime.combine(datetime.date.today(), datetime.time())
+  path = sys.argv[3] if len(sys.argv) > 3 else capture_path(tag_heuer_520_mule.config)
+  applied, skipped, suppressed = replay(tag_heuer_520_mule.get_db(), path, int(mktime(since.timetuple()) * 1000), tag_heuer_520_mule.handle_time_event)
+  print "%d impulses replayed, %d already recorded, %d suppressed by the dead time filter" % (applied, skipped, suppressed)
+  print "queued for recalc, they are scored with the next recalc (eg. Recalc on the admin scores page)"
@@ -5,7 +5,10 @@ import urllib2
 import os
 import types
 import re
+import ctypes, ctypes.util
+from time import time
 from datetime import date
+import audio_cues
 
 # used to pipe stdout from subprocess to /dev/null
 dev_null = open(os.devnull, 'wb')
@@ -21,6 +24,9 @@ def date_weekday(date_str):
 #######################################
 
 def play_sound(path):
+  # preloaded WAV cues are played by audio_cue_mule.py when it is running
+  if path.endswith('.wav') and audio_cues.send_cue(path):
+    return
   # this uses the play command provided by the sox package
   # using Popen allows this to be non blocking
   try:
@@ -166,52 +172,111 @@ def time_cmp(a,b):
 
 #######################################
 
-def run_cmp(a,b):
-  #util_log.debug("run_cmp: %r, %r", a, b)
-  if a['dns_dnf'] and b['dns_dnf']:
-    return 0
-  elif a['dns_dnf']:
-    return 1
-  elif b['dns_dnf']:
-    return -1
-  elif a['total_time_ms'] in (0,None) and b['total_time_ms'] in (0,None):
-    return 0
-  elif a['total_time_ms'] in (0,None):
-    return 1
-  elif b['total_time_ms'] is (0,None):
-    return -1
-  elif a['total_time_ms'] < b['total_time_ms']:
-    return -1
-  elif a['total_time_ms'] > b['total_time_ms']:
-    return 1
-  else:
-    return 0
+def run_numbers(runs):
+  """ Yield (run, run_number) for one entry's runs given in run_id order
+
+  Runs that are tossed out or have no state do not count, they get the number of the previous counted run.
+  """
+  count = 0
+  for run in runs:
+    if run['state'] is not None and run['state'] != 'tossout':
+      count += 1
+    yield run, count
+
+def run_sectors(run):
+  """ Fill in sector_1/2/3_time of a run dict from its start, split and finish times
+
+  A sector is blank unless both of its timestamps are set and in order.
+  """
+  times = (run['start_time_ms'], run['split_1_time_ms'], run['split_2_time_ms'], run['finish_time_ms'])
+  for i in range(3):
+    if times[i] and times[i + 1] and times[i + 1] > times[i]:
+      run['sector_%d_time' % (i + 1)] = format_time(times[i + 1] - times[i])
+    else:
+      run['sector_%d_time' % (i + 1)] = None
+  return run
 
 #######################################
 
-def entry_cmp(a,b):
-  #util_log.debug("entry_cmp: %r, %r", a, b)
-  if a['event_runs'] < b['event_runs']:
-    return 1
-  elif a['event_runs'] > b['event_runs']:
-    return -1
-  elif a['event_time_ms'] in (0,None) and b['event_time_ms'] in (0,None):
-    return 0
-  elif a['event_time_ms'] in (0,None):
-    return 1
-  elif b['event_time_ms'] in (0,None):
-    return -1
-  elif a['event_time_ms'] < b['event_time_ms']:
-    return -1
-  elif a['event_time_ms'] > b['event_time_ms']:
-    return 1
-  else:
-    return 0
+def run_sort_key(run):
+  """ Sort key for an entry's scored runs, best first
 
-def start_entry_cmp(a,b):
-  if a['run_count'] < b['run_count']:
-    return 1
-  elif a['run_count'] > b['run_count']:
-    return -1
+  Timed runs by total time, then runs without a time, then DNS/DNF runs.
+  """
+  if run['dns_dnf']:
+    return (2, 0)
+  elif run['total_time_ms'] in (0,None):
+    return (1, 0)
   else:
-    return 0
+    return (0, run['total_time_ms'])
+
+#######################################
+
+ENTRY_SORT_MAX_RUNS = 1000
+ENTRY_SORT_NO_TIME = 10**10 # ms, larger than any event time
+
+def entry_sort_key(entry):
+  """ Integer sort key for an entry's event standing, lower is better
+
+  Entries with more scored runs come first, then by event time with entries that have no time (or a DNF) last.
+  Stored in entries.sort_key by recalc, schema_versions/upgrade_008.sql has the same formula.
+  """
+  event_time_ms = entry['event_time_ms']
+  if event_time_ms in (0,None):
+    event_time_ms = ENTRY_SORT_NO_TIME
+  return (ENTRY_SORT_MAX_RUNS - (entry['event_runs'] or 0)) * (ENTRY_SORT_NO_TIME + 1) + event_time_ms
+
+def entry_positions(entries):
+  """ Yield (entry, class_position, overall_position) for an event's entries given in (sort_key, entry_id) order
+
+  Positions count visible entries only, hidden and deleted entries get None.
+  """
+  class_count = {}
+  overall_count = 0
+  for entry in entries:
+    if entry['scores_visible'] and not entry['deleted']:
+      overall_count += 1
+      class_count[entry['car_class']] = class_count.get(entry['car_class'], 0) + 1
+      yield entry, class_count[entry['car_class']], overall_count
+    else:
+      yield entry, None, None
+
+
+def driver_key(entry):
+  """ Identity matching one driver's entries across the events of a season
+
+  The motorsportreg.com number when known, otherwise the lower case name.
+  """
+  if entry['msreg_number']:
+    return 'msreg:%s' % entry['msreg_number'].strip()
+  return 'name:%s %s' % ((entry['first_name'] or '').strip().lower(), (entry['last_name'] or '').strip().lower())
+
+#######################################
+
+class _timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+CLOCK_MONOTONIC = 1 # linux
+
+try:
+  _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True).clock_gettime
+except (OSError, AttributeError):
+  _clock_gettime = None
+
+def monotonic_ms():
+  """ CLOCK_MONOTONIC in milliseconds, the same clock in every process so mules and web workers can be compared
+
+  Falls back to wall clock time where clock_gettime is not available.
+  """
+  if _clock_gettime is not None:
+    ts = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) == 0:
+      return ts.tv_sec * 1000 + ts.tv_nsec // 1000000
+  return int(time() * 1000)
+
+def percentile(values, percent):
+  """ Nearest rank percentile of a sorted list, None when empty """
+  if not values:
+    return None
+  return values[max(int(-(-len(values) * percent // 100)) - 1, 0)]
+